@@ -18,7 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from time import perf_counter
+_import_start = perf_counter()
+
 # import wheel deps
+# the wheels are only put on the path here, aiohttp and numpy are imported by the code that needs them
 import sys
 import os.path as path
 from glob import glob
@@ -35,7 +39,11 @@ from .sync import *
 from .ui_2d import *
 from .ui_3d import *
 from .util import *
-from .addon import addon
+from .addon import addon, profile_timer
+from .paint import paint_timer
+from .messaging import handle
+
+addon.startup["import"] = perf_counter() - _import_start
 
 
 bl_info = {
@@ -57,6 +65,8 @@ classes = (
     SB_OT_serv_stop,
     SB_OT_send_uv,
     SB_OT_texture_list,
+    SB_OT_replay,
+    SB_OT_profile,
     SB_OT_open_sprite,
     SB_OT_new_sprite,
     SB_OT_edit_sprite,
@@ -66,8 +76,13 @@ classes = (
     SB_OT_reference_reload,
     SB_OT_reference_reload_all,
     SB_OT_update_image,
+    SB_OT_metrics_export,
+    SB_OT_metrics_reset,
+    SB_OT_trace,
+    SB_OT_trace_export,
 
     SB_PT_panel_link,
+    SB_PT_panel_stats,
 
     SB_MT_menu_2d,
 
@@ -77,6 +92,7 @@ classes = (
 
 
 def register():
+    t = perf_counter()
     async_loop.setup_asyncio_executor()
 
     from bpy.utils import register_class
@@ -93,6 +109,8 @@ def register():
         editor_menus = bpy.types.MASK_MT_editor_menus
     editor_menus.append(SB_MT_menu_2d.header_draw)
 
+    addon.startup["register"] = perf_counter() - t
+
     # delay is just in case something else happens at startup
     # `persistent` protects the timer if the user loads a file before it fires
     bpy.app.timers.register(start, first_interval=0.5, persistent=True)
@@ -102,9 +120,19 @@ def unregister():
     if addon.server_up:
         addon.stop_server()
 
+    if bpy.app.timers.is_registered(profile_timer):
+        bpy.app.timers.unregister(profile_timer)
+    addon.stop_profile()
+
     if bpy.app.timers.is_registered(start):
         bpy.app.timers.unregister(start)
 
+    if bpy.app.timers.is_registered(paint_timer):
+        bpy.app.timers.unregister(paint_timer)
+
+    if bpy.app.timers.is_registered(util.apply_deferred):
+        bpy.app.timers.unregister(util.apply_deferred)
+
     if sb_on_load_post in bpy.app.handlers.load_post:
         bpy.app.handlers.load_post.remove(sb_on_load_post)
 
@@ -114,6 +142,13 @@ def unregister():
     if sb_on_depsgraph_update_post in bpy.app.handlers.depsgraph_update_post:
         bpy.app.handlers.depsgraph_update_post.remove(sb_on_depsgraph_update_post)
 
+    if sb_on_save_pre in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(sb_on_save_pre)
+
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if sb_on_undo_post in handlers:
+            handlers.remove(sb_on_undo_post)
+
     try:
         editor_menus = bpy.types.IMAGE_MT_editor_menus
     except AttributeError:
@@ -129,19 +164,23 @@ def unregister():
         unregister_class(cls)
 
 
-# hash for the set of image sources/names that is used to check if new images were added
-_images_hv = 0
-
-
 @persistent
 def start():
-    global _images_hv
-    _images_hv = hash(tuple(img.filepath for img in bpy.data.images))
+    t = perf_counter()
+    addon.textures.reset()
 
+    t_ref = perf_counter()
     bpy.ops.pribambase.reference_reload_all()
+    addon.startup["reference_reload_all"] = perf_counter() - t_ref
+
+    t_load = perf_counter()
+    load_sprites()
+    addon.startup["load_sprites"] = perf_counter() - t_load
 
     if addon.prefs.autostart:
+        t_serv = perf_counter()
         addon.start_server()
+        addon.startup["start_server"] = perf_counter() - t_serv
 
     if sb_on_load_post not in bpy.app.handlers.load_post:
         bpy.app.handlers.load_post.append(sb_on_load_post)
@@ -152,13 +191,39 @@ def start():
     if sb_on_depsgraph_update_post not in bpy.app.handlers.depsgraph_update_post:
         bpy.app.handlers.depsgraph_update_post.append(sb_on_depsgraph_update_post)
 
+    if sb_on_save_pre not in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.append(sb_on_save_pre)
+
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if sb_on_undo_post not in handlers:
+            handlers.append(sb_on_undo_post)
+
+    if not bpy.app.timers.is_registered(paint_timer):
+        bpy.app.timers.register(paint_timer, first_interval=1.0, persistent=True)
+
+    addon.startup["start"] = perf_counter() - t
+
+    if addon.prefs.startup_report:
+        print(addon.startup_report())
+
+
+def load_sprites():
+    """Update the textures from the .aseprite files that were saved after the blendfile"""
+    if addon.prefs.load_sprites:
+        # the packed pixels are as new as the blendfile, so only files saved later have something newer
+        saved = path.getmtime(bpy.data.filepath) if bpy.data.filepath else 0.0
+        util.load_sprites(bpy.data.images, newer_than=saved)
+
 
 @persistent
 def sb_on_load_post(scene):
-    global _images_hv
-    _images_hv = hash(frozenset(img.filepath for img in bpy.data.images))
+    addon.textures.reset()
+    util.forget_dispatch()
+    util.forget_images()
+    util.forget_unsaved()
 
     bpy.ops.pribambase.reference_reload_all()
+    load_sprites()
 
     if addon.prefs.autostart:
         addon.start_server()
@@ -166,24 +231,35 @@ def sb_on_load_post(scene):
 
 @persistent
 def sb_on_load_pre(scene):
+    util.forget_dispatch()
+    handle.forget_frames()
     if addon.server_up:
         addon.stop_server()
 
 
 @persistent
-def sb_on_depsgraph_update_post(scene):
-    global _images_hv
+def sb_on_save_pre(scene):
+    util.pack_unsaved_images()
 
+
+@persistent
+def sb_on_undo_post(scene):
+    # the pixels went back to something else than the last frame, so resending the same frame must not be skipped
+    util.forget_images()
+
+
+@persistent
+def sb_on_depsgraph_update_post(scene):
     dg = bpy.context.evaluated_depsgraph_get()
 
-    if dg.id_type_updated('IMAGE'):
-        imgs = frozenset(util.image_name(img) for img in bpy.data.images)
-        hv = hash(imgs)
+    # removing images does not always come with an image update, but it changes their count
+    if dg.id_type_updated('IMAGE') or addon.textures.stale:
+        # only the images in the update are checked, pixel updates don't change the name so they're cheap
+        imgs = (u.id.original for u in dg.updates if isinstance(u.id, bpy.types.Image))
+        msg = encode.texture_list_delta(*addon.textures.update(imgs))
 
-        if _images_hv != hv:
-            _images_hv = hv
-            if addon.server_up:
-                addon.server.send(encode.texture_list(imgs))
+        if msg and addon.server_up:
+            addon.server.broadcast(msg)
 
 
 @contextmanager
@@ -18,19 +18,42 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import bpy
+import tempfile
 from .messaging import Handlers
+from .metrics import Metrics
+from .trace import Tracer
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from .sync import Server
+    from .sync import Client, Server
     from .settings import SB_Preferences, SB_State
+    from .util import TextureTracker
+    from .profiler import Capture
+
+
+def default_socket_path() -> str:
+    """Socket of this blender instance, so that several of them don't take each other's"""
+    import os
+    return os.path.join(tempfile.gettempdir(), f"pribambase-{os.getpid()}.sock")
 
 
 class Addon:
     def __init__(self):
+        self.metrics = Metrics()
+        self.tracer = Tracer()
+        self.metrics.tracer = self.tracer
         self.handlers = Handlers()
+        self.handlers.metrics = self.metrics
         self._server = None
+        self._textures = None
+        # stage name -> seconds, filled while the addon is loading
+        self.startup = {}
+        # running profiler capture, and the results of the last one
+        self.profile:'Capture' = None
+        self.profile_path = ""
+        self.profile_summary = []
 
 
     @property
@@ -45,16 +68,101 @@ class Addon:
         return bpy.context.scene.sb_state
 
 
-    def start_server(self):
-        """Start server instance"""
+    @property
+    def textures(self) -> 'TextureTracker':
+        """Names of the textures that Aseprite sees"""
+        if self._textures is None:
+            from .util import TextureTracker
+            self._textures = TextureTracker()
+        return self._textures
+
+
+    @property
+    def api(self):
+        """Context-free functions for scripts, see api.py"""
+        from . import api
+        return api
+
+
+    def _create_server(self):
         if self._server:
-            raise RuntimeError(f"A server is already created at {self._server.host}:{self._server.port}")
+            raise RuntimeError(f"A server is already created at {self._server.address}")
 
         host = "localhost" if self.prefs.localhost else "0.0.0.0"
 
-        from .sync import Server
-        self._server = Server(host, addon.prefs.port)
-        self._server.start()
+        from .sync import Server, unix_sockets_supported
+        socket_path = ""
+        if self.prefs.unix_socket and unix_sockets_supported():
+            socket_path = bpy.path.abspath(self.prefs.socket_path) or default_socket_path()
+
+        # Aseprite can only connect over tcp, so without a socket it's on regardless
+        port = self.prefs.port if self.prefs.tcp or not socket_path else None
+        self._server = Server(host, port, socket_path)
+        self._server.tile_size = self.prefs.tile_size
+
+        if self.prefs.localhost and self.prefs.shm:
+            from os import path
+            from .shm import default_dir
+            self._server.shm_dir = path.join(bpy.path.abspath(self.prefs.shm_path) or default_dir(), f"pribambase-{self.prefs.port}")
+            self._server.shm_slots = self.prefs.shm_slots
+
+        if self.prefs.record:
+            import time
+            from os import path
+            from .record import Recorder
+            record_dir = bpy.path.abspath(self.prefs.record_dir) or tempfile.gettempdir()
+            self._server.recorder = Recorder(path.join(record_dir, time.strftime("pribambase-%Y%m%d-%H%M%S.sbrec")))
+
+
+    def start_server(self):
+        """Start server instance"""
+        self._create_server()
+        try:
+            self._server.start()
+        except:
+            self._server = None
+            raise
+
+
+    async def start_server_async(self):
+        """Start server instance from a coroutine, when the loop is already running"""
+        self._create_server()
+        try:
+            await asyncio.wait_for(self._server.start_async(), timeout=5.0)
+        except:
+            self._server = None
+            raise
+
+
+    def start_profile(self, seconds:float):
+        """Profile everything that runs on the main thread for the given time"""
+        import time
+        from os import path
+        from .profiler import Capture
+
+        if self.profile:
+            raise ValueError("A profile is already being captured")
+
+        record_dir = bpy.path.abspath(self.prefs.record_dir) or tempfile.gettempdir()
+        capture = Capture(path.join(record_dir, time.strftime("pribambase-%Y%m%d-%H%M%S.prof")))
+        # python 3.12+ raises ValueError if another profiler is active
+        capture.start()
+        self.profile = capture
+        bpy.app.timers.register(profile_timer, first_interval=seconds, persistent=True)
+
+
+    def stop_profile(self):
+        """Save the capture and sum up the slowest functions"""
+        from .profiler import summary
+
+        if self.profile:
+            stats = self.profile.stop()
+            self.profile_path = self.profile.filepath
+            self.profile_summary = summary(stats, self.prefs.profile_top)
+            self.profile = None
+
+            from . import util
+            util.refresh()
 
 
     def stop_server(self):
@@ -63,6 +171,18 @@ class Addon:
         self._server = None
 
 
+    async def stop_server_async(self):
+        """Stop server instance from a coroutine, when the loop is already running"""
+        server, self._server = self._server, None
+        await server.stop_async()
+
+
+    def startup_report(self) -> str:
+        """Format the startup timings for printing"""
+        lines = [f"  {stage:<24}{sec * 1000:>9.1f} ms" for stage, sec in self.startup.items()]
+        return "\n".join(["Pribambase startup:"] + lines)
+
+
     @property
     def server(self) -> 'Server':
         return self._server
@@ -73,6 +193,12 @@ class Addon:
         return self._server is not None
 
 
+    @property
+    def client(self) -> 'Client':
+        """Client that sent the message being handled, or None when replaying without a server"""
+        return self._server and self._server.client
+
+
     @property
     def connected(self) -> bool:
         return self._server and self._server.connected
@@ -80,10 +206,27 @@ class Addon:
 
 addon = Addon()
 
+
+def profile_timer():
+    """Ends the profiler capture when the time is up"""
+    addon.stop_profile()
+    return None
+
+
 from .messaging import handle
 handlers = addon.handlers
 handlers.add(handle.Batch)
+handlers.add(handle.Hello)
+handlers.add(handle.Sequenced)
+handlers.add(handle.Timestamp)
 handlers.add(handle.Image)
 handlers.add(handle.NewImage)
+handlers.add(handle.SharedImage)
+handlers.add(handle.StreamBegin)
+handlers.add(handle.StreamChunk)
+handlers.add(handle.StreamEnd)
+handlers.add(handle.FormattedImage)
+handlers.add(handle.Tiles)
+handlers.add(handle.Palette)
 handlers.add(handle.TextureList)
 handlers.add(handle.ChangeName)
\ No newline at end of file
@@ -0,0 +1,205 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Functions for scripts, that don't need the context or the UI, so they work in background mode too:
+
+    blender -b scene.blend --python build.py
+
+    # build.py
+    import bpy
+    from glob import glob
+    from pribambase.addon import addon
+
+    api = addon.api
+
+    async def build():
+        images = await api.load_sprites(glob("sprites/*.aseprite"))
+        await api.add_references(glob("refs/*.png"), scale=8)
+        ...
+
+    api.run(build())
+    bpy.ops.wm.save_mainfile()
+
+The coroutines run on the addon's loop. In the UI the loop is already kicked by a timer, and the coroutines can be
+scheduled with asyncio.ensure_future(); a script that runs from start to end, like in background mode, drives it with
+run(). The work that doesn't touch blender data, like decoding and converting pixels, goes to the worker threads in
+parallel, and the images are updated in one go.
+"""
+
+import asyncio
+import bpy
+from os import path
+from typing import Dict, Iterable, List, Tuple
+
+from .addon import addon
+from . import core
+from . import util
+
+
+def run(coro):
+    """Run the coroutine on the addon's loop until it's done, and return its result"""
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+async def start_server():
+    """Start accepting connections from Aseprite, with the addon preferences' settings"""
+    if not addon.server_up:
+        await addon.start_server_async()
+
+
+async def stop_server():
+    """Disconnect the clients and stop the server, after sending the messages that are queued"""
+    if addon.server_up:
+        await flush()
+        await addon.stop_server_async()
+
+
+async def wait_for_client(timeout:float=None):
+    """Wait until Aseprite connects, raises asyncio.TimeoutError if it takes longer than the timeout"""
+    async def connected():
+        while not addon.connected:
+            await asyncio.sleep(0.05)
+
+    await asyncio.wait_for(connected(), timeout)
+
+
+async def flush():
+    """Wait until the messages are sent to the clients"""
+    if addon.server_up:
+        await asyncio.gather(*(client.flush() for client in addon.server.clients))
+
+
+async def load_sprites(filepaths:Iterable[str], frame:int=0) -> List[bpy.types.Image]:
+    """
+    Read .aseprite files without Aseprite, into the textures that sync with them; the ones that don't exist are created.
+    The files are decoded in parallel, raises OSError or ValueError if one can't be read
+    """
+    from . import aseprite
+
+    sources = [bpy.path.abspath(p) for p in filepaths]
+    loop = asyncio.get_event_loop()
+    with addon.metrics.timer("sprite_decode"):
+        frames = await asyncio.gather(*(loop.run_in_executor(None, aseprite.load, p, frame) for p in sources))
+
+    return update_images({p: px for p, px in zip(sources, frames)})
+
+
+def update_images(images:Dict[str, "np.ndarray"]) -> List[bpy.types.Image]:
+    """
+    Replace the pixels of the textures synced with the given names, with (h, w, 4) RGBA bytes going top to bottom.
+    The names are like the ones Aseprite uses: the file path of the sprite, or the name of the image if it has none.
+    Images that don't exist are created, and they're saved in the blendfile
+    """
+    existing = util.image_index()
+    result = []
+
+    with util.batch_updates():
+        for name, pixels in images.items():
+            h, w = pixels.shape[:2]
+            img = existing.get(name)
+            if img is None:
+                img = existing[name] = util.new_packed_image(path.basename(name), w, h)
+                img.sb_source = name
+            util.update_image(w, h, name, pixels.ravel())
+            result.append(img)
+
+        # right away, without waiting for the operator
+        util.apply_updates(defer=False)
+
+    return result
+
+
+async def send_images(images:Iterable[bpy.types.Image]):
+    """
+    Open the images in Aseprite, to edit them there. The ones that are saved to files are opened from the files,
+    others are sent over. Converting the pixels happens in parallel
+    """
+    from .messaging import encode
+    from .ui_3d import image_pixels
+
+    if not addon.connected:
+        raise RuntimeError("Aseprite is not connected")
+
+    send = []
+    for img in images:
+        name = util.image_name(img)
+        if path.exists(name):
+            addon.server.send(encode.sprite_open(name=name), client=addon.server.client_for(name))
+        else:
+            w, h = img.size
+            send.append((img.name, w, h, image_pixels(img)))
+
+    loop = asyncio.get_event_loop()
+    converted = await asyncio.gather(*(loop.run_in_executor(None, core.from_blender_pixels, px, w, h) for _, w, h, px in send))
+
+    for (name, w, h, _), pixels in zip(send, converted):
+        addon.server.send_image(name, (w, h), pixels.tobytes(), client=addon.server.client_for(name))
+
+    await flush()
+
+
+async def uv_map(objects:Iterable[bpy.types.Object], size:Tuple[int, int], color=(0.0, 0.0, 0.0), weight:float=1.0,
+        selected_only:bool=False) -> "np.ndarray":
+    """
+    Draw the UV map of the meshes into (h, w, 4) RGBA bytes going top to bottom, without the GPU and antialiasing, so
+    the result is the same in background mode. Objects without UV map are skipped
+    """
+    from .ui_2d import list_uv
+
+    edges, _ = list_uv([obj for obj in objects if obj.type == 'MESH'], selected_only)
+    w, h = size
+    color = [int(c * 255) for c in color[0:3]] + [255]
+    return await asyncio.get_event_loop().run_in_executor(None, core.draw_lines, edges, w, h, color, weight)
+
+
+async def send_uv_map(objects:Iterable[bpy.types.Object], size:Tuple[int, int], sprite:str="", color=None,
+        weight:float=None, selected_only:bool=False):
+    """Show the UV map of the meshes in the sprite that Aseprite has open, by default with the addon preferences' look"""
+    from .ui_2d import send_uv_map
+
+    if not addon.connected:
+        raise RuntimeError("Aseprite is not connected")
+
+    if color is None:
+        color = addon.prefs.uv_color
+    if weight is None:
+        weight = addon.prefs.uv_weight
+
+    pixels = await uv_map(objects, size, color, weight, selected_only)
+    send_uv_map(pixels, tuple(size), sprite)
+    await flush()
+
+
+async def add_references(filepaths:Iterable[str], scale:int=10, opacity:float=0.33, selectable:bool=True,
+        collection:bpy.types.Collection=None, grid_scale:float=1.0) -> List[bpy.types.Object]:
+    """
+    Add reference images, prescaled so that the pixels line up with the view grid. They're scaled in parallel, and go to
+    the scene collection unless another one is given
+    """
+    from .ui_3d import add_reference, image_pixels
+
+    images = [bpy.data.images.load(bpy.path.abspath(p)) for p in filepaths]
+
+    loop = asyncio.get_event_loop()
+    scaled = await asyncio.gather(*(loop.run_in_executor(None, core.scale_pixels, image_pixels(img), *img.size, scale)
+            for img in images))
+
+    return [add_reference(img, scale, opacity, selectable, collection, grid_scale, px) for img, px in zip(images, scaled)]
@@ -0,0 +1,539 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Reader for Aseprite's .ase/.aseprite files, so that the sprites can be loaded without Aseprite running.
+# Follows https://github.com/aseprite/aseprite/blob/main/docs/ase-file-specs.md and flattens a frame the way
+# aseprite exports it. Needs numpy, so import the module where it's used rather than at the addon's load
+
+import os
+import struct
+import zlib
+from os import path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .core import is_aseprite
+
+
+HEADER = struct.Struct("<IHHHHHIHIIB3xHBBhhHH84x")
+FRAME = struct.Struct("<IHHH2xI")
+CHUNK = struct.Struct("<IH")
+LAYER = struct.Struct("<HHHHHHB3x")
+CEL = struct.Struct("<HhhBHh5x")
+TILESET = struct.Struct("<IIIHHh14x")
+PALETTE = struct.Struct("<III8x")
+
+HEADER_MAGIC = 0xA5E0
+FRAME_MAGIC = 0xF1FA
+
+CHUNK_OLD_PALETTE = 0x0004
+CHUNK_OLD_PALETTE_64 = 0x0011
+CHUNK_LAYER = 0x2004
+CHUNK_CEL = 0x2005
+CHUNK_PALETTE = 0x2019
+CHUNK_TILESET = 0x2023
+
+LAYER_VISIBLE = 1
+LAYER_BACKGROUND = 8
+LAYER_REFERENCE = 64
+
+LAYER_IMAGE = 0
+LAYER_GROUP = 1
+LAYER_TILEMAP = 2
+
+CEL_RAW = 0
+CEL_LINKED = 1
+CEL_COMPRESSED = 2
+CEL_TILEMAP = 3
+
+# bytes per pixel by color depth
+DEPTHS = { 32: 4, 16: 2, 8: 1 }
+
+class Layer:
+    def __init__(self, flags, type, level, blend_mode, opacity, name):
+        self.flags = flags
+        self.type = type
+        self.level = level
+        self.blend_mode = blend_mode
+        self.opacity = opacity
+        self.name = name
+        self.tileset = 0
+        self.parent:Optional[Layer] = None
+
+
+    @property
+    def visible(self) -> bool:
+        """Hidden groups hide everything in them, and reference layers are never exported"""
+        layer = self
+        while layer:
+            if not layer.flags & LAYER_VISIBLE or layer.flags & LAYER_REFERENCE:
+                return False
+            layer = layer.parent
+        return True
+
+
+    @property
+    def total_opacity(self) -> int:
+        opacity = self.opacity
+        layer = self.parent
+        while layer:
+            opacity = opacity * layer.opacity // 255
+            layer = layer.parent
+        return opacity
+
+
+class Cel:
+    def __init__(self, layer, x, y, opacity, z, pixels):
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.z = z
+        # (h, w, channels) for images, (h, w) uint32 tile references for tilemaps
+        self.pixels:np.ndarray = pixels
+        self.tilemap = False
+        self.tile_masks = None
+
+
+class Sprite:
+    """Everything in the file that's needed to flatten its frames"""
+
+    def __init__(self, w, h, depth, transparent_index, flags):
+        self.size = w, h
+        self.depth = depth
+        self.transparent_index = transparent_index
+        self.flags = flags
+        self.layers:List[Layer] = []
+        self.frames:List[List[Cel]] = []
+        self.durations:List[int] = []
+        self.palette = np.zeros((256, 4), dtype=np.ubyte)
+        # id -> (tile w, tile h, (n, th, tw, channels) tiles)
+        self.tilesets:Dict[int, Tuple[int, int, np.ndarray]] = {}
+
+
+    def flatten(self, frame=0) -> np.ndarray:
+        """RGBA bytes of the frame with all visible layers blended, as an (h, w, 4) array going top to bottom"""
+        w, h = self.size
+        canvas = np.zeros((h, w, 4), dtype=np.float32)
+
+        # aseprite orders the cels by layer and z-index, ties go to the lower z-index
+        cels = sorted(self.frames[frame], key=lambda c: (c.layer + c.z, c.z))
+
+        for cel in cels:
+            layer = self.layers[cel.layer]
+            if not layer.visible or layer.type == LAYER_GROUP:
+                continue
+
+            opacity = cel.opacity * layer.total_opacity // 255
+            if not opacity:
+                continue
+
+            src = self._cel_rgba(cel, layer)
+            blend(canvas, src, cel.x, cel.y, opacity / 255.0, layer.blend_mode)
+
+        return np.rint(canvas * 255.0).astype(np.ubyte)
+
+
+    def _cel_rgba(self, cel:Cel, layer:Layer) -> np.ndarray:
+        """Cel's pixels as (h, w, 4) floats"""
+        pixels = cel.pixels
+        if cel.tilemap:
+            pixels = self._tiles_image(cel, layer)
+
+        if self.depth == 32:
+            rgba = pixels
+        elif self.depth == 16:
+            rgba = pixels[:,:,[0, 0, 0, 1]]
+        else:
+            indices = pixels[:,:,0]
+            rgba = self.palette[indices]
+            if not layer.flags & LAYER_BACKGROUND:
+                rgba = rgba.copy()
+                rgba[indices == self.transparent_index, 3] = 0
+
+        return rgba.astype(np.float32) / np.float32(255.0)
+
+
+    def _tiles_image(self, cel:Cel, layer:Layer) -> np.ndarray:
+        """Put together the image of a tilemap cel from its tileset"""
+        tw, th, tiles = self.tilesets[layer.tileset]
+        id_mask, x_flip, y_flip, d_flip = cel.tile_masks
+        refs = cel.pixels
+        rows, cols = refs.shape
+
+        ids = refs & id_mask
+        ids[ids >= len(tiles)] = 0
+        image = tiles[ids].copy() # (rows, cols, th, tw, channels)
+
+        for flag, axis in ((d_flip, None), (x_flip, 3), (y_flip, 2)):
+            if not flag:
+                continue
+            mask = (refs & flag) != 0
+            if not mask.any():
+                continue
+            if axis is None:
+                if tw == th:
+                    image[mask] = image[mask].transpose(0, 2, 1, 3)
+            else:
+                # axes of the selected tiles are one less than in the whole map
+                image[mask] = np.flip(image[mask], axis=axis - 1)
+
+        return image.transpose(0, 2, 1, 3, 4).reshape(rows * th, cols * tw, -1)
+
+
+def blend(canvas, src, x, y, opacity, mode):
+    """Blend the (h, w, 4) floats onto the canvas at x, y, the way aseprite's rgba blenders do"""
+    ch, cw = canvas.shape[:2]
+    sh, sw = src.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + sw, cw), min(y + sh, ch)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    dst = canvas[y0:y1, x0:x1]
+    src = src[y0 - y:y1 - y, x0 - x:x1 - x]
+
+    b, ba = dst[:,:,:3], dst[:,:,3:]
+    s, sa = src[:,:,:3], src[:,:,3:] * np.float32(opacity)
+
+    # the blend mode picks the color, which is laid over the backdrop as normal after that;
+    # where the backdrop is transparent, the color stays as is
+    if mode in BLEND_MODES:
+        s = s + (BLEND_MODES[mode](b, s) - s) * ba
+
+    ra = ba + sa - ba * sa
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rc = np.where(ra > 0, b + (s - b) * (sa / ra), 0)
+
+    dst[:,:,:3] = rc
+    dst[:,:,3:] = ra
+
+
+def _multiply(b, s):
+    return b * s
+
+
+def _screen(b, s):
+    return b + s - b * s
+
+
+def _hard_light(b, s):
+    return np.where(s <= 0.5, _multiply(b, 2 * s), _screen(b, 2 * s - 1))
+
+
+def _overlay(b, s):
+    return _hard_light(s, b)
+
+
+def _color_dodge(b, s):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b <= 0, 0, np.where(s >= 1, 1, np.minimum(1, b / (1 - s))))
+
+
+def _color_burn(b, s):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b >= 1, 1, np.where(s <= 0, 0, 1 - np.minimum(1, (1 - b) / s)))
+
+
+def _soft_light(b, s):
+    d = np.where(b <= 0.25, ((16 * b - 12) * b + 4) * b, np.sqrt(b))
+    return np.where(s <= 0.5, b - (1 - 2 * s) * b * (1 - b), b + (2 * s - 1) * (d - b))
+
+
+def _divide(b, s):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b <= 0, 0, np.where(b >= s, 1, b / s))
+
+
+def _lum(c):
+    return c[:,:,0:1] * 0.3 + c[:,:,1:2] * 0.59 + c[:,:,2:3] * 0.11
+
+
+def _sat(c):
+    return c.max(axis=2, keepdims=True) - c.min(axis=2, keepdims=True)
+
+
+def _set_lum(c, l):
+    c = c + (l - _lum(c))
+    l = _lum(c)
+    n = c.min(axis=2, keepdims=True)
+    x = c.max(axis=2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = np.where(n < 0, l + (c - l) * l / (l - n), c)
+        c = np.where(x > 1, l + (c - l) * (1 - l) / (x - l), c)
+    return c
+
+
+def _set_sat(c, s):
+    n = c.min(axis=2, keepdims=True)
+    x = c.max(axis=2, keepdims=True)
+    # the top channel becomes s, the bottom one 0, and the middle one keeps its place in between
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x > n, (c - n) * s / (x - n), 0)
+
+
+BLEND_MODES = {
+    1: _multiply,
+    2: _screen,
+    3: _overlay,
+    4: np.minimum,
+    5: np.maximum,
+    6: _color_dodge,
+    7: _color_burn,
+    8: _hard_light,
+    9: _soft_light,
+    10: lambda b, s: np.abs(b - s),
+    11: lambda b, s: b + s - 2 * b * s,
+    12: lambda b, s: _set_lum(_set_sat(s, _sat(b)), _lum(b)),
+    13: lambda b, s: _set_lum(_set_sat(b, _sat(s)), _lum(b)),
+    14: lambda b, s: _set_lum(s, _lum(b)),
+    15: lambda b, s: _set_lum(b, _lum(s)),
+    16: lambda b, s: np.minimum(1, b + s),
+    17: lambda b, s: np.maximum(0, b - s),
+    18: _divide,
+}
+
+
+class _Reader:
+    def __init__(self, data:memoryview):
+        self.data = data
+        self.pos = 0
+
+
+    def take(self, fmt:struct.Struct):
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+
+    def take_uint(self, size:int) -> int:
+        value = int.from_bytes(self.data[self.pos:self.pos + size], "little")
+        self.pos += size
+        return value
+
+
+    def take_str(self) -> str:
+        length = self.take_uint(2)
+        s = bytes(self.data[self.pos:self.pos + length]).decode("utf-8", errors="replace")
+        self.pos += length
+        return s
+
+
+    def take_bytes(self, length:int) -> memoryview:
+        data = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return data
+
+
+def read(data:bytes) -> Sprite:
+    """Parse the file's contents"""
+    r = _Reader(memoryview(data))
+
+    if len(data) < HEADER.size:
+        raise ValueError("Not an aseprite file: too short")
+
+    (_, magic, frames, w, h, depth, flags, _, _, _, transparent_index,
+        ncolors, _, _, _, _, _, _) = r.take(HEADER)
+
+    if magic != HEADER_MAGIC:
+        raise ValueError("Not an aseprite file: wrong magic number")
+    if depth not in DEPTHS:
+        raise ValueError(f"Unknown color depth {depth}")
+
+    sprite = Sprite(w, h, depth, transparent_index, flags)
+    bpp = DEPTHS[depth]
+    new_palette = False
+
+    for frame in range(frames):
+        start = r.pos
+        size, magic, old_chunks, duration, chunks = r.take(FRAME)
+        if magic != FRAME_MAGIC:
+            raise ValueError(f"Frame {frame} is broken")
+
+        cels = []
+        sprite.frames.append(cels)
+        sprite.durations.append(duration)
+
+        for _ in range(chunks or old_chunks):
+            chunk_start = r.pos
+            chunk_size, chunk_type = r.take(CHUNK)
+            end = chunk_start + chunk_size
+
+            if chunk_type == CHUNK_LAYER:
+                sprite.layers.append(_read_layer(r, sprite))
+
+            elif chunk_type == CHUNK_CEL:
+                cel = _read_cel(r, sprite, end, bpp)
+                if cel is not None:
+                    cels.append(cel)
+
+            elif chunk_type == CHUNK_PALETTE:
+                _read_palette(r, sprite)
+                new_palette = True
+
+            elif chunk_type in (CHUNK_OLD_PALETTE, CHUNK_OLD_PALETTE_64) and not new_palette:
+                _read_old_palette(r, sprite, chunk_type == CHUNK_OLD_PALETTE_64)
+
+            elif chunk_type == CHUNK_TILESET:
+                _read_tileset(r, sprite, bpp)
+
+            r.pos = end
+
+        r.pos = start + size
+
+    return sprite
+
+
+def _read_layer(r:_Reader, sprite:Sprite) -> Layer:
+    flags, type, level, _, _, blend_mode, opacity = r.take(LAYER)
+    if not sprite.flags & 1:
+        # the opacity field is only valid with that header flag
+        opacity = 255
+    layer = Layer(flags, type, level, blend_mode, opacity, r.take_str())
+    if type == LAYER_TILEMAP:
+        layer.tileset = r.take_uint(4)
+
+    # the parent is the last layer one level up
+    for other in reversed(sprite.layers):
+        if other.level < level:
+            layer.parent = other if other.type == LAYER_GROUP else None
+            break
+
+    return layer
+
+
+def _read_cel(r:_Reader, sprite:Sprite, end:int, bpp:int) -> Optional[Cel]:
+    layer, x, y, opacity, type, z = r.take(CEL)
+
+    if type == CEL_LINKED:
+        linked = r.take_uint(2)
+        for cel in sprite.frames[linked]:
+            if cel.layer == layer:
+                # the position and the image are the same, but the opacity and z-index are not
+                copy = Cel(layer, cel.x, cel.y, opacity, z, cel.pixels)
+                copy.tilemap, copy.tile_masks = cel.tilemap, cel.tile_masks
+                return copy
+        return None
+
+    w, h = r.take_uint(2), r.take_uint(2)
+
+    if type == CEL_RAW:
+        data = r.take_bytes(w * h * bpp)
+        pixels = np.frombuffer(data, dtype=np.ubyte).reshape(h, w, bpp)
+
+    elif type == CEL_COMPRESSED:
+        data = zlib.decompress(r.take_bytes(end - r.pos))
+        pixels = np.frombuffer(data, dtype=np.ubyte, count=w * h * bpp).reshape(h, w, bpp)
+
+    elif type == CEL_TILEMAP:
+        bits = r.take_uint(2)
+        masks = tuple(r.take_uint(4) for _ in range(4))
+        r.pos += 10
+        data = zlib.decompress(r.take_bytes(end - r.pos))
+        dtype = { 8: np.uint8, 16: np.uint16, 32: np.uint32 }[bits]
+        refs = np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder("<"), count=w * h).reshape(h, w).astype(np.uint32)
+        cel = Cel(layer, x, y, opacity, z, refs)
+        cel.tilemap = True
+        cel.tile_masks = masks
+        return cel
+
+    else:
+        return None
+
+    return Cel(layer, x, y, opacity, z, pixels)
+
+
+def _read_palette(r:_Reader, sprite:Sprite):
+    size, first, last = r.take(PALETTE)
+    if size > len(sprite.palette):
+        palette = np.zeros((size, 4), dtype=np.ubyte)
+        palette[:len(sprite.palette)] = sprite.palette
+        sprite.palette = palette
+
+    for i in range(first, last + 1):
+        flags = r.take_uint(2)
+        sprite.palette[i] = tuple(r.take_bytes(4))
+        if flags & 1:
+            r.take_str()
+
+
+def _read_old_palette(r:_Reader, sprite:Sprite, six_bit:bool):
+    i = 0
+    for _ in range(r.take_uint(2)):
+        i += r.take_uint(1)
+        count = r.take_uint(1) or 256
+        rgb = np.frombuffer(r.take_bytes(count * 3), dtype=np.ubyte).reshape(-1, 3)
+        if six_bit:
+            rgb = (rgb.astype(np.uint16) * 255 // 63).astype(np.ubyte)
+        sprite.palette[i:i + count, :3] = rgb[:len(sprite.palette) - i]
+        sprite.palette[i:i + count, 3] = 255
+        i += count
+
+
+def _read_tileset(r:_Reader, sprite:Sprite, bpp:int):
+    id, flags, count, tw, th, _ = r.take(TILESET)
+    r.take_str()
+
+    if flags & 1:
+        # the tiles are in another file, which isn't supported
+        r.pos += 8
+
+    if flags & 2:
+        length = r.take_uint(4)
+        data = zlib.decompress(r.take_bytes(length))
+        tiles = np.frombuffer(data, dtype=np.ubyte, count=count * th * tw * bpp).reshape(count, th, tw, bpp)
+    else:
+        tiles = np.zeros((max(count, 1), th, tw, bpp), dtype=np.ubyte)
+
+    sprite.tilesets[id] = tw, th, tiles
+
+
+# path -> (mtime, size, frame, pixels) of the last loaded frame
+_cache = {}
+
+
+def load(filepath:str, frame:int=0) -> np.ndarray:
+    """Flattened RGBA frame of the file, (h, w, 4) going top to bottom; decoded again only if the file changes"""
+    filepath = path.normpath(filepath)
+    st = os.stat(filepath)
+
+    cached = _cache.get(filepath)
+    if cached and cached[:3] == (st.st_mtime_ns, st.st_size, frame):
+        return cached[3]
+
+    with open(filepath, "rb") as f:
+        sprite = read(f.read())
+
+    if not 0 <= frame < len(sprite.frames):
+        raise ValueError(f"{path.basename(filepath)} has no frame {frame + 1}")
+
+    pixels = sprite.flatten(frame)
+    # it's shared by everyone who loads the file
+    pixels.flags.writeable = False
+    _cache[filepath] = st.st_mtime_ns, st.st_size, frame, pixels
+    return pixels
+
+
+def forget(filepath:str=None):
+    """Drop the cached frame of the file, or all of them"""
+    if filepath is None:
+        _cache.clear()
+    else:
+        _cache.pop(path.normpath(filepath), None)
@@ -29,6 +29,8 @@ log = logging.getLogger(__name__)
 
 # Keeps track of whether a loop-kicking operator is already running.
 _stop_after_this_kick = False
+# the loop's default executor, also used by code that has to wait for the workers without the loop
+_executor = None
 
 
 def setup_asyncio_executor():
@@ -46,11 +48,20 @@ def setup_asyncio_executor():
     else:
         loop = asyncio.get_event_loop()
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-    loop.set_default_executor(executor)
+    global _executor
+    _executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    loop.set_default_executor(_executor)
     # loop.set_debug(True)
 
 
+def executor() -> concurrent.futures.ThreadPoolExecutor:
+    """The worker pool, for running things in parallel from the main thread"""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    return _executor
+
+
 @persistent
 def kick_async_loop() -> bool:
     """Performs a single iteration of the asyncio event loop.
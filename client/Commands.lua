@@ -25,7 +25,9 @@ pribambase_default_settings = {
     port="34613",
     autostart=false,
     autoshow=false,
-    maxsize="65535"
+    maxsize="65535",
+    sharedmem=true,
+    tiles=true
 }
 
 
@@ -52,6 +52,8 @@ dlg:separator{text="Connection"}
     :check{id="autostart", label="Connect when Aseprite launches", selected=pribambase_settings.autostart, onclick=changeAutoshow}
     :check{id="autoshow", label="Show when Aseprite launches", selected=pribambase_settings.autoshow, visible=dlg.data.autostart}
     :number{id="maxsize", label="Size Limit", decimals=0, text=tostring(pribambase_settings.maxsize)}
+    :check{id="sharedmem", label="Use shared memory for local connections", selected=pribambase_settings.sharedmem}
+    :check{id="tiles", label="Only send the changed parts of the image", selected=pribambase_settings.tiles}
 
     :separator()
     :button{text="Defaults", onclick=restoreDefaults}
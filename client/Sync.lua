@@ -44,6 +44,44 @@ else
     local frame = -1
     -- used to pause the app from processing updates
     local pause_app_change = false
+    -- shared memory slots offered by blender, nil when sending through the socket
+    local shm = nil
+    -- images that blender sends in chunks, by stream id
+    local streams = {}
+    -- id of the last stream that was sent
+    local streamId = 0
+    -- images bigger than that are sent in chunks of about that size
+    local STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+    -- largest message that blender takes, new textures aren't streamed so they have to fit; nil if it didn't say
+    local maxMessage = nil
+    -- size of the tiles agreed with blender, nil when sending whole frames
+    local tileSize = nil
+    -- tiles of the frame that was sent last, by name
+    local lastTiles = {}
+
+    -- change events are coalesced into one send per interval, which adapts to how fast blender acknowledges the frames
+    local TICK = 1 / 60
+    local MIN_INTERVAL = 1 / 60
+    local MAX_INTERVAL = 0.5
+    -- frames of one image that can be sent before blender acknowledges them
+    local CREDITS = 2
+    -- some frames are dropped without an ack, they stop taking up credit after that many seconds
+    local ACK_TIMEOUT = 2
+    -- seconds counted by the timer, os.clock() is cpu time and does not work for that
+    local clock = 0
+    local interval = MIN_INTERVAL
+    local lastSend = -math.huge
+    -- the sprite changed since the last send
+    local dirty = false
+    -- number of the last frame sent
+    local frameSeq = 0
+    -- send times of the frames that blender didn't acknowledge yet, by image name and then by frame number
+    local inFlight = {}
+    -- blender sends acknowledgements
+    local acks = false
+    -- the sprite is being changed by strokes painted in blender, which don't need to go back
+    local applyingPaint = false
+    local timer = nil
 
 
     -- Set up an image buffer for two reasons:
@@ -51,6 +89,10 @@ else
     -- b) the sprite might not be in RGBA mode, and it's easier to use ase
     --    than do conversions on the other side.
     local buf = Image(1, 1, ColorMode.RGB)
+    -- indexed and grayscale sprites are sent in their own color mode, which takes less bytes; by color mode
+    local modeBuffers = {}
+    -- palette and pixels sent last for indexed sprites, by name, to tell palette-only changes apart
+    local lastIndexed = {}
 
 
     --[[
@@ -58,19 +100,142 @@ else
         May have multiple returns, WebSocket:send() concatenates its arguments
     ]]
 
-    local function messageImage(opts)
-        local sprite = opts.sprite
-        local name = opts.name or ""
-        local id = string.byte(opts.new and 'N' or 'I')
-
+    local function drawBuffer(sprite, frame)
         if buf.width ~= sprite.width or buf.height ~= sprite.height then
             buf:resize(sprite.width, sprite.height)
         end
 
         buf:clear()
-        buf:drawSprite(sprite, opts.frame)
+        buf:drawSprite(sprite, frame)
+    end
+
+
+    local function drawModeBuffer(sprite, frame)
+        local img = modeBuffers[sprite.colorMode]
+
+        if img == nil or img.width ~= sprite.width or img.height ~= sprite.height then
+            img = Image(sprite.width, sprite.height, sprite.colorMode)
+            modeBuffers[sprite.colorMode] = img
+        end
+
+        if sprite.colorMode == ColorMode.INDEXED then
+            img:clear(sprite.transparentColor)
+        else
+            img:clear()
+        end
+        img:drawSprite(sprite, frame)
+
+        return img
+    end
+
+
+    -- RGBA bytes of the palette colors
+    local function paletteBytes(sprite)
+        local pal = sprite.palettes[1]
+        -- with a background layer, the transparent index is a normal color
+        local transparent = sprite.backgroundLayer == nil
+        local colors = {}
+
+        for i=0,#pal-1 do
+            local c = pal:getColor(i)
+            local alpha = (transparent and i == sprite.transparentColor) and 0 or c.alpha
+            colors[#colors + 1] = string.pack("BBBB", c.red, c.green, c.blue, alpha)
+        end
 
-        return string.pack("<BHHs4I4", id, buf.width, buf.height, name, buf.rowStride * buf.height), buf.bytes
+        return table.concat(colors)
+    end
+
+
+    -- fields that all kinds of image messages start with
+    local function packImageHeader(id, name)
+        return string.pack("<BHHs4", string.byte(id), buf.width, buf.height, name)
+    end
+
+
+    local function messageImage(opts)
+        drawBuffer(opts.sprite, opts.frame)
+
+        local header = packImageHeader(opts.new and 'N' or 'I', opts.name or "")
+        return header, string.pack("<I4", buf.rowStride * buf.height), buf.bytes
+    end
+
+
+    -- writes the pixels into the next shared memory slot, and only the notification goes to the socket
+    local function messageSharedImage(opts)
+        drawBuffer(opts.sprite, opts.frame)
+
+        local slot = shm.next
+        local f = shm.files[slot + 1]
+        local len = buf.rowStride * buf.height
+        shm.next = (slot + 1) % #shm.files
+        shm.seq = shm.seq % 0xffffffff + 1
+
+        -- zero seq marks the slot as being written, in case blender is still reading it
+        f:seek("set", 0)
+        f:write(string.pack("<I4I4", 0, 0))
+        f:flush()
+        f:write(buf.bytes)
+        f:seek("set", 0)
+        f:write(string.pack("<I4I4", shm.seq, len))
+        f:flush()
+
+        return packImageHeader('Z', opts.name or ""), string.pack("<BI4I4", slot, shm.seq, len)
+    end
+
+
+    -- large images are split so that blender can start converting the pixels before the whole image arrives
+    local function messageImageStream(opts)
+        drawBuffer(opts.sprite, opts.frame)
+
+        streamId = streamId % 0xffffffff + 1
+
+        local stride = buf.rowStride
+        local rows = math.max(1, STREAM_CHUNK_SIZE // stride)
+        local bytes = buf.bytes
+        local messages = { table.concat{ packImageHeader('B', opts.name or ""), string.pack("<I4", streamId) } }
+
+        for y=0,buf.height-1,rows do
+            local count = math.min(rows, buf.height - y)
+            local chunk = string.sub(bytes, y * stride + 1, (y + count) * stride)
+            messages[#messages + 1] = string.pack("<BI4Hs4", string.byte('K'), streamId, y, chunk)
+        end
+
+        messages[#messages + 1] = string.pack("<BI4", string.byte('E'), streamId)
+
+        return messages
+    end
+
+
+    -- cuts RGBA bytes into square tiles, row by row; the ones at the right and bottom edges may be smaller
+    local function splitTiles(bytes, w, h, size)
+        local stride = w * 4
+        local tiles = {}
+
+        for ty=0,h-1,size do
+            local th = math.min(size, h - ty)
+            for tx=0,w-1,size do
+                local tw = math.min(size, w - tx)
+                local rows = {}
+                for y=ty,ty+th-1 do
+                    local start = y * stride + tx * 4 + 1
+                    rows[#rows + 1] = string.sub(bytes, start, start + tw * 4 - 1)
+                end
+                tiles[#tiles + 1] = table.concat(rows)
+            end
+        end
+
+        return tiles
+    end
+
+
+    local function messageHello(options)
+        local parts = { string.pack("<B", string.byte('H')) }
+
+        for key,value in pairs(options) do
+            parts[#parts + 1] = string.pack("<s4s4", key, value)
+        end
+
+        return table.concat(parts)
     end
 
 
@@ -92,13 +257,180 @@ else
 
     --[[ Messaging logic ]]
 
+    -- sends the parts of one image message, numbered so that blender can acknowledge it when it's applied
+    local function sendFrame(name, ...)
+        if not acks then
+            ws:sendBinary(...)
+            return
+        end
+
+        frameSeq = frameSeq % 0xffffffff + 1
+
+        -- the header goes in front of the message without copying it
+        local len = 0
+        for _,part in ipairs{...} do
+            len = len + #part
+        end
+        ws:sendBinary(string.pack("<BI4I4", string.byte('Q'), frameSeq, len), ...)
+
+        inFlight[name] = inFlight[name] or {}
+        inFlight[name][frameSeq] = clock
+    end
+
+
+    local function credits(name)
+        local used = 0
+        for _ in pairs(inFlight[name] or {}) do
+            used = used + 1
+        end
+        return CREDITS - used
+    end
+
+
+    -- the parts go as they are, the image is applied when the stream ends
+    local function sendImageStream(name)
+        local messages = messageImageStream{ sprite=spr, name=name, frame=app.activeFrame }
+        for i=1,#messages-1 do
+            ws:sendBinary(messages[i])
+        end
+        sendFrame(name, messages[#messages])
+    end
+
+
+    -- indexed images are sent as one byte per pixel with a separate palette, grayscale as two bytes
+    local function sendFormattedImage(name)
+        local img = drawModeBuffer(spr, app.activeFrame)
+        local bytes = img.bytes
+
+        if #bytes > STREAM_CHUNK_SIZE then
+            -- too big for one message, the stream takes RGBA
+            lastIndexed[name] = nil
+            sendImageStream(name)
+            return
+        end
+
+        if spr.colorMode == ColorMode.GRAY then
+            sendFrame(name, string.pack("<BHHs4Bs4", string.byte('X'), img.width, img.height, name, 2, bytes))
+            return
+        end
+
+        local palette = paletteBytes(spr)
+        local last = lastIndexed[name]
+        local image = string.pack("<BHHs4Bs4", string.byte('X'), img.width, img.height, name, 1, bytes)
+        local paletteMessage = string.pack("<Bs4s4", string.byte('P'), name, palette)
+
+        if last and last.bytes == bytes and last.palette == palette then
+            -- nothing changed that blender would see
+        elseif last and last.bytes == bytes then
+            sendFrame(name, paletteMessage)
+        elseif last and last.palette == palette then
+            sendFrame(name, image)
+        else
+            sendFrame(name, messageBatch(2, paletteMessage, image))
+        end
+
+        lastIndexed[name] = { bytes=bytes, palette=palette }
+    end
+
+
+    -- only sends the tiles that changed since the last frame, which can be a lot less for big sprites
+    local function sendTiledImage(name)
+        drawBuffer(spr, app.activeFrame)
+
+        local tiles = splitTiles(buf.bytes, buf.width, buf.height, tileSize)
+        local last = lastTiles[name]
+        lastTiles[name] = { width=buf.width, height=buf.height, tiles=tiles }
+
+        if last == nil or last.width ~= buf.width or last.height ~= buf.height then
+            -- blender needs a whole frame to put the tiles into
+            if shm then
+                sendFrame(name, messageSharedImage{ sprite=spr, name=name, frame=app.activeFrame })
+            elseif #buf.bytes > STREAM_CHUNK_SIZE then
+                sendImageStream(name)
+            else
+                sendFrame(name, messageImage{ sprite=spr, name=name, frame=app.activeFrame })
+            end
+            return
+        end
+
+        -- comparing the strings does the same job as comparing tile hashes, without computing any
+        local cols = (buf.width + tileSize - 1) // tileSize
+        local parts = {}
+
+        for i,tile in ipairs(tiles) do
+            if tile ~= last.tiles[i] then
+                parts[#parts + 1] = string.pack("<HHs4", ((i - 1) % cols) * tileSize, ((i - 1) // cols) * tileSize, tile)
+            end
+        end
+
+        local size = 0
+        for _,part in ipairs(parts) do
+            size = size + #part
+        end
+
+        if size > STREAM_CHUNK_SIZE then
+            -- most of the image changed, the tiles don't save anything
+            sendImageStream(name)
+        elseif #parts > 0 then
+            sendFrame(name, packImageHeader('T', name), string.pack("<HI4", tileSize, #parts), table.concat(parts))
+        end
+    end
+
+
     local function sendImage(name, new)
         if connected and spr ~= nil and math.max(spr.width, spr.height) <= tonumber(pribambase_settings.maxsize) then
-            ws:sendBinary(messageImage{ sprite=spr, name=name, frame=app.activeFrame, new = new })
+            if not new and spr.colorMode ~= ColorMode.RGB then
+                sendFormattedImage(name)
+            elseif not new and tileSize then
+                sendTiledImage(name)
+            elseif shm and not new then
+                sendFrame(name, messageSharedImage{ sprite=spr, name=name, frame=app.activeFrame })
+            elseif not new and spr.width * spr.height * 4 > STREAM_CHUNK_SIZE then
+                sendImageStream(name)
+            elseif new and maxMessage and spr.width * spr.height * 4 > maxMessage then
+                app.alert{ title="Sync", text="The sprite is too big to create a texture from it. Create the texture in Blender, and open it here" }
+            else
+                sendFrame(name, messageImage{ sprite=spr, name=name, frame=app.activeFrame, new = new })
+            end
         end
     end
 
 
+    local function closeShm()
+        if shm then
+            for _,f in ipairs(shm.files) do
+                f:close()
+            end
+            shm = nil
+        end
+    end
+
+
+    -- returns true if all slot files could be opened
+    local function openShm(dir, slots)
+        closeShm()
+
+        if io == nil then
+            return false
+        end
+
+        local files = {}
+        for i=0,slots-1 do
+            local ok, f = pcall(io.open, app.fs.joinPath(dir, "slot" .. i .. ".bin"), "r+b")
+            if not ok or f == nil then
+                for _,opened in ipairs(files) do
+                    opened:close()
+                end
+                return false
+            end
+            files[#files + 1] = f
+        end
+
+        shm = { files=files, next=0, seq=0 }
+        return true
+    end
+
+
     -- creates a reference layer that is scaled to fill the sprite
     -- it generates several undos - consider wrapping with `app.transaction`
     local function show_uv(w, h, opacity, name, data)
@@ -206,6 +538,49 @@ else
     end
 
 
+    local function canSend()
+        -- when out of credit, the changes pile up and go in one frame later
+        return clock - lastSend >= interval and (spr == nil or credits(spr.filename) > 0)
+    end
+
+
+    local function flushSync()
+        dirty = false
+        lastSend = clock
+        syncSprite()
+    end
+
+
+    local function onSpriteChange()
+        if applyingPaint then return end
+        dirty = true
+        if timer == nil or canSend() then
+            flushSync()
+        end
+    end
+
+
+    local function onTick()
+        clock = clock + TICK
+
+        for name,frames in pairs(inFlight) do
+            for seq,sent in pairs(frames) do
+                if clock - sent > ACK_TIMEOUT then
+                    frames[seq] = nil
+                end
+            end
+            if next(frames) == nil then
+                inFlight[name] = nil
+            end
+        end
+
+        -- trailing send after the edits stop
+        if dirty and connected and canSend() then
+            flushSync()
+        end
+    end
+
+
     -- close connection and ui if the sprite is closed
     local function onAppChange()
         if pause_app_change then return end
@@ -215,7 +590,7 @@ else
         if app.activeSprite ~= spr then
             -- stop watching the hidden sprite
             if spr then
-                spr.events:off(syncSprite)
+                spr.events:off(onSpriteChange)
             end
 
             -- start watching the active sprite
@@ -224,7 +599,7 @@ else
                 spr = app.activeSprite
                 sprfile = app.activeSprite.filename
                 frame = app.activeFrame.frameNumber
-                spr.events:on("change", syncSprite)
+                spr.events:on("change", onSpriteChange)
                 syncSprite()
             end
 
@@ -241,10 +616,12 @@ else
 
     -- clean up and exit
     local function cleanup()
+        closeShm()
         if ws ~= nil then ws:close() end
         if dlg ~= nil then dlg:close() dlg = nil end
         pribambase_dlg = nil
-        if spr~=nil then spr.events:off(syncSprite) end
+        if timer ~= nil then timer:stop() end
+        if spr~=nil then spr.events:off(onSpriteChange) end
         app.events:off(onAppChange)
     end
 
@@ -256,9 +633,70 @@ else
 
     --[[ Message handlers  ]]
 
-    local function handleImage(msg)
-        local _id, w, h, name, pixels = string.unpack("<BHHs4s4", msg)
+    local function handleHello(msg)
+        local options = {}
+        local offset = 2
+
+        while offset < #msg do
+            local key, value
+            key, value, offset = string.unpack("<s4s4", msg, offset)
+            options[key] = value
+        end
+
+        -- reply with the features that are going to be used
+        local reply = {}
+
+        if options.shm and settings.sharedmem and openShm(options.shm, tonumber(options.shm_slots)) then
+            reply.shm = "1"
+        else
+            closeShm()
+        end
+
+        maxMessage = tonumber(options.max_message)
+
+        acks = options.ack ~= nil and timer ~= nil
+        if acks then
+            reply.ack = "1"
+        end
+
+        lastTiles = {}
+        if options.tile and settings.tiles then
+            tileSize = tonumber(options.tile)
+            reply.tile = options.tile
+            -- blender asks for a whole frame when it has nothing to put the tiles into
+            reply.resend = "1"
+        else
+            tileSize = nil
+        end
+
+        if options.rects then
+            reply.rects = "1"
+        end
+
+        ws:sendBinary(messageHello(reply))
+    end
+
+
+    local function handleResend(msg)
+        local _id, name = string.unpack("<Bs4", msg)
+        -- the next frame goes whole
+        lastTiles[name] = nil
+        dirty = true
+    end
+
+
+    local function handleAck(msg)
+        local name, seq = string.unpack("<s4I4", msg, 2)
+        local sent = inFlight[name] and inFlight[name][seq]
+        if sent then
+            inFlight[name][seq] = nil
+            -- smoothed round trip time
+            interval = math.min(MAX_INTERVAL, math.max(MIN_INTERVAL, interval * 0.75 + (clock - sent) * 0.25))
+        end
+    end
 
+
+    local function openImage(w, h, name, pixels)
         local sprite = Sprite(w, h, ColorMode.RGB)
         if #name > 0 then
             sprite.filename = name
@@ -269,6 +707,37 @@ else
     end
 
 
+    local function handleImage(msg)
+        local _id, w, h, name, pixels = string.unpack("<BHHs4s4", msg)
+        openImage(w, h, name, pixels)
+    end
+
+
+    local function handleStreamBegin(msg)
+        local _id, w, h, name, stream = string.unpack("<BHHs4I4", msg)
+        streams[stream] = { w=w, h=h, name=name, chunks={} }
+    end
+
+
+    local function handleStreamChunk(msg)
+        local _id, stream, _row, chunk = string.unpack("<BI4Hs4", msg)
+        local s = streams[stream]
+        if s then
+            s.chunks[#s.chunks + 1] = chunk
+        end
+    end
+
+
+    local function handleStreamEnd(msg)
+        local _id, stream = string.unpack("<BI4", msg)
+        local s = streams[stream]
+        streams[stream] = nil
+        if s then
+            openImage(s.w, s.h, s.name, table.concat(s.chunks))
+        end
+    end
+
+
     local function handleUVMap(msg)
         local _id, opacity, w, h, layer, sprite, pixels = string.unpack("<BBHHs4s4s4", msg)
 
@@ -296,19 +765,108 @@ else
     end
 
 
-    local function handleTextureList(msg)
-        local _id = string.unpack("<BH", msg)
+    -- iterate over the names in texture list messages
+    local function textureNames(msg)
         local offset = 2
         local ml = #msg
+
+        return function()
+            if offset < ml then
+                local name, next = string.unpack("<s4", msg, offset)
+                offset = next
+                return name
+            end
+        end
+    end
+
+
+    -- strokes painted in blender, only the rectangles that changed
+    local function handleImageRects(msg)
+        local name, w, h, count, offset = string.unpack("<s4HHH", msg, 2)
+
+        local target = nil
+        for _,s in ipairs(app.sprites) do
+            if s.filename == name then
+                target = s
+                break
+            end
+        end
+
+        -- the other color modes would need the colors matched to the palette
+        if target == nil or target.colorMode ~= ColorMode.RGB or target.width ~= w or target.height ~= h then
+            return
+        end
+
+        -- the pixels go into the cel that's being edited, or the top one if the sprite is in the background
+        local layer = target.layers[#target.layers]
+        local frameNumber = 1
+        if target == app.activeSprite then
+            layer = app.activeLayer or layer
+            frameNumber = app.activeFrame.frameNumber
+        end
+
+        if layer.isGroup or layer.isEditable == false then
+            return
+        end
+
+        local cel = layer:cel(frameNumber)
+        local image = Image(w, h, ColorMode.RGB)
+        if cel then
+            image:drawImage(cel.image, cel.position)
+        end
+
+        for _=1,count do
+            local x, y, rw, rh, data
+            x, y, rw, rh, data, offset = string.unpack("<HHHHs4", msg, offset)
+            local patch = Image(rw, rh, ColorMode.RGB)
+            patch.bytes = data
+
+            -- copied as is, blending would keep the old pixels under the transparent ones
+            if BlendMode ~= nil and BlendMode.SRC ~= nil then
+                image:drawImage(patch, Point(x, y), 255, BlendMode.SRC)
+            else
+                for py=0,rh-1 do
+                    for px=0,rw-1 do
+                        image:drawPixel(x + px, y + py, patch:getPixel(px, py))
+                    end
+                end
+            end
+        end
+
+        applyingPaint = true
+        app.transaction(function()
+            if cel then
+                cel.image = image
+                cel.position = Point(0, 0)
+            else
+                target:newCel(layer, frameNumber, image, Point(0, 0))
+            end
+        end)
+        applyingPaint = false
+        app.refresh()
+    end
+
+
+    local function handleTextureList(msg)
         local synced = spr and syncList[spr.filename]
 
         syncList = {}
 
-        while offset < ml do
-            local len = string.unpack("<I4", msg, offset)
-            local name = string.unpack("<s4", msg, offset)
+        for name in textureNames(msg) do
+            syncList[name] = true
+        end
+
+        if not synced then
+            syncSprite()
+        end
+    end
+
+
+    local function handleTextureAdd(msg)
+        local synced = spr and syncList[spr.filename]
+
+        for name in textureNames(msg) do
             syncList[name] = true
-            offset = offset + 4 + len
         end
 
         if not synced then
@@ -317,6 +875,26 @@ else
     end
 
 
+    local function handleTextureRemove(msg)
+        for name in textureNames(msg) do
+            syncList[name] = nil
+        end
+    end
+
+
+    local function handleTextureRename(msg)
+        local _id, from, to = string.unpack("<Bs4s4", msg)
+        local synced = spr and syncList[spr.filename]
+
+        syncList[from] = nil
+        syncList[to] = true
+
+        if not synced then
+            syncSprite()
+        end
+    end
+
+
     local function handleNewSprite(msg)
         -- creating sprite triggers the app change handler several times
         -- let's pause it and call later manually
@@ -392,13 +970,23 @@ else
 
 
     handlers = {
+        [string.byte('H')] = handleHello,
         [string.byte('I')] = handleImage,
+        [string.byte('B')] = handleStreamBegin,
+        [string.byte('K')] = handleStreamChunk,
+        [string.byte('E')] = handleStreamEnd,
         [string.byte('[')] = handleBatch,
         [string.byte('M')] = handleUVMap,
         [string.byte('L')] = handleTextureList,
+        [string.byte('A')] = handleTextureAdd,
+        [string.byte('D')] = handleTextureRemove,
+        [string.byte('R')] = handleTextureRename,
         [string.byte('S')] = handleNewSprite,
         [string.byte('O')] = handleOpenSprite,
         [string.byte('F')] = handleFocus,
+        [string.byte('Y')] = handleAck,
+        [string.byte('W')] = handleResend,
+        [string.byte('U')] = handleImageRects,
     }
 
 
@@ -415,15 +1003,31 @@ else
             connected = true
             dlg:modify{ id="status", text="Sync ON" }
 
+            if timer ~= nil then
+                timer:start()
+            end
+
             if spr ~= nil then
-                spr.events:on("change", syncSprite)
+                spr.events:on("change", onSpriteChange)
             end
 
         elseif t == WebSocketMessageType.CLOSE and dlg ~= nil then
             connected = false
+            closeShm()
+            streams = {}
+            lastIndexed = {}
+            tileSize = nil
+            lastTiles = {}
+            acks = false
+            inFlight = {}
+            interval = MIN_INTERVAL
+            dirty = false
+            if timer ~= nil then
+                timer:stop()
+            end
             dlg:modify{ id="status", text="Reconnecting..." }
             if spr ~= nil then
-                spr.events:off(syncSprite)
+                spr.events:off(onSpriteChange)
             end
         end
 
@@ -438,6 +1042,11 @@ else
         deflate=false
     }
 
+    -- Timer only exists in newer versions, older ones send on every change
+    if Timer ~= nil then
+        timer = Timer{ interval=TICK, ontick=onTick }
+    end
+
     --[[ global ]] pribambase_dlg = dlg
     app.events:on("sitechange", onAppChange)
 
@@ -455,7 +1064,7 @@ else
     menu:separator{ text="Actions" }
     -- disabled since it gets a bit upredictable in some cases -- TODO enable after temp images get blendfile reference
     -- menu:button{ id="texture", text="Create Texture", onclick=function() createTexture() menu:close() end }
-    menu:button{ id="update", text="Force Refresh", onclick=function() syncSprite() menu:close() end }
+    menu:button{ id="update", text="Force Refresh", onclick=function() lastIndexed = {} lastTiles = {} syncSprite() menu:close() end }
     menu:button{ id="reconnect", text="Reconnect", onclick=function() menu:close() ws:close() ws:connect() end }
     menu:separator()
     menu:button{ id="settings", text="* Settings", onclick=function() menu:close() app.command.SbSyncSettings() end }
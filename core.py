@@ -0,0 +1,288 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# The hot paths of the sync that don't need blender: pixel conversion, change detection, UV edges and prescaling.
+# The modules that use bpy are thin adapters around these, and tools/bench.py measures them outside of blender
+
+from typing import List, Tuple
+
+
+# pixel formats of image messages, same order as the color modes in ui_2d.COLOR_MODES
+RGBA = 0
+INDEXED = 1 # one byte palette index per pixel
+GRAY = 2 # value and alpha bytes per pixel
+
+# sprite files that aseprite.py can read
+ASEPRITE_EXTENSIONS = (".ase", ".aseprite")
+
+
+def is_aseprite(filepath:str) -> bool:
+    """Checked without importing aseprite.py, it loads numpy"""
+    return filepath.lower().endswith(ASEPRITE_EXTENSIONS)
+
+
+def to_blender_pixels(pixels, h):
+    """Convert RGBA bytes with rows going top to bottom, into the floats that blender images take"""
+    import numpy as np
+
+    pixels = np.float32(pixels) / 255.0
+    # flip y axis ass backwards
+    pixels.shape = (h, pixels.size // h)
+    return pixels[::-1,:].ravel()
+
+
+def from_blender_pixels(pixels, w, h, out=None):
+    """Blender's floats back into RGBA bytes going top to bottom, as an (h, w, 4) array"""
+    import numpy as np
+
+    if out is None:
+        out = np.empty((h, w, 4), dtype=np.ubyte)
+    src = pixels.reshape(h, w, 4)[::-1]
+
+    # in bands that fit the cache, a 4k image would need a few hundred MB of temporaries otherwise
+    band = max(1, 65536 // w)
+    tmp = np.empty((band, w, 4), dtype=np.float32)
+    for y in range(0, h, band):
+        rows = src[y:y + band]
+        t = tmp[:len(rows)]
+        np.multiply(rows, np.float32(255.0), out=t)
+        t += np.float32(0.5)
+        np.clip(t, 0, 255, out=t)
+        out[y:y + band] = t
+    return out
+
+
+def palette_lut(colors):
+    """Make a lookup table for indexed_to_blender_pixels() from palette's RGBA bytes"""
+    import numpy as np
+
+    colors = np.frombuffer(colors, dtype=np.ubyte).reshape(-1, 4)[:256]
+    lut = np.zeros((256, 4), dtype=np.float32)
+    lut[:len(colors)] = colors / np.float32(255.0)
+    return lut
+
+
+def indexed_to_blender_pixels(indices, w, h, lut):
+    """Look up palette colors of the indices, straight into blender's float pixels"""
+    import numpy as np
+
+    out = np.empty((h, w, 4), dtype=np.float32)
+    np.take(lut, indices.reshape(h, w)[::-1], axis=0, out=out, mode='clip')
+    return out.ravel()
+
+
+def gray_to_blender_pixels(pixels, w, h):
+    """Expand value-alpha pairs into blender's float pixels"""
+    import numpy as np
+
+    src = pixels.reshape(h, w, 2)[::-1]
+    out = np.empty((h, w, 4), dtype=np.float32)
+    np.multiply(src[:,:,0:1], np.float32(1.0 / 255.0), out=out[:,:,0:3])
+    np.multiply(src[:,:,1], np.float32(1.0 / 255.0), out=out[:,:,3])
+    return out.ravel()
+
+
+def row_digests(pixels, h) -> List[int]:
+    """Checksums of each row, in whatever order the rows are"""
+    import zlib
+    return [zlib.crc32(row) for row in pixels.reshape(h, -1)]
+
+
+def encode_png(pixels, w, h, level=6) -> bytes:
+    """
+    PNG file of RGBA bytes (top to bottom) or blender's floats (bottom to top). zlib lets go of the GIL,
+    so several images can be encoded in threads at once
+    """
+    import numpy as np
+    import struct
+    import zlib
+
+    if pixels.dtype == np.float32:
+        rows = np.rint(pixels.reshape(h, w * 4)[::-1] * 255.0).astype(np.ubyte)
+    else:
+        rows = pixels.reshape(h, w * 4)
+
+    # "up" filter, the difference with the row above; flat pixelart compresses to almost nothing that way
+    raw = np.empty((h, w * 4 + 1), dtype=np.ubyte)
+    raw[:, 0] = 2
+    raw[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+        chunk(b"IEND", b"")))
+
+
+_tile_weights = {}
+
+
+def tile_digests(pixels, tile):
+    """
+    Checksum of each tile x tile square of (h, w, 4) bytes, as a (rows, columns) array. The sides must be multiples of
+    the tile, which must be even. It's a weighted sum of the 8-byte words with odd weights, that wraps around,
+    so any change within one word always changes it
+    """
+    import numpy as np
+
+    h, w = pixels.shape[:2]
+    n = tile // 2 # words in a row of a tile
+    weights = _tile_weights.get(tile)
+    if weights is None:
+        rng = np.random.default_rng(tile)
+        weights = _tile_weights[tile] = (rng.integers(0, 2**63, (tile, 1, n), dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+
+    words = np.ascontiguousarray(pixels).reshape(h, w * 4).view(np.uint64)
+    rows, cols = h // tile, w // tile
+    out = np.empty((rows, cols), dtype=np.uint64)
+    # a band at a time, so the temporaries stay small
+    for y in range(rows):
+        band = words[y * tile:(y + 1) * tile].reshape(tile, cols, n)
+        np.sum(band * weights, axis=(0, 2), out=out[y])
+    return out
+
+
+def dirty_rects(changed, tile, w, h) -> List[Tuple[int, int, int, int]]:
+    """Merge the changed tiles from a (rows, columns) mask into fewer (x, y, w, h) rectangles within the image"""
+    import numpy as np
+
+    rects = []
+    runs = {} # (first, past the last column) -> first row, of the runs that continue into the current row
+
+    def close(run, top, bottom):
+        x, y = run[0] * tile, top * tile
+        rects.append((x, y, min(run[1] * tile, w) - x, min(bottom * tile, h) - y))
+
+    for row, mask in enumerate(changed):
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+        current = {}
+        for run in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            # the run goes on if the row above has exactly the same one
+            current[run] = runs.pop(run, row)
+        for run, top in runs.items():
+            close(run, top, row)
+        runs = current
+
+    for run, top in runs.items():
+        close(run, top, len(changed))
+
+    return rects
+
+
+def uv_edges(uv, loop_start, loop_total, select=None):
+    """
+    Unique UV edges of the faces as an (n, 2, 2) array of end points. The arrays are what mesh.foreach_get() gives:
+    uv is the flat loop coordinates, loop_start and loop_total are per polygon, select is the polygon mask
+    """
+    import numpy as np
+
+    uv = np.asarray(uv, dtype=np.float32).reshape(-1, 2)
+    starts = np.asarray(loop_start, dtype=np.int64)
+    totals = np.asarray(loop_total, dtype=np.int64)
+    if select is not None:
+        mask = np.asarray(select, dtype=bool)
+        starts, totals = starts[mask], totals[mask]
+
+    count = int(totals.sum())
+    if not count:
+        return np.empty((0, 2, 2), dtype=np.float32)
+
+    # every loop connects to the next one of the same face, and the last one wraps around to the first
+    face_start = np.repeat(starts, totals)
+    offset = np.arange(count) - np.repeat(np.cumsum(totals) - totals, totals)
+    loops = face_start + offset
+    following = np.where(offset == np.repeat(totals - 1, totals), face_start, loops + 1)
+
+    a, b = uv[loops], uv[following]
+    # each edge is in two faces going different directions, sorting the ends makes the duplicates equal
+    swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+    a[swap], b[swap] = b[swap], a[swap]
+
+    return unique_edges(np.hstack((a, b)))
+
+
+def unique_edges(edges):
+    """Drop the duplicate rows of (n, 4) end points; much faster than np.unique(axis=0), which compares them as records"""
+    import numpy as np
+
+    # adding zero turns -0.0 into 0.0, otherwise their bits differ
+    bits = (np.ascontiguousarray(edges, dtype=np.float32) + np.float32(0)).view(np.uint32).astype(np.uint64)
+    first = (bits[:, 0] << np.uint64(32)) | bits[:, 1]
+    second = (bits[:, 2] << np.uint64(32)) | bits[:, 3]
+
+    order = np.lexsort((second, first))
+    first, second = first[order], second[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+
+    return edges[order[keep]].reshape(-1, 2, 2)
+
+
+def scale_pixels(pixels, w, h, scale):
+    """Nearest neighbor upscale of blender's float pixels by a whole number"""
+    import numpy as np
+
+    px = np.asarray(pixels, dtype=np.float32).reshape(h, w, 4)
+    return px.repeat(scale, 0).repeat(scale, 1).ravel()
+
+
+def draw_lines(edges, w, h, color, weight=1.0):
+    """
+    Draw (n, 2, 2) UV edges into (h, w, 4) RGBA bytes going top to bottom, without antialiasing. It's for when there's
+    no GPU to draw them with, like in background mode
+    """
+    import numpy as np
+
+    out = np.zeros((h, w, 4), dtype=np.ubyte)
+    edges = np.asarray(edges, dtype=np.float32).reshape(-1, 2, 2)
+    if not len(edges):
+        return out
+
+    # pixels covered by a round brush of that diameter, around the point
+    r = max(float(weight), 1.0) / 2
+    span = np.arange(-int(r), int(r) + 1)
+    dx, dy = np.meshgrid(span, span)
+    near = dx * dx + dy * dy <= max(r * r, 0.25)
+    brush = np.stack((dx[near], dy[near]), axis=1)
+
+    # v goes up, rows go down
+    scale = np.array((w, -h), dtype=np.float32)
+    offset = np.array((0, h), dtype=np.float32)
+
+    # a chunk of edges at a time, so that dense meshes don't take a ton of memory
+    for lo in range(0, len(edges), 65536):
+        ends = edges[lo:lo + 65536] * scale + offset
+        a, d = ends[:, 0], ends[:, 1] - ends[:, 0]
+        # a step of at most one pixel along the longer side, so the lines are one pixel thin and have no gaps
+        steps = np.ceil(np.abs(d).max(axis=1)).astype(np.int64) + 1
+        edge = np.repeat(np.arange(len(ends)), steps)
+        t = (np.arange(int(steps.sum())) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(np.maximum(steps - 1, 1), steps)
+        points = np.floor(a[edge] + d[edge] * t[:, None].astype(np.float32)).astype(np.int64)
+
+        for bx, by in brush:
+            x = np.clip(points[:, 0] + bx, 0, w - 1)
+            y = np.clip(points[:, 1] + by, 0, h - 1)
+            out[y, x] = color
+
+    return out
@@ -18,7 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Type
+import asyncio
+import contextvars
+from contextlib import nullcontext
+from typing import Optional, Tuple, Type
 from types import SimpleNamespace as MessageArgs
 
 
@@ -46,6 +49,18 @@ class Handler:
         pass
 
 
+    def prepare(self, args:MessageArgs):
+        """Override this method to do the heavy work that doesn't touch blender data or the handlers' state, like
+            converting the pixels. Batches run it in the worker threads, for all their messages at once"""
+        pass
+
+
+    def wrapped(self, args:MessageArgs) -> Optional[Tuple['Handler', MessageArgs]]:
+        """Override this method in messages that carry another one, to return it as parsed. Its prepare step then
+            runs in their place"""
+        return None
+
+
     def take_bool(self):
         return self.take_uint(1) != 0
 
@@ -80,6 +95,11 @@ class Handler:
         return str(self.take_data(), encoding)
 
 
+    def at_end(self) -> bool:
+        """Check if the whole message has been parsed"""
+        return self._position >= len(self._data)
+
+
     def _parse(self, data:memoryview, args:MessageArgs):
         """Internal, use parse() instead"""
         self._position = 0
@@ -98,6 +118,8 @@ class Handlers:
 
     def __init__(self):
         self._messages={}
+        # metrics.Metrics that the handlers report to, if set
+        self.metrics = None
 
 
     def add(self, msg:Type[Handler]):
@@ -113,18 +135,57 @@ class Handlers:
         self._messages[msg.id] = m
 
 
-    async def process(self, data):
+    def parse(self, data) -> Optional[Tuple[Handler, MessageArgs]]:
+        """Find the handler and parse the message, or None if there's no handler"""
         mvdata = memoryview(data)
         id = str(mvdata[:ID_SIZE], 'utf-8')
 
         if id not in self._messages:
             print(f"Message {id} ({len(mvdata)} bytes) does not have handler")
-            return
+            return None
 
         msg = self._messages[id]
         args = MessageArgs()
-        msg._parse(mvdata[ID_SIZE:], args)
-        await msg.execute(**args.__dict__)
+        with self._timer("parse", msg):
+            msg._parse(mvdata[ID_SIZE:], args)
+
+        if self.metrics:
+            self.metrics.count(f"messages_in.{type(msg).__name__}")
+
+        return msg, args
+
+
+    def prepare(self, msg:Handler, args:MessageArgs):
+        """Run the handler's prepare step; thread safe as long as the handler's is"""
+        with self._timer("prepare", msg):
+            msg.prepare(args)
+
+
+    async def prepare_async(self, msg:Handler, args:MessageArgs):
+        """Run the prepare step in a worker thread, if the handler has one. The trace id goes along"""
+        inner = msg.wrapped(args)
+        if inner:
+            await self.prepare_async(*inner)
+        elif type(msg).prepare is not Handler.prepare:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, contextvars.copy_context().run, self.prepare, msg, args)
+
+
+    def _timer(self, stage:str, msg:Handler):
+        return self.metrics.timer(f"{stage}.{type(msg).__name__}") if self.metrics else nullcontext()
+
+
+    async def process(self, data):
+        parsed = self.parse(data)
+        if parsed:
+            msg, args = parsed
+            await self.prepare_async(msg, args)
+            await self.execute(msg, args)
+
+
+    async def execute(self, msg:Handler, args:MessageArgs):
+        with self._timer("execute", msg):
+            await msg.execute(**args.__dict__)
 
 
 # API for outgoing messages
@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Iterable, Sequence, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 from . import *
 
 
@@ -33,6 +33,17 @@ def batch(messages:Sequence[bytearray]) -> bytearray:
     return data
 
 
+def hello(options:Dict[str, str]) -> bytearray:
+    data = bytearray()
+    add_id(data, 'H')
+
+    for key, value in options.items():
+        add_string(data, key)
+        add_string(data, value)
+
+    return data
+
+
 def texture_list(images:Iterable[str]) -> bytearray:
     data = bytearray()
     add_id(data, 'L')
@@ -43,6 +54,50 @@ def texture_list(images:Iterable[str]) -> bytearray:
     return data
 
 
+def texture_list_add(images:Iterable[str]) -> bytearray:
+    data = bytearray()
+    add_id(data, 'A')
+
+    for img in images:
+        add_string(data, img)
+
+    return data
+
+
+def texture_list_remove(images:Iterable[str]) -> bytearray:
+    data = bytearray()
+    add_id(data, 'D')
+
+    for img in images:
+        add_string(data, img)
+
+    return data
+
+
+def texture_rename(old_name:str, new_name:str) -> bytearray:
+    data = bytearray()
+    add_id(data, 'R')
+    add_string(data, old_name)
+    add_string(data, new_name)
+    return data
+
+
+def texture_list_delta(added:Sequence[str], removed:Sequence[str], renamed:Sequence[Tuple[str, str]]) -> Optional[bytearray]:
+    """Pack changes of the texture list into one message, or None if there are no changes"""
+    messages = [texture_rename(old, new) for old, new in renamed]
+    if added:
+        messages.append(texture_list_add(added))
+    if removed:
+        messages.append(texture_list_remove(removed))
+
+    if not messages:
+        return None
+    elif len(messages) == 1:
+        return messages[0]
+    else:
+        return batch(messages)
+
+
 def uv_map(size:Tuple[int, int], sprite:str, pixels:bytes, opacity:int, layer:str) -> bytearray:
     data = bytearray()
     add_id(data, 'M')
@@ -65,6 +120,64 @@ def image(name:str, size:Tuple[int, int], pixels:bytes) -> bytearray:
     return data
 
 
+def image_rects(name:str, size:Tuple[int, int], rects:Sequence[Tuple[int, int, int, int, bytes]]) -> bytearray:
+    """Parts of the image that changed, as (x, y, w, h, RGBA bytes) going top to bottom"""
+    data = bytearray()
+    add_id(data, 'U')
+    add_string(data, name)
+    add_uint(data, size[0], 2)
+    add_uint(data, size[1], 2)
+    add_uint(data, len(rects), 2)
+    for x, y, w, h, pixels in rects:
+        add_uint(data, x, 2)
+        add_uint(data, y, 2)
+        add_uint(data, w, 2)
+        add_uint(data, h, 2)
+        add_data(data, pixels)
+    return data
+
+
+def image_begin(name:str, size:Tuple[int, int], stream:int) -> bytearray:
+    data = bytearray()
+    add_id(data, 'B')
+    add_uint(data, size[0], 2)
+    add_uint(data, size[1], 2)
+    add_string(data, name)
+    add_uint(data, stream, 4)
+    return data
+
+
+def image_chunk(stream:int, row:int, pixels:bytes) -> bytearray:
+    data = bytearray()
+    add_id(data, 'K')
+    add_uint(data, stream, 4)
+    add_uint(data, row, 2)
+    add_data(data, pixels)
+    return data
+
+
+def image_end(stream:int) -> bytearray:
+    data = bytearray()
+    add_id(data, 'E')
+    add_uint(data, stream, 4)
+    return data
+
+
+def image_stream(name:str, size:Tuple[int, int], pixels:bytes, stream:int, chunk_size:int) -> List[bytearray]:
+    """Split the image into begin, chunk and end messages; each chunk has whole rows and is about chunk_size bytes"""
+    w, h = size
+    stride = w * 4
+    rows = max(1, chunk_size // stride)
+    pixels = memoryview(pixels)
+
+    messages = [image_begin(name, size, stream)]
+    for y in range(0, h, rows):
+        messages.append(image_chunk(stream, y, pixels[y * stride:(y + rows) * stride]))
+    messages.append(image_end(stream))
+
+    return messages
+
+
 def sprite_new(name:str, mode:int, size: Tuple[int, int]) -> bytearray:
     data = bytearray()
     add_id(data, 'S')
@@ -86,4 +199,21 @@ def sprite_focus(name:str) -> bytearray:
     data = bytearray()
     add_id(data, 'F')
     add_string(data, name)
-    return data
\ No newline at end of file
+    return data
+
+
+def resend(name:str) -> bytearray:
+    """Blender has no frame to put the tiles into, the client should send the whole image next time"""
+    data = bytearray()
+    add_id(data, 'W')
+    add_string(data, name)
+    return data
+
+
+def ack(name:str, seq:int) -> bytearray:
+    """The image update is done with, the client paces its updates by these"""
+    data = bytearray()
+    add_id(data, 'Y')
+    add_string(data, name)
+    add_uint(data, seq, 4)
+    return data
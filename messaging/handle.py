@@ -18,15 +18,25 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from __future__ import annotations
+
 import bpy
 import asyncio
 import re
-from typing import Tuple, Iterable
+from typing import Dict, Tuple, Iterable
 from os import path
+from time import perf_counter
 from . import Handler
-import numpy as np
+from . import encode
 # TODO move into local methods
+from .. import trace
 from .. import util
+from ..addon import addon
+from ..record import INBOUND, replaying
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
 
 
 class Batch(Handler):
@@ -39,39 +49,436 @@ class Batch(Handler):
 
 
     async def execute(self, messages:Iterable[memoryview]):
-        for m in messages:
-            await self._handlers.process(m)
+        # parse everything first, and convert all messages at the same time in the worker threads
+        parsed = [p for p in map(self._handlers.parse, messages) if p]
+        await asyncio.gather(*(self._handlers.prepare_async(msg, args) for msg, args in parsed))
+
+        # then apply in order, the images are updated by one operator call
+        with util.batch_updates():
+            for msg, args in parsed:
+                await msg.execute(**args.__dict__)
+
+
+class Wrapper(Handler):
+    """Message that carries another one. That one is parsed right away, so a batch converts it in the worker threads"""
+
+    def take_message(self, args):
+        args.message = self.take_data()
+        args.inner = self._handlers.parse(args.message)
+
+
+    def wrapped(self, args):
+        return args.inner
+
+
+    async def execute_inner(self, inner):
+        if inner:
+            await self._handlers.execute(*inner)
+
+
+class Sequenced(Wrapper):
+    """Numbered image message, the number is sent back in the ack once the image is applied"""
+    id = 'Q'
+
+    def parse(self, args):
+        args.seq = self.take_uint(4)
+        self.take_message(args)
+
+
+    async def execute(self, *, seq:int, message:memoryview, inner):
+        token = util.frame_seq.set(seq)
+        try:
+            await self.execute_inner(inner)
+        finally:
+            util.frame_seq.reset(token)
+
+
+class Timestamp(Wrapper):
+    """Message with the time when the client sent it, to show the transit time in the trace"""
+    id = '@'
+
+    def parse(self, args):
+        args.sent = self.take_uint(8) # microseconds of unix time
+        self.take_message(args)
+
+
+    async def execute(self, *, sent:int, message:memoryview, inner):
+        tracer = addon.tracer
+        if tracer.enabled:
+            tracer.async_span("transit", tracer.from_wall_clock(sent / 1e6), perf_counter(), trace.current.get())
+
+        await self.execute_inner(inner)
+
+
+class Hello(Handler):
+    """Options that the client supports"""
+    id = 'H'
+
+    def parse(self, args):
+        args.options = {}
+        while not self.at_end():
+            key = self.take_str()
+            args.options[key] = self.take_str()
+
+
+    async def execute(self, *, options:Dict[str, str]):
+        if addon.client:
+            addon.client.options = options
+
+        # a new client starts with a full frame anyway
+        util.forget_images()
 
 
 class Image(Handler):
     id = 'I'
 
-    def parse(self, args):
+    def parse_header(self, args):
+        """Fields that all kinds of image messages start with"""
         args.size = self.take_uint(2), self.take_uint(2)
         args.name = self.take_str()
+
+
+    def parse(self, args):
+        import numpy as np
+
+        self.parse_header(args)
         args.data = np.frombuffer(self.take_data(), dtype=np.ubyte)
 
-    async def execute(self, *, size:Tuple[int, int], name:str, data:np.array):
+
+    def prepare(self, args):
+        # the bytes stay too, they're checksummed and kept for the tiles
+        w, h = args.size
+        if args.data.size == w * h * 4:
+            args.floats = util.to_blender_pixels(args.data, h)
+
+
+    def keep_frame(self, name:str, size:Tuple[int, int], data:np.ndarray):
+        """Remember RGBA frames when the client sends tiles, those are put into the frame later"""
+        import numpy as np
+
+        client = addon.client
+        w, h = size
+        if data.dtype == np.ubyte and data.size == w * h * 4 and (client is None or "tile" in client.options):
+            frames()[name] = data.reshape(h, w, 4).copy()
+
+
+    async def execute(self, *, size:Tuple[int, int], name:str, data:np.array, floats:np.ndarray=None):
+        client = addon.client
+        if client and name:
+            client.sprites.add(name)
+
+        self.keep_frame(name, size, data)
+
         try:
             # TODO separate cases for named and anonymous sprites
             if not bpy.context.window_manager.is_interface_locked:
-                util.update_image(size[0], size[1], name, data)
+                util.update_image(size[0], size[1], name, data, floats)
             else:
                 bpy.ops.pribambase.report(message_type='WARNING', message="UI is locked, image update skipped")
+                util.ack_image(client, name)
         except:
             # blender 2.80... if it crashes, it crashes :\
-            util.update_image(size[0], size[1], name, data)
+            util.update_image(size[0], size[1], name, data, floats)
 
 
 class NewImage(Image):
     """Same as image except it creates a named image if it doesn't exist"""
     id = 'N'
 
-    async def execute(self, *, size:Tuple[int, int], name:str, data:np.array):
+    async def execute(self, *, size:Tuple[int, int], name:str, data:np.array, floats:np.ndarray=None):
         _, short = path.split(name)
         img = util.new_packed_image(short, size[0], size[1])
         img.sb_source = name
-        await super().execute(size=size, name=name, data=data)
+        await super().execute(size=size, name=name, data=data, floats=floats)
+
+
+class SharedImage(Image):
+    """Same as image except the pixels are in the shared memory slot"""
+    id = 'Z'
+
+    def parse(self, args):
+        self.parse_header(args)
+        args.slot = self.take_uint(1)
+        args.seq = self.take_uint(4)
+        args.length = self.take_uint(4)
+
+
+    def prepare(self, args):
+        pass # no pixels in the message
+
+
+    async def execute(self, *, size:Tuple[int, int], name:str, slot:int, seq:int, length:int):
+        if replaying.get():
+            return # the slots are long gone, the capture has the pixels in the 'I' message that follows
+
+        ring = addon.client and addon.client.ring
+        data = ring and ring.read(slot, seq, length)
+
+        # None means the slot was reused already, and the newer frame's message will arrive next
+        if data is None:
+            util.ack_image(addon.client, name)
+        else:
+            recorder = addon.server.recorder
+            if recorder:
+                # pixels are not in the message, so the capture gets a copy that can be replayed without the slots
+                recorder.write(INBOUND, addon.client.id, encode.image(name, size, data.tobytes()))
+
+            await super().execute(size=size, name=name, data=data)
+
+
+class ImageStream:
+    """Image that arrives in chunks, which are converted into the destination buffer as soon as they come"""
+
+    def __init__(self, name:str, size:Tuple[int, int], keep:bool=False):
+        import numpy as np
+
+        self.name = name
+        self.size = size
+        self.rows = 0
+        self.pixels = np.empty(size[0] * size[1] * 4, dtype=np.float32)
+        # the bytes as well, when the client sends tiles that go into them later
+        self.frame = np.empty((size[1], size[0], 4), dtype=np.ubyte) if keep else None
+        # a newer frame of the same image started, the rest of this one is dropped
+        self.superseded = False
+
+
+    @property
+    def progress(self) -> float:
+        return self.rows / self.size[1]
+
+
+    def write(self, row:int, data:np.ndarray):
+        import numpy as np
+
+        w, h = self.size
+        stride = w * 4
+        count = data.size // stride
+        if count == 0 or data.size % stride or row + count > h:
+            raise ValueError(f"A chunk of {data.size} bytes at row {row} doesn't fit the {w}x{h} image \"{self.name}\"")
+
+        # blender's rows go bottom to top
+        dest = self.pixels.reshape(h, stride)[h - row - count:h - row]
+        np.multiply(data.reshape(count, stride)[::-1], np.float32(1.0 / 255.0), out=dest)
+        if self.frame is not None:
+            self.frame.reshape(h, stride)[row:row + count] = data.reshape(count, stride)
+        self.rows += count
+
+
+# unfinished streams when there's no client, e.g. in a replay
+_streams = {}
+
+def streams() -> Dict[int, ImageStream]:
+    """Unfinished streams of the current client, by id"""
+    return addon.client.streams if addon.client else _streams
+
+
+class StreamBegin(Image):
+    """Start of an image that's sent in chunks"""
+    id = 'B'
+
+    def parse(self, args):
+        self.parse_header(args)
+        args.stream = self.take_uint(4)
+
+
+    def prepare(self, args):
+        pass # no pixels in the message
+
+
+    async def execute(self, *, size:Tuple[int, int], name:str, stream:int):
+        active = streams()
+
+        # a newer frame supersedes the unfinished transfer of the same image; the stream stays until its end,
+        # so that the chunks on the way aren't taken for a broken client
+        for s in active.values():
+            if s.name == name and not s.superseded:
+                s.superseded = True
+                s.pixels = s.frame = None
+
+        client = addon.client
+        active[stream] = ImageStream(name, size, keep=client is None or "tile" in client.options)
+
+
+class StreamChunk(Handler):
+    """Rows of a streamed image"""
+    id = 'K'
+
+    def parse(self, args):
+        import numpy as np
+
+        args.stream = self.take_uint(4)
+        args.row = self.take_uint(2)
+        args.data = np.frombuffer(self.take_data(), dtype=np.ubyte)
+
+
+    async def execute(self, *, stream:int, row:int, data:np.ndarray):
+        s = streams().get(stream)
+        if s is None:
+            bpy.ops.pribambase.report(message_type='ERROR', message=f"Got rows of an image stream {stream} that didn't begin")
+        elif not s.superseded:
+            try:
+                s.write(row, data)
+            except ValueError as e:
+                # the stream ends up short of rows, and isn't shown
+                bpy.ops.pribambase.report(message_type='ERROR', message=str(e))
+            util.refresh() # progress
+
+
+class StreamEnd(Image):
+    """Streamed image is complete and can be shown"""
+    id = 'E'
+
+    def parse(self, args):
+        args.stream = self.take_uint(4)
+
+
+    def prepare(self, args):
+        pass # no pixels in the message
+
+
+    async def execute(self, *, stream:int):
+        s = streams().pop(stream, None)
+        if s is not None and not s.superseded and s.rows == s.size[1]:
+            if s.frame is not None:
+                frames()[s.name] = s.frame
+            await super().execute(size=s.size, name=s.name, data=s.pixels)
+        elif s is not None:
+            util.ack_image(addon.client, s.name)
+
+
+# the latest RGBA frames of the images by name, with rows top to bottom like they're sent; when there's no client
+_frames = {}
+
+def frames() -> Dict[str, np.ndarray]:
+    """Kept frames of the current client, so that two Aseprites with the same sprite don't mix up the tiles"""
+    return addon.client.frames if addon.client else _frames
+
+
+class Tiles(Image):
+    """Parts of the image that changed since the last frame; the frame itself must have been sent before"""
+    id = 'T'
+
+    def parse(self, args):
+        import numpy as np
+
+        self.parse_header(args)
+        args.tile = self.take_uint(2)
+        count = self.take_uint(4)
+        args.tiles = [(self.take_uint(2), self.take_uint(2), np.frombuffer(self.take_data(), dtype=np.ubyte)) for _ in range(count)]
+
+
+    def prepare(self, args):
+        pass # the tiles go into the kept frame first
+
+
+    def keep_frame(self, name, size, data):
+        pass # the tiles are written into the kept frame already
+
+
+    async def execute(self, *, size:Tuple[int, int], name:str, tile:int, tiles:Iterable[Tuple[int, int, np.ndarray]]):
+        w, h = size
+        frame = frames().get(name)
+
+        if frame is None or frame.shape[:2] != (h, w):
+            # missed the whole frame, e.g. a reused shm slot or a broken stream; the client only sends the next one
+            # when the size changes, unless it's asked to
+            client = addon.client
+            if client and "resend" in client.options:
+                addon.server.send(encode.resend(name), client=client)
+            util.ack_image(client, name)
+            return
+
+        for x, y, data in tiles:
+            tw, th = min(tile, w - x), min(tile, h - y)
+            frame[y:y + th, x:x + tw] = data.reshape(th, tw, 4)
+
+        # the update is applied later, and more tiles might be written into the frame by then
+        await super().execute(size=size, name=name, data=frame.ravel().copy())
+
+
+# palette lookup tables and the latest (size, indices) of indexed images, by name, when there's no client
+# the indices are kept so that a palette change can be shown without resending the pixels
+_palettes = {}
+_indices = {}
+
+def palettes() -> Dict[str, np.ndarray]:
+    return addon.client.palettes if addon.client else _palettes
+
+
+def indices() -> Dict[str, Tuple[Tuple[int, int], np.ndarray]]:
+    return addon.client.indices if addon.client else _indices
+
+
+def forget_frames():
+    """Drop the kept frames, palettes and indices, for when the images they were sent for are gone"""
+    for cache in (_frames, _palettes, _indices):
+        cache.clear()
+
+    if addon.server_up:
+        for client in addon.server.clients:
+            client.forget_frames()
+
+
+class FormattedImage(Image):
+    """Image in the sprite's own color mode; indexed images use the palette from the preceding palette message"""
+    id = 'X'
+
+    def parse(self, args):
+        import numpy as np
+
+        self.parse_header(args)
+        args.format = self.take_uint(1)
+        args.data = np.frombuffer(self.take_data(), dtype=np.ubyte)
+
+
+    def prepare(self, args):
+        if args.format == util.GRAY:
+            # indexed ones can't be converted yet, they need the palette as of when they're applied
+            args.data = util.gray_to_blender_pixels(args.data, *args.size)
+            args.format = util.RGBA
+
+
+    async def execute(self, *, size:Tuple[int, int], name:str, format:int, data:np.ndarray):
+        w, h = size
+
+        if format == util.INDEXED:
+            indices()[name] = size, data
+            lut = palettes().get(name)
+            if lut is None:
+                # no palette yet, the image will show up after it arrives
+                util.ack_image(addon.client, name)
+                return
+            pixels = util.indexed_to_blender_pixels(data, w, h, lut)
+
+        else:
+            pixels = data
+
+        await super().execute(size=size, name=name, data=pixels)
+
+
+class Palette(Image):
+    """Palette of an indexed image. If only the palette changed, the image is recolored with the indices it already has"""
+    id = 'P'
+
+    def parse(self, args):
+        args.name = self.take_str()
+        args.colors = self.take_data()
+
+
+    def prepare(self, args):
+        args.lut = util.palette_lut(args.colors)
+        del args.colors
+
+
+    async def execute(self, *, name:str, lut:np.ndarray):
+        palettes()[name] = lut
+
+        kept = indices().get(name)
+        if kept:
+            size, data = kept
+            await super().execute(size=size, name=name, data=util.indexed_to_blender_pixels(data, *size, lut))
+        else:
+            util.ack_image(addon.client, name)
 
 
 class TextureList(Handler):
@@ -79,7 +486,9 @@ class TextureList(Handler):
     id = 'L'
 
     async def execute(self):
-        bpy.ops.pribambase.texture_list()
+        # reply to the client that asked
+        if addon.server_up:
+            addon.server.send(encode.texture_list(addon.textures.reset()))
 
 
 class ChangeName(Handler):
@@ -111,4 +520,16 @@ class ChangeName(Handler):
                 else:
                     img.filepath = ""
 
-                bpy.ops.pribambase.texture_list()
\ No newline at end of file
+                msg = encode.texture_list_delta(*addon.textures.update((img,)))
+                if msg and addon.server_up:
+                    addon.server.broadcast(msg)
+
+        client = addon.client
+        if client:
+            client.sprites.discard(old_name)
+            client.sprites.add(new_name)
+
+        for cache in (frames(), palettes(), indices()):
+            if old_name in cache:
+                cache[new_name] = cache.pop(old_name)
+        util.rename_image(old_name, new_name)
\ No newline at end of file
@@ -0,0 +1,130 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Sync performance counters. Doesn't depend on blender, so that the tools can use it too
+
+import bisect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict
+
+
+# upper bounds of the histogram buckets, in seconds; the last bucket takes everything above
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """Distribution of durations, in fixed buckets so that adding is cheap"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+
+    def add(self, seconds:float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+    def percentile(self, p:float) -> float:
+        """Upper bound of the bucket that the percentile falls into"""
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "buckets": dict(zip([str(b) for b in BUCKETS] + ["inf"], self.buckets)),
+        }
+
+
+class Metrics:
+    """Counters and latency histograms of the sync stages, by name"""
+
+    def __init__(self):
+        # trace.Tracer that gets the timed stages as spans too, if set
+        self.tracer = None
+        # prepare steps are timed in the worker threads
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self._lock:
+            self.counters:Counter = Counter()
+            self.histograms:Dict[str, Histogram] = {}
+            self.since = perf_counter()
+
+
+    def count(self, name:str, n:int=1):
+        with self._lock:
+            self.counters[name] += n
+
+
+    def time(self, name:str, seconds:float):
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.add(seconds)
+
+
+    @contextmanager
+    def timer(self, name:str):
+        """Add the time the context takes to the histogram"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            self.time(name, end - start)
+            if self.tracer and self.tracer.enabled:
+                self.tracer.span(name, start, end)
+
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "seconds": perf_counter() - self.since,
+                "counters": dict(self.counters),
+                "histograms": {name: h.as_dict() for name, h in self.histograms.items()},
+            }
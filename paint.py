@@ -0,0 +1,164 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Sends what's painted in blender to Aseprite. The images being painted are sampled a few times per second,
+# checksums of their tiles tell which parts changed since the last sample, and only those rectangles are sent
+
+import bpy
+from time import perf_counter
+from typing import Dict, Set
+
+from . import core
+from . import util
+from .messaging import encode
+from .addon import addon
+
+
+# side of the squares that are compared; smaller tiles send less, but take longer to check
+TILE = 32
+# how often the timer looks for painted images when there are none
+IDLE_INTERVAL = 0.5
+# part of the main thread's time that sampling may take; big textures get checked less often than the preferences say
+BUDGET = 0.25
+
+
+class Tracker:
+    """Tile checksums of the image as Aseprite has it"""
+
+    def __init__(self, w, h):
+        import numpy as np
+
+        self.size = w, h
+        self.floats = np.empty(w * h * 4, dtype=np.float32)
+        # bytes padded to whole tiles, the padding stays zero
+        self.buffer = np.zeros((-(-h // TILE) * TILE, -(-w // TILE) * TILE, 4), dtype=np.ubyte)
+        self.digests = None
+        # util's checksums of the frame that came from Aseprite last, a new one means the image was replaced
+        self.applied = None
+
+
+    def sample(self, img):
+        """Read the pixels into the buffer, and return the new tile checksums"""
+        w, h = self.size
+        try:
+            img.pixels.foreach_get(self.floats)
+        except AttributeError:
+            # version < 2.83
+            self.floats[:] = img.pixels[:]
+        core.from_blender_pixels(self.floats, w, h, out=self.buffer[:h, :w])
+        return core.tile_digests(self.buffer, TILE)
+
+
+# by image name
+_trackers:Dict[str, Tracker] = {}
+
+
+def painted_images() -> Set[bpy.types.Image]:
+    """Images that are open for painting, in the image editors or the texture paint mode"""
+    images = set()
+    ctx = bpy.context
+
+    for win in ctx.window_manager.windows:
+        for area in win.screen.areas:
+            if area.type == 'IMAGE_EDITOR':
+                space = area.spaces.active
+                if space.mode == 'PAINT' and space.image:
+                    images.add(space.image)
+
+    obj = ctx.view_layer.objects.active if ctx.view_layer else None
+    if obj and obj.mode == 'TEXTURE_PAINT':
+        paint = ctx.scene.tool_settings.image_paint
+        if paint.mode == 'IMAGE':
+            if paint.canvas:
+                images.add(paint.canvas)
+        elif obj.active_material:
+            mat = obj.active_material
+            slots = mat.texture_paint_images
+            if 0 <= mat.paint_active_slot < len(slots):
+                images.add(slots[mat.paint_active_slot])
+
+    return images
+
+
+def send_changes(img, client):
+    name = util.image_name(img)
+    w, h = img.size
+    tracker = _trackers.get(name)
+    applied = util.applied_digest(name)
+
+    if tracker is None or tracker.size != (w, h):
+        tracker = _trackers[name] = Tracker(w, h)
+
+    with addon.metrics.timer("paint_sample"):
+        digests = tracker.sample(img)
+
+    # the first sample, or a frame from Aseprite replaced the pixels; either way, Aseprite has them already
+    if tracker.digests is None or tracker.applied is not applied:
+        tracker.digests = digests
+        tracker.applied = applied
+        return
+
+    changed = digests != tracker.digests
+    if not changed.any():
+        return
+
+    tracker.digests = digests
+    # the image isn't the last frame from Aseprite anymore, if it sends that again it has to be applied
+    util.forget_image(name)
+    tracker.applied = None
+
+    rects = [(x, y, rw, rh, tracker.buffer[y:y + rh, x:x + rw].tobytes()) for x, y, rw, rh in core.dirty_rects(changed, TILE, w, h)]
+    msg = encode.image_rects(name, (w, h), rects)
+    addon.server.send(msg, client=client)
+    addon.metrics.count("paint_rects", len(rects))
+    addon.metrics.count("paint_bytes", len(msg))
+
+
+def paint_timer():
+    """Looks for painted images at the rate from the preferences"""
+    if not addon.server_up or not addon.state.paint_sync:
+        _trackers.clear()
+        return IDLE_INTERVAL
+
+    start = perf_counter()
+    names = set()
+
+    for img in painted_images():
+        if not img.has_data or img.size[0] == 0:
+            continue
+
+        name = util.image_name(img)
+        # only the clients that synced the sprite can take the changes
+        client = next((c for c in addon.server.clients if name in c.sprites and c.options.get("rects")), None)
+        if client is None:
+            continue
+
+        names.add(name)
+        send_changes(img, client)
+
+    # images that are not painted anymore start over when they are again
+    for name in _trackers.keys() - names:
+        del _trackers[name]
+
+    if not names:
+        return IDLE_INTERVAL
+
+    spent = perf_counter() - start
+    return max(1.0 / addon.prefs.paint_rate, spent / BUDGET) - spent
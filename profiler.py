@@ -0,0 +1,62 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Profiler captures of what python does on the main thread, to find what makes the sync slow.
+# Nothing is hooked unless a capture is running
+
+import cProfile
+import pstats
+from os import path
+from typing import List, Tuple
+
+
+# the addon's own code, the summary lists only its functions
+ROOT = path.dirname(path.abspath(__file__))
+
+
+class Capture:
+    """One profiler run, saved to the file when stopped"""
+
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        self._profile = cProfile.Profile()
+
+
+    def start(self):
+        self._profile.enable()
+
+
+    def stop(self) -> pstats.Stats:
+        self._profile.disable()
+        self._profile.dump_stats(self.filepath)
+        return pstats.Stats(self._profile)
+
+
+def summary(stats:pstats.Stats, top:int=15, own_only:bool=True) -> List[Tuple[str, int, float, float]]:
+    """(function, calls, own time, total time) of the slowest functions by total time"""
+    rows = []
+
+    for (filename, line, func), (_, calls, own, total, _) in stats.stats.items():
+        if own_only and not filename.startswith(ROOT):
+            continue
+        rows.append((f"{func} ({path.basename(filename)}:{line})", calls, own, total))
+
+    rows.sort(key=lambda r: r[3], reverse=True)
+    return rows[:top]
@@ -0,0 +1,117 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Capture of the messages that went through the server, and playing them back"""
+
+import asyncio
+import struct
+import time
+from contextvars import ContextVar
+from os import path
+from typing import Iterator, Tuple
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .messaging import Handlers
+
+
+MAGIC = b"SBREC1\n"
+# timestamp, direction, client id, data length; followed by the data
+FRAME = struct.Struct("<dBHI")
+
+INBOUND = 0
+OUTBOUND = 1
+
+# messages being handled come from a capture, not from any of the connected clients
+replaying:ContextVar[bool] = ContextVar("pribambase_replaying", default=False)
+
+
+class Recorder:
+    """Appends every message to a capture file"""
+
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        new = not path.exists(filepath) or path.getsize(filepath) == 0
+        self._file = open(filepath, "ab")
+        if new:
+            self._file.write(MAGIC)
+
+
+    def write(self, direction:int, client:int, data):
+        self._file.write(FRAME.pack(time.time(), direction, client, len(data)))
+        self._file.write(data)
+
+
+    def close(self):
+        self._file.close()
+
+
+def read(filepath:str) -> Iterator[Tuple[float, int, int, bytes]]:
+    """Yields (timestamp, direction, client id, data) of each message in the capture"""
+    with open(filepath, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filepath} is not a session capture")
+
+        while True:
+            header = f.read(FRAME.size)
+            if len(header) < FRAME.size:
+                break # the capture might have been cut off while writing
+
+            timestamp, direction, client, length = FRAME.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+
+            yield timestamp, direction, client, data
+
+
+async def replay(filepath:str, handlers:'Handlers', realtime:bool=True, speed:float=1.0) -> Tuple[int, float]:
+    """
+    Feed the inbound messages from the capture to the handlers, either keeping the original timing
+    or as fast as possible. Returns the number of messages and the time it took. The messages are handled
+    as if there's no client, so that the acks and sprites don't go to the ones that are connected
+    """
+    token = replaying.set(True)
+    try:
+        return await _replay(filepath, handlers, realtime, speed)
+    finally:
+        replaying.reset(token)
+
+
+async def _replay(filepath, handlers, realtime, speed):
+    start = time.perf_counter()
+    first = None
+    count = 0
+
+    for timestamp, direction, _client, data in read(filepath):
+        if direction != INBOUND:
+            continue
+
+        if realtime:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        await handlers.process(data)
+        count += 1
+
+    return count, time.perf_counter() - start
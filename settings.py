@@ -19,15 +19,17 @@
 # SOFTWARE.
 
 import bpy
+import sys
 
 from .addon import addon
 
 
 
 class SB_State(bpy.types.PropertyGroup):
-    # once, here were some session settings
-    # they may come useful again so let's keep it wired
-    pass
+    paint_sync: bpy.props.BoolProperty(
+        name="Send Painting",
+        description="Send the strokes painted on synced textures in Blender to Aseprite",
+        default=False)
 
 
 class SB_Preferences(bpy.types.AddonPreferences):
@@ -45,6 +47,47 @@ class SB_Preferences(bpy.types.AddonPreferences):
         description="Only accept connections from localhost (127.0.0.1)",
         default=True)
 
+    unix_socket: bpy.props.BoolProperty(
+        name="Unix Socket",
+        description="Also accept connections on a unix domain socket, for local tools and scripts. Aseprite can't connect over it. Not available on Windows",
+        default=False)
+
+    tcp: bpy.props.BoolProperty(
+        name="TCP Port",
+        description="Listen on the port. Aseprite only connects over TCP; turn it off to only use the unix socket, which avoids port conflicts between several Blender instances",
+        default=True)
+
+    socket_path: bpy.props.StringProperty(
+        name="Socket Path",
+        description="File path of the unix socket. Leave empty to create it in the temporary folder, named after Blender's process id",
+        subtype='FILE_PATH',
+        default="")
+
+    shm: bpy.props.BoolProperty(
+        name="Shared Memory Transfer",
+        description="Pass the pixels through memory-mapped files instead of the socket. Only used for local connections",
+        default=False)
+
+    shm_path: bpy.props.StringProperty(
+        name="Shared Memory Folder",
+        description="Folder for the frame files, preferrably on a RAM disk. Leave empty to use /dev/shm or the temporary folder",
+        subtype='DIR_PATH',
+        default="")
+
+    shm_slots: bpy.props.IntProperty(
+        name="Frame Slots",
+        description="Number of frames that can be passed at the same time",
+        default=4,
+        min=2,
+        max=16)
+
+    tile_size: bpy.props.IntProperty(
+        name="Tile Size",
+        description="Aseprite only sends the square tiles of this size that changed since the last frame. Zero to always send whole frames",
+        default=64,
+        min=0,
+        max=1024)
+
     autostart: bpy.props.BoolProperty(
         name="Start Automatically",
         description="Set up the connection when Blender starts. Enabling increases blender's launch time",
@@ -86,6 +129,60 @@ class SB_Preferences(bpy.types.AddonPreferences):
         description="Change the way the changes are applied to blender data. Degrades the experience but might fix some crashes",
         default=False)
 
+    paint_rate: bpy.props.FloatProperty(
+        name="Paint Sync Rate",
+        description="How many times per second the painted textures are checked for changes to send to Aseprite",
+        default=4.0,
+        min=1.0,
+        max=30.0)
+
+    load_sprites: bpy.props.BoolProperty(
+        name="Load Sprites From Disk",
+        description="When a blendfile is opened, update the textures whose .aseprite files were saved after it, without waiting for Aseprite",
+        default=True)
+
+    record: bpy.props.BoolProperty(
+        name="Record Sessions",
+        description="Write all messages to a capture file, that can be replayed to reproduce performance problems",
+        default=False)
+
+    record_dir: bpy.props.StringProperty(
+        name="Capture Folder",
+        description="Where the captures are saved. Leave empty to use the temporary folder",
+        subtype='DIR_PATH',
+        default="")
+
+    profile_sessions: bpy.props.BoolProperty(
+        name="Profile Sessions",
+        description="Run the profiler for a while each time Aseprite connects. The capture is saved in the capture folder",
+        default=False)
+
+    profile_seconds: bpy.props.IntProperty(
+        name="Profile Length",
+        description="How long the profiler runs, in seconds",
+        default=10,
+        min=1,
+        max=600)
+
+    profile_top: bpy.props.IntProperty(
+        name="Hot Functions",
+        description="How many of the slowest functions are listed after profiling",
+        default=15,
+        min=1,
+        max=100)
+
+    png_compression: bpy.props.IntProperty(
+        name="PNG Compression",
+        description="How hard to compress the synced images packed into the blendfile. Higher is smaller and slower to save",
+        default=6,
+        min=0,
+        max=9)
+
+    startup_report: bpy.props.BoolProperty(
+        name="Report Startup Time",
+        description="Print how long each stage of loading the addon took to the system console",
+        default=False)
+
 
     def template_box(self, layout, label="Box"):
         row = layout.row().split(factor=0.15)
@@ -113,7 +210,32 @@ class SB_Preferences(bpy.types.AddonPreferences):
         row = box.row()
         row.enabled = not addon.server_up
         row.prop(self, "localhost")
-        row.prop(self, "port")
+        sub = row.row()
+        sub.enabled = self.tcp or not self.unix_socket
+        sub.prop(self, "port")
+
+        row = box.row()
+        row.enabled = not addon.server_up and sys.platform != 'win32'
+        row.prop(self, "unix_socket")
+        sub = row.row()
+        sub.enabled = self.unix_socket
+        sub.prop(self, "tcp")
+        sub.prop(self, "socket_path", text="")
+
+        if addon.server_up and addon.server.socket_path:
+            box.label(text=f"Listening on {addon.server.socket_path}")
+
+        col = box.column()
+        col.enabled = self.localhost and not addon.server_up
+        col.row().prop(self, "shm")
+        row = col.row()
+        row.enabled = self.shm
+        row.prop(self, "shm_path")
+        row.prop(self, "shm_slots")
+
+        row = box.row()
+        row.enabled = not addon.server_up
+        row.prop(self, "tile_size")
 
         if addon.server_up:
             box.row().operator("pribambase.stop_server")
@@ -123,6 +245,30 @@ class SB_Preferences(bpy.types.AddonPreferences):
         box = self.template_box(layout, label="Misc:")
 
         box.row().prop(self, "skip_modal")
+        box.row().prop(self, "load_sprites")
+        box.row().prop(self, "paint_rate")
+        row = box.row()
+        row.enabled = not addon.server_up
+        row.prop(self, "record")
+        sub = row.row()
+        sub.enabled = self.record
+        sub.prop(self, "record_dir", text="")
+        box.row().operator("pribambase.replay")
+        box.row().prop(self, "png_compression")
+
+        row = box.row()
+        row.prop(self, "profile_sessions")
+        row.prop(self, "profile_seconds")
+        row.prop(self, "profile_top")
+
+        box.row().prop(self, "startup_report")
+
+        if self.startup_report:
+            col = box.column(align=True)
+            for stage, sec in addon.startup.items():
+                row = col.row()
+                row.label(text=stage)
+                row.label(text=f"{sec * 1000:.1f} ms")
 
 
 class SB_OT_preferences(bpy.types.Operator):
@@ -0,0 +1,123 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Memory-mapped frame slots for passing pixels between processes on the same computer"""
+
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+from os import path
+from typing import Optional
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
+
+
+# every slot file starts with (seq, length); seq is zero while the writer is changing the slot
+HEADER = struct.Struct("<II")
+
+
+def default_dir() -> str:
+    """tmpfs on linux, otherwise whatever the temp folder is"""
+    return "/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class FrameRing:
+    """
+    A ring of slot files that the client writes frames into. The socket then only carries
+    a short notification, and the pixels are read from the mapping without going through it.
+    """
+
+    def __init__(self, directory:str, slots:int):
+        self.directory = directory
+        self.slots = slots
+        self._files = [None] * slots
+        self._maps = [None] * slots
+
+
+    def slot_path(self, slot:int) -> str:
+        return path.join(self.directory, f"slot{slot}.bin")
+
+
+    def create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(self.slots):
+            with open(self.slot_path(i), "wb") as f:
+                f.write(HEADER.pack(0, 0))
+
+
+    def close(self):
+        for i in range(self.slots):
+            self._unmap(i)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+    def read(self, slot:int, seq:int, length:int) -> Optional['np.ndarray']:
+        """Copy the frame out of the slot, or return None if it was already overwritten by a newer one"""
+        import numpy as np
+
+        if not 0 <= slot < self.slots or seq == 0:
+            return None
+
+        mm = self._map(slot, HEADER.size + length)
+        if mm is None or HEADER.unpack_from(mm, 0) != (seq, length):
+            return None
+
+        data = np.frombuffer(mm, dtype=np.ubyte, count=length, offset=HEADER.size).copy()
+
+        # the writer zeroes the seq before touching the pixels, so a changed header means the copy is torn
+        if HEADER.unpack_from(mm, 0)[0] != seq:
+            return None
+
+        return data
+
+
+    def _map(self, slot:int, size:int) -> Optional[mmap.mmap]:
+        mm = self._maps[slot]
+
+        if mm is None or len(mm) < size:
+            # the file grows when the client writes a bigger frame, so the mapping has to follow
+            self._unmap(slot)
+            try:
+                f = open(self.slot_path(slot), "rb")
+            except OSError:
+                return None
+
+            filesize = os.fstat(f.fileno()).st_size
+            if filesize < size:
+                f.close()
+                return None
+
+            self._files[slot] = f
+            mm = self._maps[slot] = mmap.mmap(f.fileno(), filesize, access=mmap.ACCESS_READ)
+
+        return mm
+
+
+    def _unmap(self, slot:int):
+        if self._maps[slot] is not None:
+            self._maps[slot].close()
+            self._maps[slot] = None
+        if self._files[slot] is not None:
+            self._files[slot].close()
+            self._files[slot] = None
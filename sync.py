@@ -19,106 +19,360 @@
 # SOFTWARE.
 
 from __future__ import annotations
-from aiohttp.web_ws import WebSocketResponse
 
 import bpy
 import asyncio
-import aiohttp
-from aiohttp import web
-from time import time
+import os
+import shutil
+import sys
+from contextvars import ContextVar
+from os import path
+from time import perf_counter, time
+from typing import Dict, Optional, Set, Tuple
 
 from . import async_loop
+from . import trace
 from . import util
 from .messaging import encode
 from .addon import addon
+from .record import INBOUND, OUTBOUND, replaying
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
+    from aiohttp.web_ws import WebSocketResponse
+    from .shm import FrameRing
+    from .record import Recorder
+    from .messaging.handle import ImageStream
+
+
+# the client whose message is being processed; each connection runs in its own task, so it has its own value
+_current_client:ContextVar[Optional[Client]] = ContextVar("pribambase_client", default=None)
+
+
+# images bigger than that are sent in chunks of about that size
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# largest message that's taken from a client. Frames bigger than STREAM_CHUNK_SIZE come in chunks, but new images
+# don't; this fits a new 4096x4096 sprite
+MAX_MESSAGE_SIZE = 4096 * 4096 * 4 + 64 * 1024
+
+
+def unix_sockets_supported() -> bool:
+    """asyncio can't listen to unix sockets on windows, even where they exist"""
+    import socket
+    return hasattr(socket, "AF_UNIX") and sys.platform != 'win32'
+
+
+class Client():
+    """State of one connected Aseprite instance"""
+
+    def __init__(self, ws:WebSocketResponse, id:int, recorder:Recorder=None):
+        self.id = id
+        self.ws = ws
+        self.recorder = recorder
+        # options received in the client's hello message
+        self.options:Dict[str, str] = {}
+        # names of the images that this client sent, used to route the messages about them
+        self.sprites:Set[str] = set()
+        # shared memory slots offered to this client, None if not used
+        self.ring:FrameRing = None
+        # images that are being received in chunks, by stream id
+        self.streams:Dict[int, ImageStream] = {}
+        # latest RGBA frames, palette lookup tables and (size, indices) of the client's sprites, by name; see handle.py
+        self.frames:Dict[str, np.ndarray] = {}
+        self.palettes:Dict[str, np.ndarray] = {}
+        self.indices:Dict[str, Tuple[Tuple[int, int], np.ndarray]] = {}
+        # each client has its own queue, so that a large message to one client does not hold up the others
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.ensure_future(self._write())
+
+
+    def send(self, msg, binary=True):
+        self._queue.put_nowait((msg, binary, perf_counter()))
+
+
+    async def close(self):
+        self._queue.put_nowait((None, True, 0))
+        await self.ws.close()
+        if self.ring:
+            self.ring.close()
+        self.forget_frames()
+        self.streams.clear()
+
+
+    def forget_frames(self):
+        self.frames.clear()
+        self.palettes.clear()
+        self.indices.clear()
+
+
+    async def flush(self):
+        """Wait until the queued messages are written, or the connection is closed"""
+        join = asyncio.ensure_future(self._queue.join())
+        await asyncio.wait((join, self._writer), return_when=asyncio.FIRST_COMPLETED)
+        join.cancel()
+
+
+    async def _write(self):
+        while True:
+            msg, binary, queued = await self._queue.get()
+            try:
+                if msg is None or self.ws.closed:
+                    break
+
+                addon.metrics.time("queue_wait", perf_counter() - queued)
+                addon.metrics.count("bytes_out", len(msg))
+                addon.metrics.count("messages_out")
+
+                if self.recorder:
+                    self.recorder.write(OUTBOUND, self.id, msg if binary else msg.encode())
+
+                try:
+                    if binary:
+                        await self.ws.send_bytes(msg, False)
+                    else:
+                        await self.ws.send_str(msg, False)
+                except ConnectionError:
+                    break
+            finally:
+                self._queue.task_done()
 
 
 class Server():
-    def __init__(self, host="", port=0):
+    def __init__(self, host="", port=0, socket_path=""):
         self.host = host
+        # tcp port, or None to only listen to the unix socket
         self.port = port
-        self._ws = None
+        # unix domain socket that's listened to, if not empty
+        self.socket_path = socket_path
+        # folder for shared memory slots for localhost connections, empty if not used
+        self.shm_dir = ""
+        self.shm_slots = 0
+        # offered size of the tiles that the client sends instead of whole frames, 0 if not used
+        self.tile_size = 0
+        # writes all messages to a capture file if set
+        self.recorder:Recorder = None
+        self._clients:Dict[int, Client] = {}
+        self._next_client_id = 1
+        self._next_stream_id = 1
+        # the client that sent the latest message, it's where the messages from UI go by default
+        self._active:Client = None
         self._server = None
-        self._site = None
+        self._runner = None
+        self._sites = []
         self._start_time = 0
 
 
-    def send(self, msg, binary=True):
-        if self._ws is not None:
-            if binary:
-                asyncio.ensure_future(self._ws.send_bytes(msg, False))
-            else:
-                asyncio.ensure_future(self._ws.send_str(msg, False))
+    @property
+    def address(self) -> str:
+        """Where the server listens, for the messages"""
+        where = [f"{self.host}:{self.port}"] if self.port is not None else []
+        if self.socket_path:
+            where.append(self.socket_path)
+        return " and ".join(where)
+
+
+    @property
+    def client(self) -> Optional[Client]:
+        """The client whose message is being handled, or else the one that was last active. None while replaying"""
+        if replaying.get():
+            return None
+        return _current_client.get() or self._active
+
+
+    @property
+    def clients(self):
+        return self._clients.values()
+
+
+    def client_for(self, name:str) -> Optional[Client]:
+        """Find the client that syncs the image, or the current one if none does"""
+        for client in self._clients.values():
+            if name in client.sprites:
+                return client
+        return self.client
+
+
+    def send(self, msg, binary=True, client:Client=None):
+        """Send to the given client; by default, reply to the current one"""
+        client = client or self.client
+        if client is not None:
+            client.send(msg, binary)
+
+
+    def send_image(self, name:str, size:Tuple[int, int], pixels:bytes, client:Client=None):
+        """Send RGBA image, large ones are split into chunks so neither side has to buffer one huge message"""
+        if len(pixels) <= STREAM_CHUNK_SIZE:
+            self.send(encode.image(name=name, size=size, pixels=pixels), client=client)
+        else:
+            stream = self._next_stream_id
+            self._next_stream_id = stream % 0xffffffff + 1
+            for msg in encode.image_stream(name, size, pixels, stream, STREAM_CHUNK_SIZE):
+                self.send(msg, client=client)
+
+
+    def broadcast(self, msg, binary=True):
+        for client in self._clients.values():
+            client.send(msg, binary)
 
 
     @property
     def connected(self):
-        return self._ws is not None and not self._ws.closed
+        return any(not c.ws.closed for c in self._clients.values())
 
 
-    def start(self):
-        started = False
+    async def start_async(self):
+        """Open the sites, on the loop that's already running"""
+        # aiohttp takes a while to import, so it's only loaded when the server is actually needed
+        from aiohttp import web
 
         self._start_time = int(time())
+        self._server = web.Server(self._receive)
 
-        async def _start_a(self):
-            nonlocal started
-            self._server = web.Server(self._receive)
+        self._runner = web.ServerRunner(self._server)
+        await self._runner.setup()
 
-            runner = web.ServerRunner(self._server)
-            await runner.setup()
+        # both sites share the server, so the handlers and the handshake are the same
+        if self.port is not None:
+            self._sites.append(web.TCPSite(self._runner, self.host, self.port))
+        if self.socket_path:
+            self._sites.append(web.UnixSite(self._runner, self.socket_path))
 
-            self._site = web.TCPSite(runner, self.host, self.port)
-            await self._site.start()
+        started = []
+        try:
+            for site in self._sites:
+                await site.start()
+                started.append(site)
+        except:
+            # don't keep the port taken if the socket can't be opened, or the other way around
+            await self._runner.cleanup()
+            if any(isinstance(site, web.UnixSite) for site in started):
+                os.remove(self.socket_path)
+            self._sites.clear()
+            raise
 
-            started = True
 
+    def start(self):
         async_loop.ensure_async_loop()
-        stop = asyncio.wait_for(_start_a(self), timeout=5.0)
+        stop = asyncio.wait_for(self.start_async(), timeout=5.0)
 
         try:
             asyncio.get_event_loop().run_until_complete(stop)
             util.refresh()
         except asyncio.TimeoutError:
-            raise RuntimeError(f"Could not start server at {self.host}:{self.port}")
+            raise RuntimeError(f"Could not start server at {self.address}")
+
+
+    async def stop_async(self):
+        """Close the connections and the sites, on the loop that's already running"""
+        for client in tuple(self._clients.values()):
+            await client.close()
+        for site in self._sites:
+            await site.stop()
+        await self._runner.cleanup()
+        await self._server.shutdown()
+
+        if self.socket_path and path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        if self.shm_dir:
+            shutil.rmtree(self.shm_dir, ignore_errors=True)
+
+        if self.recorder:
+            self.recorder.close()
 
 
     def stop(self):
-        async def _stop_a():
-            if self._ws is not None:  # no connections happened
-                await self._ws.close()
-            await self._site.stop()
-            await self._site._runner.cleanup()
-            await self._server.shutdown()
-
-        asyncio.ensure_future(_stop_a())
+        asyncio.ensure_future(self.stop_async())
         async_loop.erase_async_loop()
         util.refresh()
 
 
+    def hello_options(self, client:Client):
+        """Features the server offers to the client; the client replies with the ones it's going to use"""
+        options = { "version": "1", "ack": "1", "rects": "1", "max_message": str(MAX_MESSAGE_SIZE) }
+
+        if client.ring:
+            options["shm"] = client.ring.directory
+            options["shm_slots"] = str(client.ring.slots)
+
+        if self.tile_size:
+            options["tile"] = str(self.tile_size)
+
+        return options
+
+
     async def _receive(self, request) -> WebSocketResponse:
-        self._ws = web.WebSocketResponse(max_msg_size=0)
+        import aiohttp
+        from aiohttp import web
 
-        await self._ws.prepare(request)
+        ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE)
+
+        await ws.prepare(request)
 
         # client connected
-        imgs = tuple(util.image_name(img) for img in bpy.data.images)
-        await self._ws.send_bytes(encode.texture_list(imgs), False)
-        bpy.ops.pribambase.report(message_type='INFO', message="Aseprite connected")
+        client = Client(ws, self._next_client_id, self.recorder)
+        self._next_client_id += 1
+        self._clients[client.id] = client
+        self._active = client
+        _current_client.set(client)
+
+        if self.shm_dir:
+            # every client writes its own slots
+            from .shm import FrameRing
+            client.ring = FrameRing(path.join(self.shm_dir, f"client{client.id}"), self.shm_slots)
+            client.ring.create()
+
+        if addon.prefs.profile_sessions and not addon.profile:
+            try:
+                addon.start_profile(addon.prefs.profile_seconds)
+            except ValueError:
+                pass # another profiler has it, the session goes on without
+
+        client.send(encode.hello(self.hello_options(client)))
+
+        # it gets the full list once and then only the changes
+        imgs = addon.textures.reset()
+        client.send(encode.texture_list(imgs))
+
+        count = len(self._clients)
+        bpy.ops.pribambase.report(message_type='INFO', message="Aseprite connected" if count == 1 else f"Aseprite connected ({count} total)")
         util.refresh()
 
-        async for msg in self._ws:
-            if msg.type == aiohttp.WSMsgType.BINARY:
-                await addon.handlers.process(msg.data)
-
-            elif msg.type == aiohttp.WSMsgType.ERROR:
-                bpy.ops.pribambase.report(message_type='ERROR', message=f"Connection closed with exception {self._ws.exception()}")
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    self._active = client
+                    addon.metrics.count("bytes_in", len(msg.data))
+                    if self.recorder:
+                        self.recorder.write(INBOUND, client.id, msg.data)
+
+                    tracer = addon.tracer
+                    if tracer.enabled:
+                        received = perf_counter()
+                        token = trace.current.set(tracer.new_id())
+                        try:
+                            await addon.handlers.process(msg.data)
+                        finally:
+                            tracer.async_span("message", received, perf_counter(), trace.current.get())
+                            trace.current.reset(token)
+                    else:
+                        await addon.handlers.process(msg.data)
+
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    bpy.ops.pribambase.report(message_type='ERROR', message=f"Connection closed with exception {ws.exception()}")
+        finally:
+            # client disconnected
+            del self._clients[client.id]
+            if self._active is client:
+                self._active = next(iter(self._clients.values()), None)
+            await client.close()
 
-        # client disconnected
         bpy.ops.pribambase.report(message_type='INFO', message="Aseprite disconnected")
         util.refresh()
 
-        return self._ws
+        return ws
 
 
 class SB_OT_serv_start(bpy.types.Operator):
@@ -165,8 +419,69 @@ class SB_OT_texture_list(bpy.types.Operator):
 
 
     def execute(self, context):
-        images = (util.image_name(img) for img in bpy.data.images)
+        images = addon.textures.reset()
         msg = encode.texture_list(images)
-        addon.server.send(msg)
+        addon.server.broadcast(msg)
 
         return {'FINISHED'}
+
+
+class SB_OT_replay(bpy.types.Operator):
+    bl_idname = "pribambase.replay"
+    bl_label = "Replay Session..."
+    bl_description = "Feed the messages from a recorded session to the handlers, as if they came from Aseprite"
+
+    filepath: bpy.props.StringProperty(subtype="FILE_PATH")
+    filter_glob: bpy.props.StringProperty(default="*.sbrec", options={'HIDDEN'})
+
+    realtime: bpy.props.BoolProperty(
+        name="Original Speed",
+        description="Keep the timing of the recording, otherwise process the messages as fast as possible",
+        default=True)
+
+
+    def execute(self, context):
+        from .record import replay
+
+        async def _replay_a():
+            count, elapsed = await replay(bpy.path.abspath(self.filepath), addon.handlers, realtime=self.realtime)
+            bpy.ops.pribambase.report(message_type='INFO', message=f"Replayed {count} messages in {elapsed:.2f}s")
+
+        asyncio.ensure_future(_replay_a())
+        async_loop.ensure_async_loop()
+
+        return {'FINISHED'}
+
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+class SB_OT_profile(bpy.types.Operator):
+    bl_idname = "pribambase.profile"
+    bl_label = "Profile"
+    bl_description = "Record what blender does for a while, to find what makes the sync slow. The capture is saved in the capture folder"
+
+    seconds: bpy.props.IntProperty(name="Seconds", default=10, min=1, max=600)
+
+
+    @classmethod
+    def poll(self, ctx):
+        return addon.profile is None
+
+
+    def execute(self, context):
+        try:
+            addon.start_profile(self.seconds)
+        except ValueError as e:
+            # a capture or another profiler is running
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        return {'FINISHED'}
+
+
+    def invoke(self, context, event):
+        self.seconds = addon.prefs.profile_seconds
+        return self.execute(context)
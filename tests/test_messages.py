@@ -0,0 +1,65 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Runs outside of blender on top of tools/fakebpy.py: python -m pytest tests
+
+import asyncio
+import sys
+import threading
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "tools"))
+import fakebpy
+
+fakebpy.install()
+pribambase = fakebpy.import_addon()
+
+from pribambase.messaging import Handlers, add_data, add_id, add_uint, encode, handle
+
+
+class Image(handle.Image):
+    def prepare(self, args):
+        super().prepare(args)
+        args.thread = threading.current_thread()
+
+
+def wrap(id, field, size, msg):
+    data = bytearray()
+    add_id(data, id)
+    add_uint(data, field, size)
+    add_data(data, msg)
+    return data
+
+
+def test_wrapped_image_is_prepared_in_worker():
+    handlers = Handlers()
+    for msg in (handle.Batch, handle.Sequenced, handle.Timestamp, Image):
+        handlers.add(msg)
+
+    image = encode.image("a.png", (4, 4), np.full(64, 10, dtype=np.ubyte).tobytes())
+    msg, args = handlers.parse(wrap('Q', 1, 4, wrap('@', 0, 8, image)))
+    asyncio.new_event_loop().run_until_complete(handlers.prepare_async(msg, args))
+
+    _, stamped = args.inner
+    _, inner = stamped.inner
+    assert inner.floats.dtype == np.float32
+    assert inner.thread is not threading.main_thread()
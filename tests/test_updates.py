@@ -0,0 +1,75 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Runs outside of blender on top of tools/fakebpy.py: python -m pytest tests
+
+import asyncio
+import sys
+import types
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "tools"))
+import fakebpy
+
+fakebpy.install()
+pribambase = fakebpy.import_addon()
+
+import soak
+from pribambase import util
+
+
+def setup_module():
+    soak.install_scene(pribambase, types.SimpleNamespace(port=0, tile_size=0, shm=False, shm_slots=0))
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def frame(value, w=4, h=4):
+    return np.full(w * h * 4, value, dtype=np.ubyte)
+
+
+def test_frame_replaces_waiting_one():
+    util.new_packed_image("a.png", 4, 4)
+
+    with util.batch_updates():
+        for seq, value in ((1, 10), (2, 20)):
+            token = util.frame_seq.set(seq)
+            try:
+                util.update_image(4, 4, "a.png", frame(value))
+            finally:
+                util.frame_seq.reset(token)
+
+        waiting = util._pending["a.png"]
+        assert waiting.seqs == [1, 2]
+        assert waiting.pixels[0] == 20
+
+    util.apply_updates(defer=False)
+    assert not util._pending
+
+
+def test_unsaved_keeps_bytes():
+    util.new_packed_image("b.png", 4, 4)
+    pixels = frame(30)
+    util.update_image(4, 4, "b.png", pixels, util.to_blender_pixels(pixels, 4))
+    util.apply_updates(defer=False)
+
+    w, h, saved = util._unsaved["b.png"]
+    assert saved.dtype == np.ubyte
@@ -0,0 +1,177 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmarks of the sync hot paths, runs without Blender.
+
+    python tools/bench.py
+    python tools/bench.py --sizes 64 1024 8192 --json before.json
+    python tools/bench.py --compare before.json
+
+Reports the best time, throughput and peak memory allocated by each case. With --compare, exits
+with an error if any case got slower than the threshold, so it can guard against regressions.
+8192x8192 sprites take a few GB of memory, so they're not in the default sizes.
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import fakebpy
+
+fakebpy.install()
+pribambase = fakebpy.import_addon()
+from pribambase import core
+from pribambase.messaging import Handlers, encode, handle
+
+
+SIZES = (64, 256, 1024, 2048, 4096)
+LOOPS = (1000, 10000, 100000, 1000000)
+
+
+def quad_grid(loops:int):
+    """UV layout of a grid mesh with about that many loops, like foreach_get() gives it"""
+    side = max(1, int((loops / 4) ** 0.5))
+    faces = side * side
+    y, x = np.divmod(np.arange(faces), side)
+    corners = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.float32)
+    uv = (np.stack((x, y), axis=1)[:, None, :] + corners) / side
+    starts = np.arange(faces, dtype=np.int32) * 4
+    totals = np.full(faces, 4, dtype=np.int32)
+    return uv.astype(np.float32).ravel(), starts, totals, np.ones(faces, dtype=bool)
+
+
+def image_cases(size:int):
+    """(name, function, bytes processed) for a square sprite"""
+    rng = np.random.default_rng(size)
+    w = h = size
+    rgba = rng.integers(0, 256, w * h * 4, dtype=np.uint8)
+    indices = rng.integers(0, 256, w * h, dtype=np.uint8)
+    gray = rng.integers(0, 256, w * h * 2, dtype=np.uint8)
+    lut = core.palette_lut(rng.integers(0, 256, 256 * 4, dtype=np.uint8).tobytes())
+    floats = core.to_blender_pixels(rgba, h)
+
+    handlers = Handlers()
+    handlers.add(handle.Image)
+    message = bytes(encode.image("bench.aseprite", (w, h), rgba.tobytes()))
+
+    cases = [
+        ("encode.image", lambda: encode.image("bench.aseprite", (w, h), rgba.tobytes()), rgba.nbytes),
+        ("parse.Image", lambda: handlers.parse(message), rgba.nbytes),
+        ("to_blender_pixels", lambda: core.to_blender_pixels(rgba, h), rgba.nbytes),
+        ("indexed_to_blender_pixels", lambda: core.indexed_to_blender_pixels(indices, w, h, lut), indices.nbytes),
+        ("gray_to_blender_pixels", lambda: core.gray_to_blender_pixels(gray, w, h), gray.nbytes),
+        ("row_digests", lambda: core.row_digests(rgba, h), rgba.nbytes),
+        ("encode_png", lambda: core.encode_png(rgba, w, h), rgba.nbytes),
+        ("from_blender_pixels", lambda: core.from_blender_pixels(floats, w, h), floats.nbytes),
+        ("tile_digests", lambda: core.tile_digests(rgba.reshape(h, w, 4), 32), rgba.nbytes),
+    ]
+
+    if size <= 2048:
+        cases.append(("scale_pixels x4", lambda: core.scale_pixels(floats, w, h, 4), floats.nbytes))
+
+    return [(f"{name} {size}x{size}", f, n) for name, f, n in cases]
+
+
+def uv_cases(loops:int):
+    uv, starts, totals, select = quad_grid(loops)
+    edges = core.uv_edges(uv, starts, totals, select)
+    return [
+        (f"uv_edges {len(uv) // 2} loops", lambda: core.uv_edges(uv, starts, totals, select), uv.nbytes),
+        (f"draw_lines {len(uv) // 2} loops", lambda: core.draw_lines(edges, 1024, 1024, (0, 0, 0, 255)), edges.nbytes)]
+
+
+def measure(f, min_time:float, min_runs:int):
+    """Best time of several runs, and the peak memory of one"""
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_runs or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+
+    # separately, tracemalloc slows things down
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=SIZES, help="sprite sizes, in pixels per side")
+    parser.add_argument("--loops", type=int, nargs="*", default=LOOPS, help="mesh sizes, in loops")
+    parser.add_argument("--filter", default="", help="only run the cases with this in their name")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to repeat each case for")
+    parser.add_argument("--min-runs", type=int, default=3, help="least number of runs of each case")
+    parser.add_argument("--json", default="", help="save the results to this file")
+    parser.add_argument("--compare", default="", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown against --compare that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    cases = [c for size in args.sizes for c in image_cases(size)] + [c for loops in args.loops for c in uv_cases(loops)]
+    results = {}
+    regressions = []
+
+    print(f"{'case':<44}{'best ms':>10}{'MB/s':>10}{'peak MB':>10}{'change':>9}")
+    for name, f, nbytes in cases:
+        if args.filter not in name:
+            continue
+
+        best, peak = measure(f, args.min_time, args.min_runs)
+        results[name] = {"seconds": best, "bytes": nbytes, "peak": peak}
+
+        change = ""
+        if name in baseline:
+            ratio = best / baseline[name]["seconds"]
+            change = f"{ratio:.2f}x"
+            if ratio > args.threshold:
+                regressions.append(name)
+                change += " !"
+
+        print(f"{name:<44}{best * 1000:>10.2f}{nbytes / best / 2**20:>10.0f}{peak / 2**20:>10.1f}{change:>9}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print(f"\n{len(regressions)} cases slower than {args.threshold}x: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
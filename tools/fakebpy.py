@@ -0,0 +1,124 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Just enough of a fake `bpy` for the addon modules to import outside of Blender, so that their
+bpy-free parts can be driven by benchmarks and scripts:
+
+    import fakebpy
+    fakebpy.install()
+    addon = fakebpy.import_addon()  # the package, named pribambase
+
+Nothing here behaves like Blender beyond what the modules touch at import time.
+"""
+
+import importlib.util
+import sys
+import types
+from os import path
+
+
+class _Anything:
+    """Stands for any bpy class or function; can be subclassed, called and looked into"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+    def __getattr__(self, name):
+        return _Anything()
+
+    def __init_subclass__(cls, **kwargs):
+        pass
+
+
+class _Types(types.ModuleType):
+    def __getattr__(self, name):
+        # fresh class for every name, so that the addon's classes can inherit from several of them
+        cls = type(name, (), {})
+        setattr(self, name, cls)
+        return cls
+
+
+class _Props(types.ModuleType):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def _persistent(f):
+    return f
+
+
+def install():
+    """Put the fake modules into sys.modules, unless the real ones are there"""
+    if "bpy" in sys.modules:
+        return
+
+    bpy = types.ModuleType("bpy")
+    bpy.types = _Types("bpy.types")
+    bpy.props = _Props("bpy.props")
+
+    handlers = types.ModuleType("bpy.app.handlers")
+    handlers.persistent = _persistent
+    for name in ("load_post", "load_pre", "save_pre", "save_post", "undo_post", "redo_post", "depsgraph_update_post"):
+        setattr(handlers, name, [])
+
+    timers = types.ModuleType("bpy.app.timers")
+    timers.register = timers.unregister = lambda *args, **kwargs: None
+    timers.is_registered = lambda f: False
+
+    bpy.app = types.ModuleType("bpy.app")
+    bpy.app.handlers = handlers
+    bpy.app.timers = timers
+    bpy.app.version = (2, 93, 0)
+
+    bpy.path = types.SimpleNamespace(abspath=lambda p: p)
+    bpy.utils = _Anything()
+    bpy.ops = _Anything()
+    bpy.context = types.SimpleNamespace(window_manager=None, preferences=None, scene=None, edit_image=None)
+    bpy.data = types.SimpleNamespace(images=[], objects=[])
+
+    imbuf = types.ModuleType("imbuf")
+    imbuf.new = imbuf.write = lambda *args, **kwargs: None
+
+    sys.modules.update({
+        "bpy": bpy,
+        "bpy.types": bpy.types,
+        "bpy.props": bpy.props,
+        "bpy.app": bpy.app,
+        "bpy.app.handlers": handlers,
+        "bpy.app.timers": timers,
+        "imbuf": imbuf,
+    })
+
+
+def import_addon(name="pribambase"):
+    """Import the addon package from this checkout"""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    root = path.dirname(path.dirname(path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(name, path.join(root, "__init__.py"), submodule_search_locations=[root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,386 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Stand-in for the Aseprite client that speaks the sync protocol and measures the server.
+
+    python tools/loadgen.py --sprites 8 --size 256 256 --rate 30 --duration 20
+
+Simulates several sprites being painted, switching frames and getting renamed, and reports
+message and byte rates along with two latencies: the round trip of a texture list request,
+and the time from sending a frame until the server acknowledges that it's applied.
+Only needs aiohttp and numpy, so it runs on any machine that can reach Blender.
+"""
+
+import argparse
+import asyncio
+import random
+import struct
+import sys
+import time
+from os import path
+
+import aiohttp
+import numpy as np
+
+# the messaging package doesn't need blender, import it as a top level package
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import messaging
+from messaging import encode
+
+
+def message_texture_list_request() -> bytearray:
+    data = bytearray()
+    messaging.add_id(data, 'L')
+    return data
+
+
+def message_change_name(old_name:str, new_name:str) -> bytearray:
+    data = bytearray()
+    messaging.add_id(data, 'C')
+    messaging.add_string(data, old_name)
+    messaging.add_string(data, new_name)
+    return data
+
+
+def message_new_image(name:str, size, pixels:bytes) -> bytearray:
+    data = encode.image(name, size, pixels)
+    data[0:1] = b'N'
+    return data
+
+
+def message_shared_image(name:str, size, slot:int, seq:int, length:int) -> bytearray:
+    data = bytearray()
+    messaging.add_id(data, 'Z')
+    messaging.add_uint(data, size[0], 2)
+    messaging.add_uint(data, size[1], 2)
+    messaging.add_string(data, name)
+    messaging.add_uint(data, slot, 1)
+    messaging.add_uint(data, seq, 4)
+    messaging.add_uint(data, length, 4)
+    return data
+
+
+def message_sequenced(seq:int, msg) -> bytearray:
+    """Numbers the frame, the server acks it with the number once the image is updated"""
+    data = bytearray()
+    messaging.add_id(data, 'Q')
+    messaging.add_uint(data, seq, 4)
+    messaging.add_data(data, msg)
+    return data
+
+
+def message_timestamp(msg) -> bytearray:
+    """Wraps the message with the time it's sent, for the server's trace"""
+    data = bytearray()
+    messaging.add_id(data, '@')
+    messaging.add_uint(data, int(time.time() * 1e6), 8)
+    messaging.add_data(data, msg)
+    return data
+
+
+def percentile(values, q:float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Stats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sent_messages = {}
+        self.sent_bytes = 0
+        self.received_messages = {}
+        self.received_bytes = 0
+        self.latency = []
+        self.apply_latency = []
+
+
+    def sent(self, msg):
+        id = chr(msg[0])
+        self.sent_messages[id] = self.sent_messages.get(id, 0) + 1
+        self.sent_bytes += len(msg)
+
+
+    def received(self, msg):
+        id = chr(msg[0])
+        self.received_messages[id] = self.received_messages.get(id, 0) + 1
+        self.received_bytes += len(msg)
+
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        sent = sum(self.sent_messages.values())
+        received = sum(self.received_messages.values())
+        def latency(values):
+            values = sorted(values)
+            ms = lambda q: percentile(values, q) * 1000
+            return f"n={len(values)} p50={ms(0.5):.1f} p90={ms(0.9):.1f} p99={ms(0.99):.1f} max={ms(1.0):.1f} ms"
+
+        return "\n".join((
+            f"elapsed      {elapsed:.1f} s",
+            f"sent         {sent / elapsed:.1f} msg/s, {self.sent_bytes / elapsed / 1048576:.2f} MB/s  {dict(sorted(self.sent_messages.items()))}",
+            f"received     {received / elapsed:.1f} msg/s, {self.received_bytes / elapsed / 1048576:.2f} MB/s  {dict(sorted(self.received_messages.items()))}",
+            f"latency      {latency(self.latency)}",
+            f"applied      {latency(self.apply_latency)}",
+        ))
+
+
+class SharedSlots:
+    """Client side of shm.FrameRing"""
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, directory:str, slots:int):
+        self._files = [open(path.join(directory, f"slot{i}.bin"), "r+b") for i in range(slots)]
+        self._next = 0
+        self._seq = 0
+
+
+    def write(self, pixels:bytes):
+        """Returns (slot, seq) of the written frame"""
+        slot = self._next
+        f = self._files[slot]
+        self._next = (slot + 1) % len(self._files)
+        self._seq = self._seq % 0xffffffff + 1
+
+        f.seek(0)
+        f.write(self.HEADER.pack(0, 0))
+        f.flush()
+        f.write(pixels)
+        f.seek(0)
+        f.write(self.HEADER.pack(self._seq, len(pixels)))
+        f.flush()
+
+        return slot, self._seq
+
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+class LoadClient:
+    """Connects to the server and plays the part of aseprite"""
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.textures = set()
+        self.options = {}
+        self.shm = None
+        # current name of each sprite, they change with renames
+        self._names = {}
+        self._ws = None
+        self._pending_probes = []
+        # send times of the frames that the server didn't ack yet, by number
+        self._unacked = {}
+        self._seq = 0
+        self.acks = False
+        self._hello = asyncio.Event()
+
+
+    async def send(self, msg):
+        if self.args.timestamps:
+            msg = message_timestamp(msg)
+        self.stats.sent(msg)
+        await self._ws.send_bytes(bytes(msg))
+
+
+    async def run(self):
+        args = self.args
+        connector = aiohttp.UnixConnector(path=args.unix) if args.unix else None
+        url = "http://localhost/" if args.unix else args.url
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async with session.ws_connect(url, max_msg_size=0) as ws:
+                self._ws = ws
+                reader = asyncio.ensure_future(self._read())
+
+                await asyncio.wait_for(self._hello.wait(), timeout=5.0)
+                reply = {}
+                if args.shm and "shm" in self.options:
+                    self.shm = SharedSlots(self.options["shm"], int(self.options["shm_slots"]))
+                    reply["shm"] = "1"
+                if "ack" in self.options:
+                    reply["ack"] = "1"
+                    self.acks = True
+                await self.send(encode.hello(reply))
+
+                self.stats = Stats()
+                self._unacked.clear()
+                tasks = [asyncio.ensure_future(self._sprite(i)) for i in range(args.sprites)]
+                tasks.append(asyncio.ensure_future(self._probe()))
+                if args.rename_every > 0:
+                    tasks.append(asyncio.ensure_future(self._renames()))
+
+                await asyncio.sleep(args.duration)
+
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                reader.cancel()
+
+        if self.shm:
+            self.shm.close()
+
+
+    async def _read(self):
+        async for msg in self._ws:
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                continue
+
+            self.stats.received(msg.data)
+            self._handle(memoryview(msg.data))
+
+
+    def _handle(self, data):
+        id = chr(data[0])
+
+        if id == '[':
+            count, = struct.unpack_from("<H", data, 1)
+            pos = 3
+            for _ in range(count):
+                length, = struct.unpack_from("<I", data, pos)
+                pos += 4
+                self._handle(data[pos:pos + length])
+                pos += length
+        elif id == 'H':
+            strings = self._strings(data)
+            self.options = dict(zip(strings, strings))
+            self._hello.set()
+        elif id == 'L':
+            self.textures = set(self._strings(data))
+            if self._pending_probes:
+                self.stats.latency.append(time.perf_counter() - self._pending_probes.pop(0))
+        elif id == 'A':
+            self.textures.update(self._strings(data))
+        elif id == 'D':
+            self.textures.difference_update(self._strings(data))
+        elif id == 'R':
+            old_name, new_name = self._strings(data)
+            self.textures.discard(old_name)
+            self.textures.add(new_name)
+        elif id == 'Y':
+            # the name goes first, the number is the last 4 bytes
+            seq, = struct.unpack_from("<I", data, len(data) - 4)
+            sent = self._unacked.pop(seq, None)
+            if sent is not None:
+                self.stats.apply_latency.append(time.perf_counter() - sent)
+
+
+    @staticmethod
+    def _strings(data):
+        """Yields strings from the list/hello messages"""
+        pos = 1
+        while pos < len(data):
+            length, = struct.unpack_from("<I", data, pos)
+            pos += 4
+            yield bytes(data[pos:pos + length]).decode('utf-8')
+            pos += length
+
+
+    def sprite_name(self, i:int, generation:int=0) -> str:
+        return f"loadgen/sprite{i:03}" + (f"_{generation}" if generation else "") + ".aseprite"
+
+
+    async def _sprite(self, i:int):
+        """Paints one sprite at the configured rate, cycling through its frames"""
+        args = self.args
+        w, h = args.size
+        rng = np.random.default_rng(args.seed + i)
+        frames = [rng.integers(0, 256, w * h * 4, dtype=np.uint8).tobytes() for _ in range(args.frames)]
+        name = self.sprite_name(i)
+        self._names[i] = name
+
+        await self.send(message_new_image(name, (w, h), frames[0]))
+
+        interval = 1.0 / args.rate
+        next_time = time.perf_counter()
+        n = 0
+        while True:
+            n += 1
+            pixels = frames[n % len(frames)]
+            name = self._names[i]
+
+            if self.shm:
+                slot, seq = self.shm.write(pixels)
+                msg = message_shared_image(name, (w, h), slot, seq, len(pixels))
+            else:
+                msg = encode.image(name, (w, h), pixels)
+
+            if self.acks:
+                self._seq = self._seq % 0xffffffff + 1
+                self._unacked[self._seq] = time.perf_counter()
+                msg = message_sequenced(self._seq, msg)
+
+            await self.send(msg)
+
+            next_time += interval
+            await asyncio.sleep(max(0.0, next_time - time.perf_counter()))
+
+
+    async def _renames(self):
+        """Every so often, renames a burst of sprites as if they were saved under new names"""
+        generation = 0
+        while True:
+            await asyncio.sleep(self.args.rename_every)
+            generation += 1
+            for i in random.sample(range(self.args.sprites), min(self.args.rename_burst, self.args.sprites)):
+                new_name = self.sprite_name(i, generation)
+                await self.send(message_change_name(self._names[i], new_name))
+                self._names[i] = new_name
+
+
+    async def _probe(self):
+        """Measures how long the server takes to get through the queued messages"""
+        while True:
+            await asyncio.sleep(self.args.probe)
+            self._pending_probes.append(time.perf_counter())
+            await self.send(message_texture_list_request())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:34613", help="server address")
+    parser.add_argument("--unix", default="", help="connect to a unix socket instead of the url")
+    parser.add_argument("--sprites", type=int, default=4, help="number of sprites painted at the same time")
+    parser.add_argument("--size", type=int, nargs=2, default=(256, 256), metavar=("W", "H"), help="sprite size")
+    parser.add_argument("--rate", type=float, default=30.0, help="edits per second for each sprite")
+    parser.add_argument("--frames", type=int, default=4, help="number of different frames each sprite cycles through")
+    parser.add_argument("--rename-every", type=float, default=0.0, help="seconds between rename bursts, 0 to never rename")
+    parser.add_argument("--rename-burst", type=int, default=1, help="number of sprites renamed in one burst")
+    parser.add_argument("--probe", type=float, default=0.1, help="seconds between latency probes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run for")
+    parser.add_argument("--shm", action="store_true", help="use shared memory slots if the server offers them")
+    parser.add_argument("--timestamps", action="store_true", help="send the time of sending with each message, for tracing")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    client = LoadClient(args)
+    asyncio.run(client.run())
+    print(client.stats.report())
+
+
+if __name__ == "__main__":
+    main()
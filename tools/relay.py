@@ -0,0 +1,484 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Relay that holds the connection to Aseprite while Blender is busy rendering, saving or loading a file.
+
+    python tools/relay.py --port 34613 --blender http://localhost:34614
+
+Aseprite connects to the relay like it would to Blender, and the relay connects to Blender, which is set to
+listen on another port. Frames from Aseprite are acked right away, and the latest one of each sprite is kept;
+Blender gets them as fast as it acks them, and the frames that come in the meantime replace the waiting ones.
+When Blender goes away, e.g. to open another file, the relay reconnects once it's back and sends it the latest
+frame of every sprite. The texture list is kept as well, so Aseprite gets it without waiting for Blender.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from os import path
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiohttp
+from aiohttp import web
+import numpy as np
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import fakebpy
+
+fakebpy.install()
+pribambase = fakebpy.import_addon()
+from pribambase.core import RGBA, INDEXED
+from pribambase.messaging import Handler, Handlers, add_data, add_id, add_string, add_uint, encode, handle
+from pribambase.sync import MAX_MESSAGE_SIZE, STREAM_CHUNK_SIZE
+
+
+# what the relay offers to Aseprite; the tiles and shared memory are for the last hop only, and it doesn't need them
+OPTIONS = {"version": "1", "ack": "1", "rects": "1", "max_message": str(MAX_MESSAGE_SIZE)}
+
+
+def message_formatted_image(name:str, size:Tuple[int, int], format:int, pixels:bytes) -> bytearray:
+    data = bytearray()
+    add_id(data, 'X')
+    add_uint(data, size[0], 2)
+    add_uint(data, size[1], 2)
+    add_string(data, name)
+    add_uint(data, format, 1)
+    add_data(data, pixels)
+    return data
+
+
+def message_palette(name:str, colors:bytes) -> bytearray:
+    data = bytearray()
+    add_id(data, 'P')
+    add_string(data, name)
+    add_data(data, colors)
+    return data
+
+
+def message_sequenced(seq:int, msg) -> bytearray:
+    data = bytearray()
+    add_id(data, 'Q')
+    add_uint(data, seq, 4)
+    add_data(data, msg)
+    return data
+
+
+# messages from blender, that the relay reads on the way
+
+class Ack(Handler):
+    id = 'Y'
+
+    def parse(self, args):
+        args.name = self.take_str()
+        args.seq = self.take_uint(4)
+
+
+class TextureList(Handler):
+    id = 'L'
+
+    def parse(self, args):
+        args.names = []
+        while not self.at_end():
+            args.names.append(self.take_str())
+
+
+class TexturesAdded(TextureList):
+    id = 'A'
+
+
+class TexturesRemoved(TextureList):
+    id = 'D'
+
+
+class TextureRenamed(Handler):
+    id = 'R'
+
+    def parse(self, args):
+        args.old_name = self.take_str()
+        args.new_name = self.take_str()
+
+
+class Sprite:
+    """The latest state of a sprite, and where it is on the way to blender"""
+
+    def __init__(self, name:str):
+        self.name = name
+        self.size = (0, 0)
+        self.format = RGBA
+        self.pixels:np.ndarray = None
+        self.palette:bytes = None
+        # created in aseprite, and blender hasn't got it yet
+        self.new = False
+        # changed since it was last sent
+        self.dirty = False
+        # sequence number of the frame that blender hasn't acked yet, and when it was sent
+        self.seq = 0
+        self.sent = 0.0
+
+
+    def messages(self, seq:int) -> List[bytearray]:
+        """Everything blender needs to show the sprite; the last message is numbered, and big frames come in chunks"""
+        if self.format == RGBA and not self.new and self.pixels.nbytes > STREAM_CHUNK_SIZE:
+            # the number is unique enough to be the stream id too
+            parts = encode.image_stream(self.name, self.size, self.pixels.data, seq, STREAM_CHUNK_SIZE)
+            parts[-1] = message_sequenced(seq, parts[-1])
+            return parts
+
+        if self.format == RGBA:
+            msg = encode.image(self.name, self.size, self.pixels.data)
+            if self.new:
+                msg[0:1] = b'N'
+        else:
+            msg = message_formatted_image(self.name, self.size, self.format, self.pixels.data)
+            if self.format == INDEXED and self.palette is not None:
+                # the palette goes first, indexed images need it
+                msg = encode.batch((message_palette(self.name, self.palette), msg))
+
+        return [message_sequenced(seq, msg)]
+
+
+class Stats:
+    def __init__(self):
+        self.received = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.reconnects = 0
+
+
+    def report(self) -> str:
+        return f"frames received {self.received}, coalesced {self.coalesced}, sent {self.sent} ({self.sent_bytes / 1048576:.1f} MB), blender connections {self.reconnects}"
+
+
+class AsepriteClient:
+    def __init__(self, ws:web.WebSocketResponse):
+        self.ws = ws
+        self.options:Dict[str, str] = {}
+        # unfinished chunked images by stream id, as (name, size, rows, pixels)
+        self.streams:Dict[int, Tuple[str, Tuple[int, int], int, np.ndarray]] = {}
+
+
+class Relay:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.sprites:Dict[str, Sprite] = {}
+        self.textures:List[str] = []
+        self.clients:Set[AsepriteClient] = set()
+        # messages for blender that go in order, before the frames
+        self.control:List[bytes] = []
+        self.blender:Optional[aiohttp.ClientWebSocketResponse] = None
+        self._in_flight:Dict[int, Sprite] = {}
+        self._seq = 0
+        self._wake = asyncio.Event()
+
+        self.from_aseprite = Handlers()
+        for msg in (handle.Batch, handle.Sequenced, handle.Timestamp, handle.Hello, handle.Image, handle.NewImage,
+                handle.FormattedImage, handle.Palette, handle.StreamBegin, handle.StreamChunk, handle.StreamEnd,
+                handle.ChangeName, handle.TextureList):
+            self.from_aseprite.add(msg)
+
+        self.from_blender = Handlers()
+        for msg in (handle.Batch, handle.Hello, Ack, TextureList, TexturesAdded, TexturesRemoved, TextureRenamed):
+            self.from_blender.add(msg)
+
+
+    async def run(self):
+        server = web.Server(self._receive)
+        runner = web.ServerRunner(server)
+        await runner.setup()
+        site = web.TCPSite(runner, self.args.host, self.args.port)
+        await site.start()
+        print(f"Waiting for Aseprite at {self.args.host}:{self.args.port}, relaying to {self.args.blender}")
+
+        try:
+            await asyncio.gather(self._connect_blender(), self._send_blender())
+        finally:
+            await runner.cleanup()
+
+
+    # aseprite side
+
+    async def _receive(self, request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE)
+        await ws.prepare(request)
+
+        client = AsepriteClient(ws)
+        self.clients.add(client)
+        print("Aseprite connected")
+
+        await ws.send_bytes(bytes(encode.hello(OPTIONS)))
+        await ws.send_bytes(bytes(encode.texture_list(self.textures)))
+
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    self._from_aseprite(client, msg.data)
+        finally:
+            self.clients.discard(client)
+            print("Aseprite disconnected")
+
+        return ws
+
+
+    def _from_aseprite(self, client:AsepriteClient, data, seq:int=0):
+        id = chr(data[0])
+        if id not in "[Q@HINXPBKECL":
+            # nothing to keep track of, blender gets it as is
+            self._control(bytes(data))
+            return
+
+        msg, args = self.from_aseprite.parse(data)
+
+        if id == '[':
+            for part in args.messages:
+                self._from_aseprite(client, part, seq)
+        elif id == 'Q':
+            self._from_aseprite(client, args.message, args.seq)
+        elif id == '@':
+            self._from_aseprite(client, args.message, seq)
+        elif id == 'H':
+            client.options = args.options
+        elif id in "IN":
+            self._frame(client, seq, args.name, args.size, RGBA, args.data, new=(id == 'N'))
+        elif id == 'X':
+            self._frame(client, seq, args.name, args.size, args.format, args.data)
+        elif id == 'P':
+            sprite = self._sprite(args.name)
+            sprite.palette = bytes(args.colors)
+            # the image is recolored with the indices blender already has, if it has any
+            sprite.dirty = sprite.pixels is not None
+            self._ack(client, args.name, seq)
+            self._wake.set()
+        elif id == 'B':
+            w, h = args.size
+            # a newer frame supersedes the unfinished transfer of the same image
+            for stream, (name, *_) in tuple(client.streams.items()):
+                if name == args.name:
+                    del client.streams[stream]
+            client.streams[args.stream] = args.name, args.size, 0, np.empty(w * h * 4, dtype=np.ubyte)
+        elif id == 'K':
+            s = client.streams.get(args.stream)
+            if s is not None:
+                name, size, rows, pixels = s
+                stride = size[0] * 4
+                pixels[args.row * stride:args.row * stride + args.data.size] = args.data
+                client.streams[args.stream] = name, size, rows + args.data.size // stride, pixels
+        elif id == 'E':
+            s = client.streams.pop(args.stream, None)
+            if s is not None:
+                name, size, rows, pixels = s
+                if rows == size[1]:
+                    self._frame(client, seq, name, size, RGBA, pixels)
+                else:
+                    self._ack(client, name, seq)
+        elif id == 'C':
+            sprite = self.sprites.pop(args.old_name, None)
+            if sprite is not None:
+                sprite.name = args.new_name
+                self.sprites[args.new_name] = sprite
+            # the frames that wait are sent under the new name, so blender has to rename first
+            self._control(bytes(data))
+        elif id == 'L':
+            # blender sends the changes as they happen, the list is up to date
+            asyncio.ensure_future(client.ws.send_bytes(bytes(encode.texture_list(self.textures))))
+
+
+    def _sprite(self, name:str) -> Sprite:
+        sprite = self.sprites.get(name)
+        if sprite is None:
+            sprite = self.sprites[name] = Sprite(name)
+        return sprite
+
+
+    def _frame(self, client:AsepriteClient, seq:int, name:str, size:Tuple[int, int], format:int, pixels:np.ndarray, new=False):
+        sprite = self._sprite(name)
+        self.stats.received += 1
+        if sprite.dirty:
+            self.stats.coalesced += 1
+
+        sprite.size = size
+        sprite.format = format
+        sprite.pixels = pixels
+        # if blender didn't get the one that created it, this one does
+        sprite.new = sprite.new or new
+        sprite.dirty = True
+
+        # aseprite doesn't have to wait for blender
+        self._ack(client, name, seq)
+        self._wake.set()
+
+
+    def _ack(self, client:AsepriteClient, name:str, seq:int):
+        if "ack" in client.options and not client.ws.closed:
+            asyncio.ensure_future(client.ws.send_bytes(bytes(encode.ack(name, seq))))
+
+
+    def _control(self, msg:bytes):
+        # kept while blender is away too, e.g. renames have to get there before the frames with the new names
+        self.control.append(msg)
+        self._wake.set()
+
+
+    def _to_aseprite(self, msg:bytes):
+        for client in tuple(self.clients):
+            if msg[0:1] == b'U' and "rects" not in client.options:
+                continue
+            if not client.ws.closed:
+                asyncio.ensure_future(client.ws.send_bytes(msg))
+
+
+    # blender side
+
+    async def _connect_blender(self):
+        """Keep connecting to blender, it goes away when it loads another file"""
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    async with session.ws_connect(self.args.blender, max_msg_size=0) as ws:
+                        await self._read_blender(ws)
+                except (aiohttp.ClientError, OSError):
+                    pass
+
+                if self.blender is not None:
+                    print("Blender disconnected")
+                    self.blender = None
+
+                self._in_flight.clear()
+                for sprite in self.sprites.values():
+                    sprite.seq = 0
+                await asyncio.sleep(self.args.retry)
+
+
+    async def _read_blender(self, ws:aiohttp.ClientWebSocketResponse):
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                continue
+
+            data = msg.data
+            id = chr(data[0])
+
+            if id == 'H':
+                await ws.send_bytes(bytes(encode.hello({"ack": "1", "rects": "1"})))
+                self.blender = ws
+                self.stats.reconnects += 1
+                print("Blender connected")
+
+                # catch up on everything that happened while it was away
+                for sprite in self.sprites.values():
+                    sprite.dirty = sprite.pixels is not None
+                self._wake.set()
+
+            elif id == 'Y':
+                _, args = self.from_blender.parse(data)
+                sprite = self._in_flight.pop(args.seq, None)
+                if sprite is not None and sprite.seq == args.seq:
+                    sprite.seq = 0
+                    self._wake.set()
+
+            else:
+                self._textures(data)
+                self._to_aseprite(data)
+
+
+    def _textures(self, data):
+        """Keep the texture list up to date, from the list itself and the changes"""
+        id = chr(data[0])
+        if id not in "[LADR":
+            return
+
+        _, args = self.from_blender.parse(data)
+        if id == '[':
+            for part in args.messages:
+                self._textures(part)
+        elif id == 'L':
+            self.textures = args.names
+        elif id == 'A':
+            self.textures += [n for n in args.names if n not in self.textures]
+        elif id == 'D':
+            self.textures = [n for n in self.textures if n not in args.names]
+        elif id == 'R':
+            self.textures = [args.new_name if n == args.old_name else n for n in self.textures]
+
+
+    async def _send_blender(self):
+        """Send the latest frames as soon as blender is done with the previous ones"""
+        timeout = self.args.ack_timeout
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout / 2)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            ws = self.blender
+            if ws is None or ws.closed:
+                continue
+
+            try:
+                while self.control:
+                    await ws.send_bytes(self.control.pop(0))
+
+                now = time.perf_counter()
+                for sprite in tuple(self.sprites.values()):
+                    if sprite.seq and now - sprite.sent > timeout:
+                        # the ack got lost somewhere, don't wait for it forever
+                        self._in_flight.pop(sprite.seq, None)
+                        sprite.seq = 0
+
+                    if sprite.dirty and not sprite.seq:
+                        self._seq = self._seq % 0xffffffff + 1
+                        messages = sprite.messages(self._seq)
+                        sprite.seq, sprite.sent, sprite.dirty, sprite.new = self._seq, now, False, False
+                        self._in_flight[sprite.seq] = sprite
+                        self.stats.sent += 1
+                        for msg in messages:
+                            self.stats.sent_bytes += len(msg)
+                            await ws.send_bytes(bytes(msg))
+
+            except ConnectionError:
+                pass # reconnecting sends everything again
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost", help="address to wait for Aseprite at")
+    parser.add_argument("--port", type=int, default=34613, help="port to wait for Aseprite at")
+    parser.add_argument("--blender", default="http://localhost:34614", help="address of Blender's server")
+    parser.add_argument("--retry", type=float, default=0.5, help="seconds between attempts to connect to Blender")
+    parser.add_argument("--ack-timeout", type=float, default=10.0, help="seconds to wait for Blender to ack a frame before sending the next one anyway")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    relay = Relay(args)
+    try:
+        asyncio.run(relay.run())
+    except KeyboardInterrupt:
+        pass
+    print(relay.stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Soak test: keeps the sync server busy for hours and watches its memory.
+
+    python tools/soak.py --duration 8h -- --sprites 8 --rate 30
+    python tools/soak.py --duration 30m --interval 10 --csv soak.csv -- --shm
+    python tools/soak.py --url http://localhost:34613 --pid 12345 --duration 2h
+
+By default the server runs in this process on top of tools/fakebpy.py, with images that keep their
+pixels in numpy arrays, and tools/loadgen.py plays Aseprite in a subprocess; everything after `--`
+goes to loadgen. Every interval it samples the RSS, tracemalloc and the number of live objects by
+type, along with the sizes of the addon's caches and queues. The first sample after the warmup is
+the baseline, and the run fails if memory grows by more than the thresholds after it. The report
+lists the lines that allocated the most and the types that multiplied the most since the baseline.
+
+With --url, it drives a server that's already running, e.g. in Blender, and only the RSS of --pid
+is watched. That's the way to see undo steps and Blender's own image buffers, which the fake
+images don't have.
+"""
+
+import argparse
+import asyncio
+import csv
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from collections import Counter
+from os import path
+
+import numpy as np
+
+TOOLS = path.dirname(path.abspath(__file__))
+sys.path.insert(0, TOOLS)
+import fakebpy
+
+MB = 1024 * 1024
+
+# frames kept for each allocation, enough to tell the harness's own ones apart
+TRACE_FRAMES = 4
+
+
+def duration(text:str) -> float:
+    """Seconds from '90', '90s', '30m' or '8h'"""
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def rss(pid=None):
+    """Resident memory of the process in bytes, or None if there's no way to tell"""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+class FakePixels:
+    """Image.pixels, backed by a float array"""
+
+    def __init__(self, size):
+        self.array = np.zeros(size[0] * size[1] * 4, dtype=np.float32)
+
+
+    def foreach_set(self, values):
+        self.array[:] = values
+
+
+    def __setitem__(self, key, values):
+        self.array[key] = values
+
+
+    def __len__(self):
+        return self.array.size
+
+
+class FakeImage:
+    """Just the parts of bpy.types.Image that the sync touches"""
+
+    def __init__(self, name, w, h):
+        self.name = name
+        self.sb_source = ""
+        self.filepath = ""
+        self.packed_file = None
+        self.use_fake_user = False
+        self.has_data = True
+        self.size = [w, h]
+        self.pixels = FakePixels(self.size)
+
+
+    def as_pointer(self):
+        return id(self)
+
+
+    def scale(self, w, h):
+        self.size = [w, h]
+        self.pixels = FakePixels(self.size)
+
+
+    def save(self):
+        # new_packed_image() removes the file after packing
+        open(self.filepath, "wb").close()
+
+
+    def pack(self):
+        self.packed_file = True
+
+
+    def reload(self):
+        pass
+
+
+    def update(self):
+        pass
+
+
+    def update_tag(self):
+        pass
+
+
+class FakeImages(list):
+    def new(self, name, w, h, alpha=True):
+        img = FakeImage(name, w, h)
+        self.append(img)
+        return img
+
+
+def install_scene(pribambase, args):
+    """Give the fake bpy enough state for the server and the image updates to run"""
+    import bpy
+    from pribambase import util
+
+    prefs = types.SimpleNamespace(
+        localhost=True, port=args.port, unix_socket=False, tcp=True, socket_path="",
+        tile_size=args.tile_size, shm=args.shm, shm_path="", shm_slots=args.shm_slots,
+        record=False, record_dir="", profile_sessions=False, profile_seconds=10, profile_top=20,
+        skip_modal=True, autostart=False, startup_report=False)
+
+    bpy.context.preferences = types.SimpleNamespace(addons={pribambase.__name__: types.SimpleNamespace(preferences=prefs)})
+    bpy.context.window_manager = types.SimpleNamespace(is_interface_locked=False, windows=[])
+    bpy.data.images = FakeImages()
+
+    operator = util.SB_OT_update_image()
+
+    def update_image():
+        # in blender the operator runs from a modal timer, after the message handler is done
+        asyncio.get_event_loop().call_soon(operator.modal_execute, None)
+        return {'RUNNING_MODAL'}
+
+    bpy.ops = types.SimpleNamespace(pribambase=types.SimpleNamespace(
+        update_image=update_image,
+        report=lambda message_type='INFO', message="": None))
+
+
+def containers(pribambase) -> dict:
+    """Sizes of the caches and queues that could grow with the session"""
+    from pribambase import util
+    from pribambase.addon import addon
+    from pribambase.messaging import handle
+
+    sizes = {
+        "pending": len(util._pending),
+        "row_digests": len(util._row_digests),
+        "frames": len(handle._frames),
+        "palettes": len(handle._palettes),
+        "indices": len(handle._indices),
+        "streams": len(handle._streams),
+        "trace_events": len(addon.tracer.events),
+        "images": len(__import__("bpy").data.images),
+    }
+
+    if addon.server_up:
+        clients = list(addon.server.clients)
+        sizes["clients"] = len(clients)
+        sizes["send_queue"] = sum(c._queue.qsize() for c in clients)
+        sizes["sprites"] = sum(len(c.sprites) for c in clients)
+        for name in ("frames", "palettes", "indices", "streams"):
+            sizes[name] += sum(len(getattr(c, name)) for c in clients)
+
+    sizes["tasks"] = len(asyncio.all_tasks())
+    return sizes
+
+
+def object_counts() -> Counter:
+    gc.collect()
+    return Counter(type(o).__name__ for o in gc.get_objects())
+
+
+class Sample:
+    def __init__(self, elapsed, rss, traced, objects, sizes):
+        self.elapsed = elapsed
+        self.rss = rss
+        self.traced = traced
+        self.objects = objects
+        self.sizes = sizes
+
+
+    def row(self) -> dict:
+        row = {
+            "elapsed": round(self.elapsed, 1),
+            "rss_mb": round(self.rss / MB, 2) if self.rss is not None else "",
+            "traced_mb": round(self.traced / MB, 2) if self.traced is not None else "",
+            "objects": sum(self.objects.values()) if self.objects else "",
+        }
+        row.update(self.sizes)
+        return row
+
+
+def slope(samples, key) -> float:
+    """Least squares growth per hour"""
+    points = [(s.elapsed, key(s)) for s in samples if key(s) is not None]
+    if len(points) < 2:
+        return 0.0
+    t, v = np.array(points, dtype=np.float64).T
+    return float(np.polyfit(t, v, 1)[0]) * 3600
+
+
+class Soak:
+    def __init__(self, args, loadgen_args):
+        self.args = args
+        self.loadgen_args = loadgen_args
+        self.external = bool(args.url)
+        self.pribambase = None
+        self.samples = []
+        self.baseline:Sample = None
+        self.baseline_snapshot = None
+        self.baseline_objects = None
+        self.final_snapshot = None
+        self._start = 0.0
+        self._csv = None
+
+
+    def start_server(self):
+        fakebpy.install()
+        self.pribambase = fakebpy.import_addon()
+        install_scene(self.pribambase, self.args)
+
+        from pribambase import async_loop
+        from pribambase.addon import addon
+        async_loop.setup_asyncio_executor()
+        addon.start_server()
+
+
+    def stop_server(self):
+        from pribambase.addon import addon
+        if addon.server_up:
+            addon.stop_server()
+
+
+    def sample(self) -> Sample:
+        elapsed = time.perf_counter() - self._start
+
+        if self.external:
+            return Sample(elapsed, rss(self.args.pid) if self.args.pid else None, None, None, {})
+
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        objects = object_counts() if not self.args.no_objects else None
+        return Sample(elapsed, rss(), traced, objects, containers(self.pribambase))
+
+
+    def record(self, s:Sample):
+        self.samples.append(s)
+        row = s.row()
+
+        if self.args.csv:
+            if self._csv is None:
+                f = open(self.args.csv, "w", newline="")
+                self._csv = f, csv.DictWriter(f, fieldnames=list(row.keys()), extrasaction="ignore")
+                self._csv[1].writeheader()
+            self._csv[1].writerow(row)
+            self._csv[0].flush()
+
+        print("  ".join(f"{k}={v}" for k, v in row.items()), flush=True)
+
+
+    async def loadgen(self, seconds):
+        url = self.args.url or f"http://localhost:{self.args.port}"
+        cmd = [sys.executable, path.join(TOOLS, "loadgen.py"), "--url", url, "--duration", str(seconds)]
+        if self.args.shm:
+            cmd.append("--shm")
+        return await asyncio.create_subprocess_exec(*cmd, *self.loadgen_args)
+
+
+    async def run(self):
+        args = self.args
+        self._start = time.perf_counter()
+        client = await self.loadgen(args.warmup + args.duration)
+
+        # let the caches fill up and the allocator settle before taking the baseline
+        await asyncio.sleep(args.warmup)
+        self.baseline = self.sample()
+        if tracemalloc.is_tracing():
+            self.baseline_snapshot = tracemalloc.take_snapshot()
+        self.baseline_objects = self.baseline.objects
+        self.record(self.baseline)
+
+        end = self._start + args.warmup + args.duration
+        while client.returncode is None and time.perf_counter() < end:
+            try:
+                await asyncio.wait_for(client.wait(), timeout=min(args.interval, max(0.0, end - time.perf_counter())))
+            except asyncio.TimeoutError:
+                pass
+            self.record(self.sample())
+
+        if client.returncode is None:
+            await client.wait()
+
+        # the server should have drained everything by now, so the last sample counts what's left over
+        await asyncio.sleep(1.0)
+        if tracemalloc.is_tracing():
+            self.final_snapshot = tracemalloc.take_snapshot()
+        self.record(self.sample())
+
+        if self._csv:
+            self._csv[0].close()
+
+        return client.returncode
+
+
+    def report(self) -> bool:
+        """Print the summary, returns False if the memory grew more than allowed"""
+        args = self.args
+        first, last = self.baseline, self.samples[-1]
+        tail = self.samples[self.samples.index(first):]
+        ok = True
+
+        def check(label, before, after, limit, rate):
+            nonlocal ok
+            if before is None or after is None:
+                return
+            growth = after - before
+            failed = limit is not None and growth > limit
+            ok = ok and not failed
+            print(f"{label:<12}{before:>12.1f} -> {after:>10.1f}  growth {growth:>+9.1f} ({rate:+.1f}/h)  limit {limit}  {'FAIL' if failed else 'ok'}")
+
+        print(f"\nafter {last.elapsed - first.elapsed:.0f} s from the baseline:")
+        mb = lambda v: v / MB if v is not None else None
+        check("rss MB", mb(first.rss), mb(last.rss), args.max_rss, slope(tail, lambda s: mb(s.rss)))
+        check("traced MB", mb(first.traced), mb(last.traced), args.max_traced, slope(tail, lambda s: mb(s.traced)))
+        if first.objects and last.objects:
+            count = lambda s: sum(s.objects.values())
+            check("objects", count(first), count(last), args.max_objects, slope(tail, count))
+
+        grown = {k: (first.sizes.get(k, 0), v) for k, v in last.sizes.items() if v > first.sizes.get(k, 0)}
+        if grown:
+            print("\ncontainers that grew: " + ", ".join(f"{k} {a} -> {b}" for k, (a, b) in grown.items()))
+
+        if first.objects and last.objects:
+            diff = (last.objects - first.objects).most_common(args.top)
+            if diff:
+                print("\nlive objects added, by type:")
+                for name, n in diff:
+                    print(f"  {n:>+9}  {name}")
+
+        if self.baseline_snapshot is not None and self.final_snapshot is not None:
+            # leave out the harness itself; the server's stacks start deeper in the event loop than the frames kept
+            ignore = (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__, all_frames=True),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            )
+            snapshot = self.final_snapshot.filter_traces(ignore)
+            stats = snapshot.compare_to(self.baseline_snapshot.filter_traces(ignore), "traceback" if args.traceback > 1 else "lineno")
+            stats = [s for s in stats if s.size_diff > 0][:args.top]
+            if stats:
+                print("\nallocations added since the baseline:")
+                for s in stats:
+                    # the line that allocated first, then its callers
+                    frames = list(reversed(s.traceback))[:args.traceback]
+                    print(f"  {s.size_diff / 1024:>+10.1f} KiB {s.count_diff:>+8} blocks  {frames[0].filename}:{frames[0].lineno}")
+                    for frame in frames[1:]:
+                        print(f"  {'':>31}  {frame.filename}:{frame.lineno}")
+
+        return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=duration, default=duration("1h"), help="how long to run after the warmup, e.g. 600, 30m or 8h")
+    parser.add_argument("--warmup", type=duration, default=60.0, help="seconds before the baseline sample")
+    parser.add_argument("--interval", type=duration, default=60.0, help="seconds between samples")
+    parser.add_argument("--port", type=int, default=34699, help="port of the in-process server")
+    parser.add_argument("--tile-size", type=int, default=0, help="offer tiles of that size to the client, 0 to send whole frames")
+    parser.add_argument("--shm", action="store_true", help="use shared memory slots")
+    parser.add_argument("--shm-slots", type=int, default=3)
+    parser.add_argument("--url", default="", help="drive a running server instead of the in-process one")
+    parser.add_argument("--pid", type=int, default=0, help="with --url, the process whose RSS is watched")
+    parser.add_argument("--max-rss", type=float, default=64.0, help="MB the RSS may grow after the baseline")
+    parser.add_argument("--max-traced", type=float, default=16.0, help="MB the python allocations may grow after the baseline")
+    parser.add_argument("--max-objects", type=int, default=20000, help="live objects that may be added after the baseline")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="tracemalloc slows everything down quite a bit")
+    parser.add_argument("--no-objects", action="store_true", help="don't count live objects, it's slow with lots of them")
+    parser.add_argument("--traceback", type=int, default=1, help="frames kept for each allocation")
+    parser.add_argument("--top", type=int, default=15, help="lines in the allocation and object lists")
+    parser.add_argument("--csv", default="", help="also write the samples to a csv file")
+
+    argv = sys.argv[1:] if argv is None else argv
+    # the rest goes to loadgen
+    if "--" in argv:
+        i = argv.index("--")
+        argv, rest = argv[:i], argv[i + 1:]
+    else:
+        rest = []
+    return parser.parse_args(argv), rest
+
+
+def main(argv=None):
+    args, loadgen_args = parse_args(argv)
+    soak = Soak(args, loadgen_args)
+
+    if not soak.external:
+        if not args.no_tracemalloc:
+            tracemalloc.start(max(TRACE_FRAMES, args.traceback))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        soak.start_server()
+    else:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    try:
+        code = loop.run_until_complete(soak.run())
+    except KeyboardInterrupt:
+        code = 0
+    finally:
+        if not soak.external:
+            soak.stop_server()
+
+    if code:
+        print(f"loadgen exited with {code}", file=sys.stderr)
+
+    ok = soak.report() if soak.baseline else False
+    sys.exit(0 if ok and not code else 1)
+
+
+if __name__ == "__main__":
+    main()
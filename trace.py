@@ -0,0 +1,102 @@
+# Copyright (c) 2021 lampysprites
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Message tracing in the chrome trace event format, which chrome://tracing and ui.perfetto.dev can open.
+# Doesn't depend on blender, so that the tools can use it too
+
+import json
+import threading
+from collections import deque
+from contextvars import ContextVar
+from time import perf_counter, time
+from typing import Optional
+
+
+# id of the message that's being handled, 0 outside of messages or when not tracing
+current:ContextVar[int] = ContextVar("pribambase_trace", default=0)
+
+
+class Tracer:
+    """Collects spans while enabled; when not, recording is a single check"""
+
+    def __init__(self, limit:int=200000):
+        self.enabled = False
+        self.events = deque(maxlen=limit)
+        self._next_id = 1
+        # spans come from the worker threads too
+        self._lock = threading.Lock()
+        # to put the client's wall clock times on the same timeline
+        self._epoch = time() - perf_counter()
+
+
+    def start(self):
+        with self._lock:
+            self.events.clear()
+        self._epoch = time() - perf_counter()
+        self.enabled = True
+
+
+    def stop(self):
+        self.enabled = False
+
+
+    def new_id(self) -> int:
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+        return id
+
+
+    def from_wall_clock(self, seconds:float) -> float:
+        """Convert time.time() of the same machine to perf_counter()"""
+        return seconds - self._epoch
+
+
+    def span(self, name:str, start:float, end:float, trace:Optional[int]=None):
+        """Work done on the current thread, times from perf_counter()"""
+        event = {
+            "name": name,
+            "cat": "sync",
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": 1,
+            "tid": threading.get_ident(),
+            "args": {"trace": current.get() if trace is None else trace}}
+        with self._lock:
+            self.events.append(event)
+
+
+    def async_span(self, name:str, start:float, end:float, trace:int):
+        """Time that one message spends somewhere, like waiting in a queue; shows as a separate track for the message"""
+        with self._lock:
+            for ph, ts in (("b", start), ("e", end)):
+                self.events.append({"name": name, "cat": "message", "ph": ph, "ts": ts * 1e6, "pid": 1, "id": trace})
+
+
+    def as_dict(self):
+        with self._lock:
+            events = list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+    def export(self, filepath:str):
+        with open(filepath, "w") as f:
+            json.dump(self.as_dict(), f)
@@ -19,15 +19,10 @@
 # SOFTWARE.
 
 import bpy
-import bmesh
-import gpu
-import bgl
-from mathutils import Matrix
-from gpu_extras.batch import batch_for_shader
-import numpy as np
 from os import path
 
 from .messaging import encode
+from . import core
 from . import util
 from .addon import addon
 
@@ -43,6 +38,118 @@ UV_DEST = [
 ]
 
 
+def list_uv(objects, selected_only=True):
+    """
+    UV edges of the objects' faces, as an (n, 2, 2) array of end points, and the names of the objects that have no UV
+    map to draw
+    """
+    import numpy as np
+
+    edges = []
+    skipped = []
+
+    for obj in objects:
+        if obj.mode == 'EDIT':
+            # copy edit mode changes to the mesh, then it can be read in bulk instead of going over the bmesh
+            obj.update_from_editmode()
+
+        mesh = obj.data
+        uv_layer = mesh.uv_layers.active
+        if uv_layer is None:
+            skipped.append(obj.name)
+            continue
+
+        uv = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", uv)
+
+        count = len(mesh.polygons)
+        loop_start = np.empty(count, dtype=np.int32)
+        loop_total = np.empty(count, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_start)
+        mesh.polygons.foreach_get("loop_total", loop_total)
+        select = None
+        if selected_only:
+            select = np.empty(count, dtype=bool)
+            mesh.polygons.foreach_get("select", select)
+
+        edges.append(core.uv_edges(uv, loop_start, loop_total, select))
+
+    if not edges:
+        return np.empty((0, 2, 2), dtype=np.float32), skipped
+
+    # objects can share the UV layout
+    return core.unique_edges(np.concatenate(edges).reshape(-1, 4)), skipped
+
+
+def draw_uv(edges, w, h, color, weight, aa=False):
+    """Draw the UV edges into (h, w, 4) RGBA bytes going top to bottom, on the GPU if there's one"""
+    import numpy as np
+
+    lines = tuple(color[0:3]) + (1.0,)
+
+    try:
+        import gpu
+        import bgl
+        from mathutils import Matrix
+        from gpu_extras.batch import batch_for_shader
+
+        offscreen = gpu.types.GPUOffScreen(w, h)
+    except Exception:
+        # background mode has no GPU context
+        return core.draw_lines(edges, w, h, [int(c * 255) for c in lines], weight)
+
+    nbuf = np.zeros((h, w, 4), dtype=np.uint8)
+    shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
+    batch = batch_for_shader(shader, 'LINES', {"pos": edges.reshape(-1, 2)})
+
+    with offscreen.bind():
+        with gpu.matrix.push_pop():
+            # see explanation in https://blender.stackexchange.com/questions/153697/gpu-python-module-why-drawed-pixels-are-shifted-in-the-result-image
+            projection_matrix = Matrix.Diagonal((2.0, -2.0, 1.0))
+            projection_matrix = Matrix.Translation((-1.0, 1.0, 0.0)) @ projection_matrix.to_4x4()
+            gpu.matrix.load_projection_matrix(projection_matrix)
+
+            bgl.glEnable(bgl.GL_BLEND)
+            bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+            bgl.glLineWidth(weight)
+
+            if aa:
+                bgl.glEnable(bgl.GL_BLEND)
+                bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+                bgl.glEnable(bgl.GL_LINE_SMOOTH)
+                bgl.glHint(bgl.GL_LINE_SMOOTH_HINT, bgl.GL_NICEST)
+            else:
+                bgl.glDisable(bgl.GL_BLEND)
+                bgl.glDisable(bgl.GL_LINE_SMOOTH)
+                bgl.glHint(bgl.GL_LINE_SMOOTH_HINT, bgl.GL_FASTEST)
+
+            shader.bind()
+            shader.uniform_float("color", lines)
+            batch.draw(shader)
+
+        # retrieve the texture
+        # https://blender.stackexchange.com/questions/221110/fastest-way-copying-from-bgl-buffer-to-numpy-array
+        buffer = bgl.Buffer(bgl.GL_BYTE, nbuf.shape, nbuf)
+        bgl.glReadPixels(0, 0, w, h, bgl.GL_RGBA, bgl.GL_UNSIGNED_BYTE, buffer)
+
+    offscreen.free()
+    return nbuf
+
+
+def send_uv_map(pixels, size, source=""):
+    """Send the drawn UV map to the aseprite that has the sprite open, or the current one"""
+    msg = encode.uv_map(
+            size=size,
+            sprite=source,
+            pixels=pixels.tobytes(),
+            layer=addon.prefs.uv_layer,
+            opacity=int(addon.prefs.uv_color[3] * 255))
+    if source:
+        msg = encode.batch((encode.sprite_focus(source), msg))
+
+    addon.server.send(msg, client=addon.server.client_for(source))
+
+
 class SB_OT_send_uv(bpy.types.Operator):
     bl_idname = "pribambase.set_uv"
     bl_label = "Send UV"
@@ -86,53 +193,6 @@ class SB_OT_send_uv(bpy.types.Operator):
         return addon.connected and context.edit_object is not None or context.image_paint_object is not None
 
 
-    def list_uv(self):
-        ctx = bpy.context
-        active = ctx.object
-        lines = set()
-
-        objects = [obj for obj in ctx.selected_objects if obj.type == 'MESH']
-        if (active is not None) and (active not in objects) and (active.type == 'MESH'):
-            objects.append(ctx.object)
-
-        for obj in objects:
-
-            try:
-                bm = bmesh.from_edit_mesh(obj.data)
-                bm_created = False # freeing an editmode bmesh crashes blender
-            except: # if there's `elif`, why isn't there `exceptry`?
-                try:
-                    bm = bmesh.new()
-                    bm_created = True
-                    bm.from_mesh(obj.data)
-                except:
-                    self.report('WARNING', "UVMap drawing skipped: can't access mesh data")
-                    continue
-
-            uv = bm.loops.layers.uv.active
-
-            # get all edges
-            for face in bm.faces:
-                if not face.select:
-                    continue
-
-                for i in range(0, len(face.loops)):
-                    a = face.loops[i - 1][uv].uv.to_tuple()
-                    b = face.loops[i][uv].uv.to_tuple()
-
-                    # sorting prevents the edge from being added twice for differently directed loops
-                    # order doesn't really matter, just that there is one
-                    if a > b:
-                        a, b = b, a
-
-                    lines.add((a, b))
-
-            if bm_created:
-                bm.free()
-
-        return lines
-
-
     def uvmap_size(self):
         scale = addon.prefs.uv_scale
         size = [128, 128]
@@ -154,58 +214,17 @@ class SB_OT_send_uv(bpy.types.Operator):
                 self.report({"ERROR"}, "'Texture Source' only works with a file-associated texture")
                 return {'CANCELLED'}
 
-        aa = addon.prefs.uv_aa
-        weight = self.weight
-        lines = self.color[0:3] + (1.0,)
-        nbuf = np.zeros((h, w, 4), dtype=np.uint8)
-
-        offscreen = gpu.types.GPUOffScreen(w, h)
-
-        coords = [c for pt in self.list_uv() for c in pt]
-        shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
-        batch = batch_for_shader(shader, 'LINES', {"pos": coords})
-
-        with offscreen.bind():
-            with gpu.matrix.push_pop():
-                # see explanation in https://blender.stackexchange.com/questions/153697/gpu-python-module-why-drawed-pixels-are-shifted-in-the-result-image
-                projection_matrix = Matrix.Diagonal((2.0, -2.0, 1.0))
-                projection_matrix = Matrix.Translation((-1.0, 1.0, 0.0)) @ projection_matrix.to_4x4()
-                gpu.matrix.load_projection_matrix(projection_matrix)
+        active = context.object
+        objects = [obj for obj in context.selected_objects if obj.type == 'MESH']
+        if (active is not None) and (active not in objects) and (active.type == 'MESH'):
+            objects.append(active)
 
-                bgl.glEnable(bgl.GL_BLEND)
-                bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
-                bgl.glLineWidth(weight)
-
-                if aa:
-                    bgl.glEnable(bgl.GL_BLEND)
-                    bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
-                    bgl.glEnable(bgl.GL_LINE_SMOOTH)
-                    bgl.glHint(bgl.GL_LINE_SMOOTH_HINT, bgl.GL_NICEST)
-                else:
-                    bgl.glDisable(bgl.GL_BLEND)
-                    bgl.glDisable(bgl.GL_LINE_SMOOTH)
-                    bgl.glHint(bgl.GL_LINE_SMOOTH_HINT, bgl.GL_FASTEST)
-
-                shader.bind()
-                shader.uniform_float("color", lines)
-                batch.draw(shader)
-
-            # retrieve the texture
-            # https://blender.stackexchange.com/questions/221110/fastest-way-copying-from-bgl-buffer-to-numpy-array
-            buffer = bgl.Buffer(bgl.GL_BYTE, nbuf.shape, nbuf)
-            bgl.glReadPixels(0, 0, w, h, bgl.GL_RGBA, bgl.GL_UNSIGNED_BYTE, buffer)
-
-        # send data
-        msg = encode.uv_map(
-                size=(w, h),
-                sprite=source,
-                pixels=nbuf.tobytes(),
-                layer=addon.prefs.uv_layer,
-                opacity=int(addon.prefs.uv_color[3] * 255))
-        if source:
-            msg = encode.batch((encode.sprite_focus(source), msg))
+        edges, skipped = list_uv(objects)
+        for name in skipped:
+            self.report({'WARNING'}, f"UVMap drawing skipped: {name} has no UV map")
 
-        addon.server.send(msg)
+        pixels = draw_uv(edges, w, h, self.color, self.weight, addon.prefs.uv_aa)
+        send_uv_map(pixels, (w, h), source)
 
         return {"FINISHED"}
 
@@ -224,10 +243,21 @@ class SB_OT_send_uv(bpy.types.Operator):
 
 
 
+def can_open(source) -> bool:
+    """Aseprite files can be read without Aseprite, other formats need it to load them"""
+    return addon.connected or util.is_aseprite(source)
+
+
+def load_sprite(source):
+    """Fill the texture from the .aseprite file right away, Aseprite will send its version later if it's connected"""
+    if util.is_aseprite(source):
+        util.load_sprites(img for img in bpy.data.images if img.sb_source == source)
+
+
 class SB_OT_open_sprite(bpy.types.Operator):
     bl_idname = "pribambase.open_sprite"
     bl_label = "Open..."
-    bl_description = "Set up a texture from a file using Aseprite"
+    bl_description = "Set up a texture from a file using Aseprite. Aseprite files can be opened without it"
     bl_options = {'REGISTER', 'UNDO'}
 
 
@@ -238,16 +268,15 @@ class SB_OT_open_sprite(bpy.types.Operator):
     use_filter: bpy.props.BoolProperty(default=True, options={'HIDDEN'})
 
 
-    @classmethod
-    def poll(self, context):
-        return addon.connected
-
-
     def execute(self, context):
         source = bpy.path.abspath(self.filepath)
         _, name = path.split(source)
         img = None
 
+        if not can_open(source):
+            self.report({'ERROR'}, "Only .ase/.aseprite files can be opened while Aseprite is not connected")
+            return {'CANCELLED'}
+
         for i in bpy.data.images:
             # we might have this image opened already
             if i.sb_source == source:
@@ -262,8 +291,11 @@ class SB_OT_open_sprite(bpy.types.Operator):
         if context.area.type == 'IMAGE_EDITOR':
             context.area.spaces.active.image = img
 
-        msg = encode.sprite_open(source)
-        addon.server.send(msg)
+        load_sprite(source)
+
+        if addon.connected:
+            msg = encode.sprite_open(source)
+            addon.server.send(msg, client=addon.server.client_for(source))
 
         return {'FINISHED'}
 
@@ -349,23 +381,20 @@ class SB_OT_edit_sprite(bpy.types.Operator):
 
 
     def execute(self, context):
+        import numpy as np
+
         img = context.edit_image
         edit_name = util.image_name(img)
-        msg = None
+        client = addon.server.client_for(edit_name)
 
         if path.exists(edit_name):
-            msg = encode.sprite_open(name=edit_name)
+            addon.server.send(encode.sprite_open(name=edit_name), client=client)
         else:
             pixels = np.asarray(np.array(img.pixels) * 255, dtype=np.ubyte)
             pixels.shape = (img.size[1], pixels.size // img.size[1])
             pixels = np.ravel(pixels[::-1,:])
 
-            msg = encode.image(
-                name=img.name,
-                size=img.size,
-                pixels=pixels.tobytes())
-
-        addon.server.send(msg)
+            addon.server.send_image(img.name, tuple(img.size), pixels.tobytes(), client=client)
 
         return {'FINISHED'}
 
@@ -383,24 +412,21 @@ class SB_OT_edit_sprite_copy(bpy.types.Operator):
 
 
     def execute(self, context):
+        import numpy as np
+
         img = context.edit_image
 
         pixels = np.asarray(np.array(img.pixels) * 255, dtype=np.ubyte)
         pixels.shape = (img.size[1], pixels.size // img.size[1])
         pixels = np.ravel(pixels[::-1,:])
 
-        msg = encode.image(
-            name="",
-            size=img.size,
-            pixels=pixels.tobytes())
-
-        addon.server.send(msg)
+        addon.server.send_image("", tuple(img.size), pixels.tobytes())
 
         return {'FINISHED'}
 
 
 class SB_OT_replace_sprite(bpy.types.Operator):
-    bl_description = "Replace current texture with a file using Aseprite"
+    bl_description = "Replace current texture with a file using Aseprite. Aseprite files can be loaded without it"
     bl_idname = "pribambase.replace_sprite"
     bl_label = "Replace..."
     bl_options = {'REGISTER', 'UNDO'}
@@ -413,13 +439,21 @@ class SB_OT_replace_sprite(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        return addon.connected and context.area.type == 'IMAGE_EDITOR'
+        return context.area.type == 'IMAGE_EDITOR' and context.edit_image is not None
 
     def execute(self, context):
         source = bpy.path.abspath(self.filepath)
+
+        if not can_open(source):
+            self.report({'ERROR'}, "Only .ase/.aseprite files can be opened while Aseprite is not connected")
+            return {'CANCELLED'}
+
         context.edit_image.sb_source = source
-        msg = encode.sprite_open(source)
-        addon.server.send(msg)
+        load_sprite(source)
+
+        if addon.connected:
+            msg = encode.sprite_open(source)
+            addon.server.send(msg, client=addon.server.client_for(source))
 
         return {'FINISHED'}
 
@@ -20,26 +20,65 @@
 
 import bpy
 from .addon import addon
-import numpy as np
+from . import core
 from math import pi
+from os import path
 
 
-def scale_image(image, scale):
-    """Scale image in-place without filtering"""
+def image_pixels(image):
+    """Blender's float pixels of the image, as a flat array"""
+    import numpy as np
+
+    w, h = image.size
+    try:
+        # version >= 2.83
+        px = np.empty(w * h * 4, dtype=np.float32)
+        image.pixels.foreach_get(px)
+    except:
+        # version < 2.83
+        px = np.array(image.pixels, dtype=np.float32)
+    return px
+
+
+def scale_image(image, scale, px=None):
+    """Scale image in-place without filtering. The pixels can be scaled beforehand with core.scale_pixels()"""
     w, h = image.size
-    px = np.array(image.pixels, dtype=np.float32)
-    px.shape = (w, h, 4)
+    if px is None:
+        px = core.scale_pixels(image_pixels(image), w, h, scale)
     image.scale(w * scale, h * scale)
-    px = px.repeat(scale, 0).repeat(scale, 1)
     try:
         # version >= 2.83
-        image.pixels.foreach_set(px.ravel())
+        image.pixels.foreach_set(px)
     except:
         # version < 2.83
-        image.pixels[:] = px.ravel()
+        image.pixels[:] = px
     image.update()
 
 
+def add_reference(image, scale=10, opacity=0.33, selectable=True, collection=None, grid_scale=1.0, px=None):
+    """
+    Create an image empty showing the loaded image, prescaled so that its pixels line up with the view grid. Doesn't
+    need context, the empty goes to the scene collection if no other is given
+    """
+    w, h = image.size
+    scale_image(image, scale, px)
+    image.sb_scale = scale
+
+    ref = bpy.data.objects.new(image.name, None)
+    ref.rotation_euler = (pi/2, 0, 0)
+    ref.empty_display_type = 'IMAGE'
+    ref.data = image
+    ref.use_empty_image_alpha = opacity < 1.0
+    ref.color[3] = opacity
+    ref.empty_display_size = max(w, h) * grid_scale
+    ref.hide_select = not selectable
+
+    if collection is None:
+        collection = bpy.context.scene.collection
+    collection.objects.link(ref)
+    return ref
+
+
 class SB_OT_reference_add(bpy.types.Operator):
     bl_idname = "pribambase.reference_add"
     bl_label = "Add Reference"
@@ -86,19 +125,15 @@ class SB_OT_reference_add(bpy.types.Operator):
     def execute(self, context):
         image = bpy.data.images.load(self.filepath)
         #image.pack() # NOTE without packing it breaks after reload but so what
-        w, h = image.size
-        scale_image(image, self.scale)
-        image.sb_scale = self.scale
-
-        bpy.ops.object.add(align='WORLD', rotation=(pi/2, 0, 0), location = (0, 0, 0))
-        ref = context.active_object
-        ref.data = image
-        ref.empty_display_type = 'IMAGE'
-        ref.use_empty_image_alpha = self.opacity < 1.0
-        ref.color[3] = self.opacity
-        ref.empty_display_size = max(w, h) * context.space_data.overlay.grid_scale
+        ref = add_reference(image, self.scale, self.opacity, self.selectable,
+                collection=context.collection, grid_scale=context.space_data.overlay.grid_scale)
+
+        for obj in context.selected_objects:
+            obj.select_set(False)
+        ref.select_set(True)
+        context.view_layer.objects.active = ref
+
         if not self.selectable:
-            ref.hide_select = True
             self.report({'INFO'}, "The reference won't be selectable. Use the outliner to reload/delete it")
 
         return {'FINISHED'}
@@ -157,7 +192,8 @@ class SB_PT_panel_link(bpy.types.Panel):
         status = "Off"
         icon = 'UNLINKED'
         if addon.connected:
-            status = "Connected"
+            count = len(addon.server.clients)
+            status = "Connected" if count == 1 else f"Connected ({count})"
             icon = 'CHECKMARK'
         elif addon.server_up:
             status = "Waiting..."
@@ -173,6 +209,154 @@ class SB_PT_panel_link(bpy.types.Panel):
             row.operator("pribambase.start_server", text="Connect", icon="DECORATE_LINKED")
         row.operator("pribambase.preferences", icon='PREFERENCES', text="", emboss=False)
 
+        if addon.server_up:
+            for client in addon.server.clients:
+                for stream in client.streams.values():
+                    if stream.superseded:
+                        continue
+                    _, name = path.split(stream.name)
+                    layout.row().label(text=f"{name}: {int(stream.progress * 100)}%", icon='IMPORT')
+
+        layout.row().prop(addon.state, "paint_sync")
+
         layout.row().operator("pribambase.reference_add")
         layout.row().operator("pribambase.reference_reload")
         layout.row().operator("pribambase.reference_reload_all")
+
+
+class SB_OT_metrics_export(bpy.types.Operator):
+    bl_idname = "pribambase.metrics_export"
+    bl_label = "Export Stats..."
+    bl_description = "Save the sync performance counters and timings as JSON"
+
+    filepath: bpy.props.StringProperty(subtype="FILE_PATH")
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+
+    def execute(self, context):
+        import json
+
+        with open(bpy.path.abspath(self.filepath), "w") as f:
+            json.dump(addon.metrics.as_dict(), f, indent=2)
+
+        return {'FINISHED'}
+
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "pribambase-stats.json"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+class SB_OT_metrics_reset(bpy.types.Operator):
+    bl_idname = "pribambase.metrics_reset"
+    bl_label = "Reset Stats"
+    bl_description = "Start counting the sync performance from zero"
+
+    def execute(self, context):
+        addon.metrics.reset()
+        return {'FINISHED'}
+
+
+class SB_OT_trace(bpy.types.Operator):
+    bl_idname = "pribambase.trace"
+    bl_label = "Trace Messages"
+    bl_description = "Start or stop recording where the time goes for each message"
+
+    def execute(self, context):
+        tracer = addon.tracer
+        if tracer.enabled:
+            tracer.stop()
+        else:
+            tracer.start()
+        return {'FINISHED'}
+
+
+class SB_OT_trace_export(bpy.types.Operator):
+    bl_idname = "pribambase.trace_export"
+    bl_label = "Export Trace..."
+    bl_description = "Save the recorded trace as JSON, that can be opened in chrome://tracing or ui.perfetto.dev"
+
+    filepath: bpy.props.StringProperty(subtype="FILE_PATH")
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+
+    @classmethod
+    def poll(self, ctx):
+        return len(addon.tracer.events) > 0
+
+
+    def execute(self, context):
+        addon.tracer.export(bpy.path.abspath(self.filepath))
+        return {'FINISHED'}
+
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "pribambase-trace.json"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}GB"
+
+
+class SB_PT_panel_stats(bpy.types.Panel):
+    bl_idname = "SB_PT_panel_stats_3d"
+    bl_label = "Stats"
+    bl_category = "Tool"
+    bl_space_type = "VIEW_3D"
+    bl_region_type = "UI"
+    bl_parent_id = "SB_PT_panel_link_3d"
+    bl_options = {'DEFAULT_CLOSED'}
+
+
+    def draw(self, context):
+        layout = self.layout
+        metrics = addon.metrics
+
+        col = layout.column(align=True)
+        for name, n in sorted(metrics.counters.items()):
+            text = _format_bytes(n) if name.startswith("bytes") else str(n)
+            row = col.row()
+            row.label(text=name)
+            row.label(text=text)
+
+        # times in ms
+        col = layout.column(align=True)
+        for name, h in sorted(metrics.histograms.items()):
+            row = col.row()
+            row.label(text=name)
+            row.label(text=f"{h.count}x {h.mean * 1000:.2f} / {h.percentile(95) * 1000:.1f} / {h.max * 1000:.1f}")
+
+        if metrics.histograms:
+            layout.row().label(text="count, mean / p95 / max ms")
+
+        row = layout.row()
+        row.operator("pribambase.metrics_export", text="Export")
+        row.operator("pribambase.metrics_reset", text="Reset")
+
+        row = layout.row()
+        tracing = addon.tracer.enabled
+        row.operator("pribambase.trace", text="Stop Trace" if tracing else "Trace", icon='REC' if tracing else 'SEQUENCE', depress=tracing)
+        row.operator("pribambase.trace_export", text="Export")
+
+        if addon.profile:
+            layout.row().label(text="Profiling...", icon='REC')
+        else:
+            layout.row().operator("pribambase.profile", icon='TIME')
+
+        if addon.profile_summary:
+            _, name = path.split(addon.profile_path)
+            layout.row().label(text=name, icon='FILE')
+            col = layout.column(align=True)
+            for func, calls, own, total in addon.profile_summary:
+                row = col.row()
+                row.label(text=func)
+                row.label(text=f"{calls}x {total * 1000:.0f} ms")
@@ -23,9 +23,25 @@ import imbuf
 import os
 from os import path
 import tempfile
-import numpy as np
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 from .addon import addon
+from . import async_loop
+from . import trace
+# the conversions used to live here, other modules still use them as util.*
+from .core import RGBA, INDEXED, GRAY, to_blender_pixels, palette_lut, indexed_to_blender_pixels, gray_to_blender_pixels, row_digests
+from .core import is_aseprite
+from . import core
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
+    from .sync import Client
 
 
 def refresh():
@@ -50,9 +66,11 @@ class ModalExecuteMixin:
         raise NotImplementedError()
 
     def modal(self, context, event):
-        if event.type == 'TIMER':
-            context.window_manager.event_timer_remove(self.timer)
-            self.modal_execute(context)
+        if event.type != 'TIMER':
+            # input that comes before the timer is not ours to eat
+            return {'PASS_THROUGH'}
+        context.window_manager.event_timer_remove(self.timer)
+        self.modal_execute(context)
         return {'FINISHED'}
 
     def execute(self, context):
@@ -76,6 +94,85 @@ def image_name(img):
     return img.name
 
 
+class TextureTracker:
+    """
+    Keeps the set of texture names that Aseprite knows about, and works out what changed from the images
+    reported by the depsgraph, without going over every image in the blendfile
+    """
+
+    def __init__(self):
+        self._names = {} # image pointer -> name
+        self._count = Counter() # name -> number of images using it
+
+
+    @property
+    def names(self) -> Iterable[str]:
+        return self._count.keys()
+
+
+    @property
+    def stale(self) -> bool:
+        """Images were added or removed without being reported"""
+        return len(self._names) != len(bpy.data.images)
+
+
+    def reset(self) -> Iterable[str]:
+        """Rebuild the list from scratch, and return all names"""
+        self._names = {img.as_pointer(): image_name(img) for img in bpy.data.images}
+        self._count = Counter(self._names.values())
+        return self.names
+
+
+    def update(self, images:Iterable[bpy.types.Image]) -> Tuple[List[str], List[str], List[Tuple[str, str]]]:
+        """Check given images for changes, and return lists of (added, removed, renamed) names"""
+        added, removed, renamed = [], [], []
+
+        def change(old, new):
+            gone = fresh = False
+
+            if old is not None:
+                self._count[old] -= 1
+                if not self._count[old]:
+                    del self._count[old]
+                    gone = True
+
+            if new is not None:
+                self._count[new] += 1
+                fresh = self._count[new] == 1
+
+            if gone and fresh:
+                renamed.append((old, new))
+            elif gone:
+                removed.append(old)
+            elif fresh:
+                added.append(new)
+
+        for img in images:
+            ptr = img.as_pointer()
+            name = image_name(img)
+            old = self._names.get(ptr)
+            if old != name:
+                self._names[ptr] = name
+                change(old, name)
+
+        if self.stale:
+            # only compare pointers, names are checked for updated images above
+            alive = {img.as_pointer(): img for img in bpy.data.images}
+            for ptr in self._names.keys() - alive.keys():
+                change(self._names.pop(ptr), None)
+            for ptr in alive.keys() - self._names.keys():
+                name = self._names[ptr] = image_name(alive[ptr])
+                change(None, name)
+
+        # the same name might come and go within one update, e.g. after undo
+        both = set(added).intersection(removed)
+        if both:
+            added = [n for n in added if n not in both]
+            removed = [n for n in removed if n not in both]
+
+        return added, removed, renamed
+
+
 def new_packed_image(name, w, h):
     """Create a packed image with data that will be saved (unlike bpy.data.images.new that is cleaned when the file is opened)"""
     img = bpy.data.images.new(name, w, h, alpha=True)
@@ -89,56 +186,412 @@ def new_packed_image(name, w, h):
     return img
 
 
-_update_image_args = None
-def update_image(w, h, name, pixels):
-    global update_image_args
-    update_image_args = w, h, name, pixels
-    bpy.ops.pribambase.update_image()
+# (w, h, dtype, row checksums) of the last applied frame, by image name
+_row_digests = {}
 
-class SB_OT_update_image(bpy.types.Operator, ModalExecuteMixin):
-    bl_idname = "pribambase.update_image"
-    bl_label = "Update Image"
-    bl_description = "Report the message. Not redoable atm"
-    bl_options = {'REGISTER', 'UNDO_GROUPED', 'INTERNAL'}
-    bl_undo_group = "pribambase.update_image"
 
-    def modal_execute(self, context):
-        """Replace the image with pixel data"""
-        img = None
-        w, h, name, pixels = self.args
-
-        for i in bpy.data.images:
-            if (i.sb_source == name) or \
-                    (name == (bpy.path.abspath(i.filepath) if i.filepath.startswith("//") else i.filepath)) \
-                    or (name == i.name):
-                img = i
-                break
-        else:
-            # to avoid accidentally reviving deleted images, we ignore anything doesn't exist already
-            return
-
-        if not img.has_data:
-            # load *some* data so that the image can be packed, and then updated
-            ib = imbuf.new((w, h))
-            tmp = path.join(tempfile.gettempdir(), "__sb__delete_me.png")
-            imbuf.write(ib, tmp)
-            img.filepath = tmp
+def forget_images():
+    """Drop the checksums, for when the images might have changed behind our back, like after undo or loading a file"""
+    global _viewport_images
+    _row_digests.clear()
+    _viewport_images = (float("-inf"), frozenset())
+
+
+def forget_image(name):
+    """Drop the image's checksums, so that the next frame from Aseprite isn't skipped after the image was painted over"""
+    _row_digests.pop(name, None)
+
+
+def applied_digest(name):
+    """Checksums of the last frame from Aseprite that was applied to the image, or None"""
+    return _row_digests.get(name)
+
+
+# the last frame of each synced image that changed since the file was saved, by datablock name
+_unsaved = {}
+
+
+def forget_unsaved():
+    _unsaved.clear()
+
+
+def pack_unsaved_images():
+    """
+    Encode the images that changed since the last save in the worker threads, and pack them. Blender encodes
+    modified packed images one by one when saving, this way it doesn't have to, and unchanged ones cost nothing
+    """
+    jobs = []
+    for name, (w, h, pixels) in _unsaved.items():
+        img = bpy.data.images.get(name)
+        # images that live in files are up to the user to save
+        if img and img.packed_file and tuple(img.size) == (w, h):
+            jobs.append((img, w, h, pixels))
+    _unsaved.clear()
+
+    if not jobs:
+        return
+
+    level = addon.prefs.png_compression
+    with addon.metrics.timer("save_encode"):
+        encoded = list(async_loop.executor().map(lambda job: core.encode_png(job[3], job[1], job[2], level), jobs))
+
+    with addon.metrics.timer("save_pack"):
+        for (img, *_), data in zip(jobs, encoded):
+            img.pack(data=data, data_len=len(data))
+            # drops the modified buffer, so blender doesn't encode it again; it's loaded back from the png when drawn
             img.reload()
-            img.pack()
-            img.filepath=""
-            img.use_fake_user = True
-            os.remove(tmp)
+    addon.metrics.count("images_packed", len(jobs))
+
+
+def load_sprites(images:Iterable[bpy.types.Image], newer_than:float=0.0) -> int:
+    """
+    Update the images from their .aseprite files, without Aseprite. The files are decoded in parallel, and only the ones
+    changed after `newer_than` timestamp are. Returns the number of images updated
+    """
+    jobs = []
+    for img in images:
+        source = img.sb_source
+        if is_aseprite(source):
+            try:
+                if path.getmtime(source) > newer_than:
+                    jobs.append(source)
+            except OSError:
+                pass # moved or deleted
+
+    if not jobs:
+        return 0
+
+    # it loads numpy, so only once there's something to decode
+    from . import aseprite
+
+    def decode(source):
+        try:
+            return aseprite.load(source)
+        except (OSError, ValueError, zlib.error) as e:
+            return e
+
+    with addon.metrics.timer("sprite_decode"):
+        results = list(async_loop.executor().map(decode, jobs))
+
+    count = 0
+    with batch_updates():
+        for source, pixels in zip(jobs, results):
+            if isinstance(pixels, Exception):
+                bpy.ops.pribambase.report(message_type='WARNING', message=f"Could not load {path.basename(source)}: {pixels}")
+                continue
+            h, w = pixels.shape[:2]
+            update_image(w, h, source, pixels.ravel())
+            count += 1
+
+    return count
+
+
+def rename_image(old_name, new_name):
+    """Move the checksums over when the sprite is saved under a new name, otherwise the old ones stay forever"""
+    if old_name in _row_digests:
+        _row_digests[new_name] = _row_digests.pop(old_name)
+
+
+# number of the frame that's being handled, 0 if the client doesn't number them
+frame_seq:ContextVar[int] = ContextVar("pribambase_frame_seq", default=0)
+
+
+def ack_image(client, name, seq=None):
+    """Let the client know that the frame is done with, it sends the next one when it gets that"""
+    if client is not None and client.options.get("ack") and addon.server_up:
+        from .messaging import encode
+        addon.server.send(encode.ack(name, frame_seq.get() if seq is None else seq), client=client)
+
+
+class Update(NamedTuple):
+    """Frame that waits for the operator"""
+    w: int
+    h: int
+    # RGBA bytes, or floats already converted by to_blender_pixels(); this is what gets saved
+    pixels: 'np.ndarray'
+    # the same bytes converted in a worker thread, if they were
+    floats: Optional['np.ndarray']
+    # (w, h, dtype, row checksums)
+    digest: tuple
+    # numbers of this frame and of the ones it replaced, they all get acked when it's applied
+    seqs: List[int]
+    client: Optional['Client']
+    queued: float
+    trace_id: int
+
+
+# image updates that wait for the operator, by name; only the latest frame of each image is kept
+_pending:Dict[str, Update] = {}
+# the operator is going to run, no need to call it again
+_dispatched = False
+# when it was called; if it doesn't run for that long, it's considered lost and called again
+_dispatched_at = 0.0
+DISPATCH_TIMEOUT = 1.0
+_batch_depth = 0
+
+# how soon the images are updated, by where they're shown
+EDITOR = 0 # open in an image editor
+VIEWPORT = 1 # on a material of a visible object, in a viewport that shows textures
+HIDDEN = 2 # not shown anywhere, the updates wait and only the latest one is applied
+# hidden images are updated at most this often, seconds
+DEFER_INTERVAL = 0.5
+# going over the materials takes a while in big scenes, so what the viewports show is looked up at most this often
+VISIBILITY_INTERVAL = 1.0
+
+# when the update of each hidden image was first put off, by name
+_deferred = {}
+# (time, image names) of the last lookup of the viewports
+_viewport_images = (float("-inf"), frozenset())
+
+
+@contextmanager
+def batch_updates():
+    """Image updates within the context are applied by one operator call, with one redraw and undo step"""
+    global _batch_depth
+    _batch_depth += 1
+    try:
+        yield
+    finally:
+        _batch_depth -= 1
+        if not _batch_depth and _pending:
+            _dispatch_updates()
+
+
+def _dispatch_updates():
+    global _dispatched, _dispatched_at
+    if _dispatched and perf_counter() - _dispatched_at < DISPATCH_TIMEOUT:
+        return
+
+    _dispatched = True
+    _dispatched_at = perf_counter()
+    try:
+        bpy.ops.pribambase.update_image()
+    except:
+        _dispatched = False
+        raise
+
+    if _dispatched and not bpy.app.timers.is_registered(apply_deferred):
+        # the modal timer might never fire, e.g. if a file is loaded first; this one calls the operator again then
+        bpy.app.timers.register(apply_deferred, first_interval=DISPATCH_TIMEOUT)
+
+
+def forget_dispatch():
+    """Loading a file drops the operator that was going to run"""
+    global _dispatched
+    _dispatched = False
+
+
+def update_image(w, h, name, pixels, floats=None):
+    """
+    Replace the image's pixels. Takes either RGBA bytes, or floats already converted by to_blender_pixels().
+    Frames that are the same as the last one are skipped, so they don't make an undo step either. If the bytes
+    were converted already in a worker thread, pass the floats too; the bytes are still used for the checksums
+    """
+    digest = w, h, pixels.dtype.str, row_digests(pixels, h)
+    client = addon.client if addon.server_up else None
+    seq = frame_seq.get()
+
+    waiting = _pending.get(name)
+    if digest == (waiting.digest if waiting else _row_digests.get(name)):
+        addon.metrics.count("updates_skipped")
+        ack_image(client, name, seq)
+        return
+
+    # acks of the replaced frames are sent along with this one
+    seqs = (waiting.seqs if waiting else []) + [seq]
+    if waiting:
+        addon.metrics.count("updates_replaced")
+    _pending[name] = Update(w, h, pixels, floats, digest, seqs, client, perf_counter(), trace.current.get())
+
+    if not _batch_depth:
+        _dispatch_updates()
+
+
+def image_index():
+    """Images by every name an update can refer to them by; the first one wins, same as going over them in order"""
+    index = {}
+    for i in bpy.data.images:
+        fp = i.filepath
+        for key in (i.sb_source, bpy.path.abspath(fp) if fp.startswith("//") else fp, i.name):
+            if key:
+                index.setdefault(key, i)
+    return index
+
+
+def _material_images(mat, found, seen):
+    """Add the images of the material's texture nodes, including the ones in node groups"""
+    tree = mat.node_tree if mat.use_nodes else None
+    stack = [tree] if tree else []
+    while stack:
+        tree = stack.pop()
+        if tree.name in seen:
+            continue
+        seen.add(tree.name)
+        for node in tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image:
+                found.add(node.image.name)
+            elif node.type == 'GROUP' and node.node_tree:
+                stack.append(node.node_tree)
+
+
+def viewport_images(windows) -> frozenset:
+    """Names of the images on materials of the visible objects, if any viewport shows materials or textures"""
+    global _viewport_images
+
+    now = perf_counter()
+    if now - _viewport_images[0] < VISIBILITY_INTERVAL:
+        return _viewport_images[1]
+
+    found = set()
+    layers = []
+    for win in windows:
+        for area in win.screen.areas:
+            if area.type == 'VIEW_3D':
+                shading = area.spaces.active.shading
+                if shading.type in ('MATERIAL', 'RENDERED') or (shading.type == 'SOLID' and shading.color_type == 'TEXTURE'):
+                    if win.view_layer not in layers:
+                        layers.append(win.view_layer)
+
+    materials = set()
+    seen = set()
+    for layer in layers:
+        for obj in layer.objects:
+            if obj.visible_get(view_layer=layer):
+                for slot in obj.material_slots:
+                    mat = slot.material
+                    if mat and mat.name not in materials:
+                        materials.add(mat.name)
+                        _material_images(mat, found, seen)
+
+    _viewport_images = now, frozenset(found)
+    return _viewport_images[1]
+
+
+def image_ranks():
+    """Function that tells how soon an image should be updated, or None if there's no UI to show them anyway"""
+    wm = bpy.context.window_manager
+    windows = wm.windows if wm else ()
+    if not windows:
+        return None
+
+    editors = set()
+    for win in windows:
+        for area in win.screen.areas:
+            if area.type == 'IMAGE_EDITOR' and area.spaces.active.image:
+                editors.add(area.spaces.active.image.name)
 
-        elif (img.size[0] != w or img.size[1] != h):
-                img.scale(w, h)
+    viewports = viewport_images(windows)
 
-        # convert data to blender accepted floats
-        pixels = np.float32(pixels) / 255.0
-        # flip y axis ass backwards
-        pixels.shape = (h, pixels.size // h)
-        pixels = pixels[::-1,:].ravel()
+    def rank(img):
+        if img is None or img.name in editors:
+            return EDITOR # missing images only need the ack
+        return VIEWPORT if img.name in viewports else HIDDEN
 
-        # change blender data
+    return rank
+
+
+def apply_deferred():
+    """Timer that applies the hidden images' updates once they waited long enough, or the ones the operator lost"""
+    if _pending:
+        _dispatch_updates()
+    return None
+
+
+def apply_updates(defer=True):
+    """
+    Replace the images with the pixels that wait for it, right away. Normally the operator does that. The images that
+    are shown go first, and the hidden ones wait up to DEFER_INTERVAL unless `defer` is off
+    """
+    global _dispatched
+    _dispatched = False
+
+    updates = tuple(_pending.items())
+    _pending.clear()
+
+    # one pass over the images instead of one per update, scripts can load thousands at once
+    images = image_index()
+    rank = image_ranks() if defer else None
+    if rank:
+        updates = sorted(updates, key=lambda u: rank(images.get(u[0])))
+
+    now = perf_counter()
+    applied = 0
+    for name, update in updates:
+        img = images.get(name)
+        if rank and rank(img) == HIDDEN:
+            since = _deferred.setdefault(name, now)
+            if since == now:
+                addon.metrics.count("updates_deferred")
+            if now - since < DEFER_INTERVAL:
+                # newer frames replace it while it waits
+                _pending[name] = update
+                continue
+
+        _deferred.pop(name, None)
+        _apply(img, name, update)
+        applied += 1
+
+    if _pending and not bpy.app.timers.is_registered(apply_deferred):
+        bpy.app.timers.register(apply_deferred, first_interval=DEFER_INTERVAL)
+
+    if applied:
+        with addon.metrics.timer("redraw"):
+            refresh()
+        addon.metrics.count("redraws")
+
+
+def _apply(img, name, update:Update):
+    # the spans of applying go to the message the frame came in
+    token = trace.current.set(update.trace_id)
+    try:
+        _apply_image(img, name, update)
+    finally:
+        trace.current.reset(token)
+
+
+def _apply_image(img, name, update:Update):
+    import numpy as np
+
+    w, h, pixels, seqs, client = update.w, update.h, update.pixels, update.seqs, update.client
+
+    metrics = addon.metrics
+    now = perf_counter()
+    metrics.time("update_wait", now - update.queued)
+    if addon.tracer.enabled:
+        addon.tracer.async_span("update_wait", update.queued, now, trace.current.get())
+
+    if img is None:
+        # to avoid accidentally reviving deleted images, we ignore anything doesn't exist already
+        for seq in seqs:
+            ack_image(client, name, seq)
+        return
+
+    if not img.has_data:
+        # load *some* data so that the image can be packed, and then updated
+        ib = imbuf.new((w, h))
+        tmp = path.join(tempfile.gettempdir(), "__sb__delete_me.png")
+        imbuf.write(ib, tmp)
+        img.filepath = tmp
+        img.reload()
+        img.pack()
+        img.filepath=""
+        img.use_fake_user = True
+        os.remove(tmp)
+
+    elif (img.size[0] != w or img.size[1] != h):
+            img.scale(w, h)
+
+    # the bytes take a quarter of what the floats do, and the png encoder takes either
+    _unsaved[img.name] = w, h, pixels
+
+    with metrics.timer("conversion"):
+        if update.floats is not None:
+            pixels = update.floats
+        elif pixels.dtype != np.float32:
+            pixels = to_blender_pixels(pixels, h)
+
+    # change blender data
+    with metrics.timer("foreach_set"):
         try:
             # version >= 2.83; this is much faster
             img.pixels.foreach_set(pixels)
@@ -146,18 +599,29 @@ class SB_OT_update_image(bpy.types.Operator, ModalExecuteMixin):
             # version < 2.83
             img.pixels[:] = pixels
 
+    _row_digests[name] = update.digest
+
+    with metrics.timer("update"):
         img.update()
 
         # [#12] for some users viewports do not update from update() alone
         img.update_tag()
-        refresh()
 
-        return {'FINISHED'}
+    for seq in seqs:
+        ack_image(client, name, seq)
 
 
-    def execute(self, context):
-        self.args = update_image_args
-        return ModalExecuteMixin.execute(self, context)
+class SB_OT_update_image(bpy.types.Operator, ModalExecuteMixin):
+    bl_idname = "pribambase.update_image"
+    bl_label = "Update Image"
+    bl_description = "Report the message. Not redoable atm"
+    bl_options = {'REGISTER', 'UNDO_GROUPED', 'INTERNAL'}
+    bl_undo_group = "pribambase.update_image"
+
+    def modal_execute(self, context):
+        """Replace the images with pixel data"""
+        apply_updates()
+        return {'FINISHED'}
 
 
 class SB_OT_report(bpy.types.Operator, ModalExecuteMixin):